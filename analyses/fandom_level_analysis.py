@@ -1,37 +1,64 @@
-import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
 import streamlit as st
 
-from utils import logger, format_number
-from fandom import Fandom
+from chord_charts import retrieve_chord_chart
+from utils import logger, format_number, retrieve_fandom_search_index
+from fandom_cache import retrieve_fandom_cache
+from name_search import NAME_SEARCH_NGRAM, NAME_SEARCH_PAGE_SIZE
 
-FANDOM_ORDER_LU = {
-    'Popularity by Work Count': {'by': 'works_num', 'ascending': False},
-    'Alphabetically': {'by': 'fandom_name', 'ascending': True},
-}
+FANDOM_ORDER_LU = ['Popularity by Work Count', 'Alphabetically']
 
 
 class FandomLevelAnalysis:
-    def __init__(
-        self, non_fandom_tags_agg, works_with_fandom, fandom_works_count
-    ):
-        fandom_works_count = fandom_works_count.compute().reset_index()
-        col1, col2 = st.columns([1, 2])
+    def __init__(self):
+        # Only a page of fandoms is sent to the browser, from the search index
+        # rather than the full fandom_works_count
+        search_index = retrieve_fandom_search_index()
+        col1, col2, col3 = st.columns([2, 3, 1])
         fandom_order = col1.radio(
             'View fandom list ordered by', FANDOM_ORDER_LU
         )
-        fandom_select_list = fandom_works_count.sort_values(
-            **FANDOM_ORDER_LU[fandom_order]
+        query = col2.text_input(
+            'Search fandoms',
+            help=(
+                'Matches any part of the fandom name, or its start for '
+                f'fewer than {NAME_SEARCH_NGRAM} characters'
+            ),
         )
-        fandom_selection = col2.selectbox(
-            'Choose fandom (can type to search)', fandom_select_list
+        # Keyed by the search so a new search starts on its first page
+        page = col3.number_input(
+            'Page',
+            min_value=1,
+            value=1,
+            step=1,
+            key=f'fandom_page_{fandom_order}_{query}',
         )
-        logger.info(f'Initializing fandom class for {fandom_selection}')
-        fandom = Fandom(
-            fandom_selection, works_with_fandom, non_fandom_tags_agg
+        offset = (page - 1) * NAME_SEARCH_PAGE_SIZE
+        fandoms, has_more = search_index.search(
+            query, offset, alphabetical=fandom_order == FANDOM_ORDER_LU[1]
+        )
+        if not fandoms:
+            st.warning('No fandom found, try another search or page.')
+            return
+        works_nums = {
+            fandom['name']: fandom['works_num'] for fandom in fandoms
+        }
+        fandom_selection = st.selectbox(
+            'Choose fandom',
+            list(works_nums),
+            format_func=lambda name: (
+                f'{name} ({format_number(works_nums[name])} works)'
+            ),
         )
+        if has_more:
+            st.caption('More fandoms on the next page.')
+        logger.info(f'Initializing fandom class for {fandom_selection}')
+        fandom = retrieve_fandom_cache().get(fandom_selection)
         logger.info(f'{fandom_selection} initialized')
+        works_num = works_nums[fandom_selection]
         st.markdown(
-            f'We found __{format_number(len(fandom.works))}__ '
+            f'We found __{format_number(works_num)}__ '
             f'works to analyze.'
         )
         st.markdown('***')
@@ -39,11 +66,11 @@ class FandomLevelAnalysis:
         relationship_type = st.radio(
             'Choose relationship type', ['romantic', 'platonic']
         )
-        fig_c, ax_c = plt.subplots()
-        fandom.generate_relationship_chord_chart(
-            relationship_type=relationship_type, ax=ax_c
+        # Rendered once per fandom and served from the cache afterwards
+        st.image(
+            retrieve_chord_chart(fandom, relationship_type),
+            use_column_width=True,
         )
-        st.pyplot(fig_c)
         st.markdown(
             '''
             Inspiration for chart came from the visualizations of 
@@ -72,5 +99,40 @@ class FandomLevelAnalysis:
         col2.metric('Median', median_word_count)
         st.plotly_chart(fig_wc, use_container_width=True)
         st.subheader('Works Over Time')
-        fig_ym = fandom.year_month_distribution()
+        months = pd.DatetimeIndex(fandom.timeline.months).strftime('%Y-%m')
+        if not len(months):
+            st.plotly_chart(
+                fandom.year_month_distribution(), use_container_width=True
+            )
+            return
+        # Answered from the prefix sums of the fandom, so moving the slider
+        # does not read works
+        first_month, last_month = st.select_slider(
+            'Months created',
+            options=list(months),
+            value=(months[0], months[-1]),
+        )
+        start = pd.Timestamp(first_month)
+        end = pd.Timestamp(last_month) + pd.offsets.MonthBegin()
+        fig_ym = fandom.year_month_distribution(start, end)
         st.plotly_chart(fig_ym, use_container_width=True)
+        summary = fandom.timeline.summary(start, end)
+        col1, col2 = st.columns(2)
+        col1.metric('Works', format_number(summary['works_num']))
+        col2.metric(
+            'Mean Word Count',
+            '-' if np.isnan(summary['word_count_mean'])
+            else int(summary['word_count_mean']),
+        )
+        top_relationships = fandom.timeline.top_relationships(start, end)
+        if top_relationships.empty:
+            st.markdown(
+                f'No relationships tagged from {first_month} to '
+                f'{last_month}.'
+            )
+            return
+        st.markdown(
+            f'Most popular relationships from {first_month} to '
+            f'{last_month}:'
+        )
+        st.dataframe(top_relationships, use_container_width=True)
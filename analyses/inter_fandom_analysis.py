@@ -1,49 +1,69 @@
 import streamlit as st
-import pandas as pd
 import plotly.express as px
 
-from utils import PX_TEMPLATE, PX_FONT_SIZE_AXES, PX_FONT_SIZE_TICKS
+from utils import (
+    retrieve_top_relationships, PX_TEMPLATE, PX_FONT_SIZE_AXES,
+    PX_FONT_SIZE_TICKS
+)
 
 
 class InterFandomAnalysis:
-    def __init__(
-        self, non_fandom_tags_agg, works_with_fandom, fandom_works_count
-    ):
-        idx = pd.IndexSlice
-        non_fandom_tags_agg = non_fandom_tags_agg.compute()
-        fandom_works_count = fandom_works_count.compute()
-        rel_tags = non_fandom_tags_agg.loc[idx[:, ['Relationship']], :]
-        rel_tags = rel_tags.droplevel('type_final', axis=0).drop(
-            columns='word_count_mean'
-        )
-        rel_tags['rn'] = rel_tags.groupby('fandom_name')['works_num'].rank(
-            method='first', ascending=False
-        )
-        most_popular = (
-            rel_tags.loc[rel_tags['rn'] == 1].drop(columns='rn').reset_index()
-        )
-        most_popular = most_popular.merge(
-            fandom_works_count,
-            how='left',
-            on='fandom_name',
-            suffixes=('', '_fandom_total'),
+    def __init__(self):
+        most_popular = self.retrieve_most_popular_relationships()
+        st.subheader(
+            '''
+            How popular is the most popular pairing in each fandom? 
+        '''
         )
-        most_popular['pct_of_fandom'] = (
-            most_popular['works_num'] / most_popular['works_num_fandom_total']
+        st.markdown('#### And how popular is it?')
+        fig = self.most_popular_relationship_scatter(most_popular)
+        st.plotly_chart(fig, use_container_width=True)
+        st.markdown(
+            '''
+            The chart below plots the popularity of the most popular pairing 
+            for the top 100 fandoms by number of works. 
+            Each dot represents one fandom. Zoom in and hover over each dot 
+            for details on which fandom and pairing each dot represents.
+            The x axis represents the percent of total works within the fandom 
+            that are tagged with the most popular pairing.
+            The y axis represents the total number of works within the fandom 
+            as of the time of data collection.    
+        '''
         )
+
+    @staticmethod
+    def retrieve_most_popular_relationships():
+        """
+        Most popular relationship of each fandom
+        :return: One row per fandom, sorted by number of works in the fandom
+        :rtype: pandas DataFrame
+        """
+        # Precomputed in preprocessing, see build_top_relationships
+        top_relationships = retrieve_top_relationships()
+        most_popular = top_relationships.loc[
+            top_relationships['rank'] == 1
+        ].copy()
         most_popular.sort_values(
             by='works_num_fandom_total',
             ascending=False,
             inplace=True,
         )
-        st.subheader(
-            '''
-            How popular is the most popular pairing in each fandom? 
-        '''
-        )
-        st.markdown('#### And how popular is it?')
+        return most_popular
+
+    @staticmethod
+    def most_popular_relationship_scatter(most_popular, fandoms_num=100):
+        """
+        Plots the share of works of the most popular relationship of each
+            fandom against the number of works of the fandom
+        :param most_popular: Top relationship of each fandom, sorted by number
+            of works in the fandom
+        :type most_popular: pandas DataFrame
+        :param fandoms_num: Number of fandoms to plot
+        :type fandoms_num: int
+        :return: Plotly figure
+        """
         fig = px.scatter(
-            most_popular.head(100),
+            most_popular.head(fandoms_num),
             x='pct_of_fandom',
             y='works_num_fandom_total',
             custom_data=['fandom_name', 'name_final'],
@@ -77,16 +97,4 @@ class InterFandomAnalysis:
         fig.update_xaxes(
             rangeselector_font_size=PX_FONT_SIZE_AXES,
         )
-        st.plotly_chart(fig, use_container_width=True)
-        st.markdown(
-            '''
-            The chart below plots the popularity of the most popular pairing 
-            for the top 100 fandoms by number of works. 
-            Each dot represents one fandom. Zoom in and hover over each dot 
-            for details on which fandom and pairing each dot represents.
-            The x axis represents the percent of total works within the fandom 
-            that are tagged with the most popular pairing.
-            The y axis represents the total number of works within the fandom 
-            as of the time of data collection.    
-        '''
-        )
+        return fig
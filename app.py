@@ -1,16 +1,35 @@
+import importlib
+
 import streamlit as st
 
-from utils import retrieve_preprocessed_data, MINIMUM_WORK_COUNT
-from analyses.fandom_level_analysis import FandomLevelAnalysis
-from analyses.inter_fandom_analysis import InterFandomAnalysis
+from utils import MINIMUM_WORK_COUNT
 
+# Module and class of each analysis. A session renders one analysis, so each
+# is imported (with the chart libraries it needs) only when it is chosen, and
+# loads the data it uses through its own cached loaders
 ANALYSIS_TYPES = {
-    'Fandom Level': FandomLevelAnalysis,
-    'Inter-fandom': InterFandomAnalysis,
+    'Fandom Level': (
+        'analyses.fandom_level_analysis', 'FandomLevelAnalysis'
+    ),
+    'Inter-fandom': (
+        'analyses.inter_fandom_analysis', 'InterFandomAnalysis'
+    ),
 }
 PAGE_TITLE = 'AO3 Data Visualizations'
 
 
+def load_analysis(analysis_type):
+    """
+    Imports the class of an analysis
+    :param analysis_type: Key of ANALYSIS_TYPES
+    :type analysis_type: str
+    :return: Class that renders the analysis when initialized
+    :rtype: type
+    """
+    module_name, class_name = ANALYSIS_TYPES[analysis_type]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
 def run():
     st.set_page_config(
         initial_sidebar_state='auto',
@@ -18,11 +37,6 @@ def run():
         page_title=PAGE_TITLE,
         layout='wide',
     )
-    (
-        non_fandom_tags_agg,
-        works_with_fandom,
-        fandom_works_count,
-    ) = retrieve_preprocessed_data()
     st.title(PAGE_TITLE)
     st.markdown(
         '''
@@ -35,9 +49,7 @@ def run():
     st.markdown('***')
     analysis_type = st.sidebar.radio('Choose an analysis', ANALYSIS_TYPES)
     # Initializes the class with the analysis
-    ANALYSIS_TYPES[analysis_type](
-        non_fandom_tags_agg, works_with_fandom, fandom_works_count
-    )
+    load_analysis(analysis_type)()
     st.markdown('***')
     with st.expander('General methodology notes'):
         st.markdown(
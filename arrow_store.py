@@ -0,0 +1,161 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Schema metadata key of the rows of each fandom in a store file
+ARROW_STORE_FANDOM_INDEX_KEY = b'fandom_index'
+
+
+def arrow_store_location(file_location, store_directory):
+    """
+    Location in the Arrow store of the copy of a parquet file
+    :param file_location: Location of the parquet file
+    :type file_location: str
+    :param store_directory: Directory of the Arrow store
+    :type store_directory: str
+    :return: Location of the Arrow IPC file
+    :rtype: str
+    """
+    return os.path.join(
+        store_directory,
+        os.path.basename(file_location).replace('.parquet', '.arrow'),
+    )
+
+
+def fandom_row_ranges(fandom_names):
+    """
+    Rows of each fandom in data where the rows of a fandom are contiguous
+    :param fandom_names: Fandom of each row, or any other key of the rows
+        such as a MultiIndex
+    :type fandom_names: pandas Series, Index or numpy array
+    :return: Fandom to start and end of its rows
+    :rtype: dict
+    """
+    fandom_codes, unique_fandom_names = pd.factorize(fandom_names)
+    fandom_starts = np.flatnonzero(np.diff(fandom_codes, prepend=-1) != 0)
+    fandom_ends = np.append(fandom_starts[1:], len(fandom_codes))
+    return {
+        unique_fandom_names[fandom_codes[start]]: (int(start), int(end))
+        for start, end in zip(fandom_starts, fandom_ends)
+    }
+
+
+def convert_to_arrow_store(file_location, store_location):
+    """
+    Copies a parquet file with a fandom_name column or index level into an
+        uncompressed Arrow IPC file, with the rows of each fandom contiguous
+        and their offsets stored in the schema metadata
+    :param file_location: Location of the parquet file
+    :type file_location: str
+    :param store_location: Location of the Arrow IPC file
+    :type store_location: str
+    :return: None
+    :rtype: None
+    """
+    # One dictionary per column, as the IPC file format does not allow
+    # replacing dictionaries between batches
+    table = pq.read_table(file_location).unify_dictionaries().combine_chunks()
+    fandom_codes, _ = pd.factorize(table.column('fandom_name').to_pandas())
+    if np.any(np.diff(fandom_codes) < 0):
+        order = np.argsort(fandom_codes, kind='stable')
+        table = table.take(order).combine_chunks()
+    fandom_index = {
+        str(fandom_name): rows
+        for fandom_name, rows in fandom_row_ranges(
+            table.column('fandom_name').to_pandas()
+        ).items()
+    }
+    table = table.replace_schema_metadata(
+        {
+            **(table.schema.metadata or {}),
+            ARROW_STORE_FANDOM_INDEX_KEY: json.dumps(fandom_index),
+        }
+    )
+    os.makedirs(os.path.dirname(store_location) or '.', exist_ok=True)
+    # Written aside and moved into place, as other processes may be mapping
+    # the file already
+    temporary_location = f'{store_location}.{os.getpid()}.tmp'
+    with pa.OSFile(temporary_location, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temporary_location, store_location)
+    return None
+
+
+def is_arrow_store_stale(file_location, store_location):
+    """
+    Whether the parquet file was written after its copy in the Arrow store
+    :param file_location: Location of the parquet file
+    :type file_location: str
+    :param store_location: Location of the Arrow IPC file
+    :type store_location: str
+    :rtype: bool
+    """
+    return (
+        not os.path.exists(store_location)
+        or os.stat(store_location).st_mtime_ns
+        < os.stat(file_location).st_mtime_ns
+    )
+
+
+def build_arrow_store(file_locations, store_directory):
+    """
+    Converts the parquet files whose copy in the Arrow store is missing or
+        older than them
+    :param file_locations: Locations of the parquet files
+    :type file_locations: list
+    :param store_directory: Directory of the Arrow store
+    :type store_directory: str
+    :return: None
+    :rtype: None
+    """
+    for file_location in file_locations:
+        store_location = arrow_store_location(file_location, store_directory)
+        if is_arrow_store_stale(file_location, store_location):
+            convert_to_arrow_store(file_location, store_location)
+    return None
+
+
+class ArrowStoreTable:
+    """
+    Table of the Arrow store, memory mapped rather than read. Slices are views
+        of the mapped file, so the pages are only read when used and are
+        shared through the page cache by all processes mapping the file
+    """
+    def __init__(self, store_location):
+        """
+        :param store_location: Location of the Arrow IPC file
+        :type store_location: str
+        """
+        self.store_location = store_location
+        self.table = pa.ipc.open_file(pa.memory_map(store_location)).read_all()
+        self.fandom_index = json.loads(
+            self.table.schema.metadata[ARROW_STORE_FANDOM_INDEX_KEY]
+        )
+
+    def fandom_rows(self, fandom_name):
+        """
+        Rows of one fandom. Numeric columns without missing values are not
+            copied, so they are read-only
+        :param fandom_name: Name of the fandom
+        :type fandom_name: str
+        :return: Rows of the fandom, with the same index as the saved data.
+            No rows if the fandom has none in the table
+        :rtype: pandas DataFrame
+        """
+        start, end = self.fandom_index.get(fandom_name, (0, 0))
+        return self.table.slice(start, end - start).to_pandas(
+            split_blocks=True
+        )
+
+
+if __name__ == '__main__':
+    # Imported here, as utils imports this module
+    from utils import logger, ARROW_STORE_DIRECTORY, ARROW_STORE_LOCS
+
+    build_arrow_store(ARROW_STORE_LOCS, ARROW_STORE_DIRECTORY)
+    logger.info(f'Arrow store built in {ARROW_STORE_DIRECTORY}')
@@ -0,0 +1,223 @@
+import argparse
+import contextlib
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+from benchmarks.synthetic_dump import generate_synthetic_dump
+from preprocess_data import preprocess_data
+from utils import (
+    logger,
+    DATA_DIRECTORY,
+    PREPROCESS_PROCESSES,
+    WORKS_CSV_CHUNKSIZE,
+    WORKS_TAGS_PARQUET,
+)
+
+BENCHMARK_BASELINES_LOC = 'benchmarks/baselines.json'
+BENCHMARK_MINIMUM_WORK_COUNT = 100
+# A stage regresses if it is this many times slower or bigger than baseline
+BENCHMARK_REGRESSION_TOLERANCE = 1.25
+# ...and by more than this, so tiny stages do not flag on noise
+BENCHMARK_NOISE_FLOOR = {'seconds': 0.1, 'peak_mb': 10}
+
+
+@contextlib.contextmanager
+def _working_directory(directory):
+    previous_directory = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(previous_directory)
+
+
+def benchmark_preprocessing(
+    works_csv_location,
+    tags_csv_location,
+    output_directory,
+    minimum_work_count=BENCHMARK_MINIMUM_WORK_COUNT,
+    chunksize=WORKS_CSV_CHUNKSIZE,
+    processes=PREPROCESS_PROCESSES,
+):
+    """
+    Runs preprocess_data with a run report and reads the time of each stage
+        and how much it grows peak memory from the report. It runs from
+        output_directory, so the outputs are written there rather than over
+        the data of the app
+    With a pool of processes, the stages run in workers are summed over the
+        workers (see RunReport.merge)
+    :param works_csv_location: Location of the works CSV
+    :type works_csv_location: str
+    :param tags_csv_location: Location of the tags CSV
+    :type tags_csv_location: str
+    :param output_directory: Directory to write the outputs to
+    :type output_directory: str
+    :param minimum_work_count: Minimum number of works a fandom must have to be
+        included in analysis
+    :type minimum_work_count: int
+    :param chunksize: Number of works per batch, see preprocess_data
+    :type chunksize: int
+    :param processes: Number of processes, see preprocess_data
+    :type processes: int
+    :return: Stage name to seconds and peak memory growth in MB, and the
+        seconds of the whole run under 'run'
+    :rtype: dict
+    """
+    works_csv_location = os.path.abspath(works_csv_location)
+    tags_csv_location = os.path.abspath(tags_csv_location)
+    report_location = os.path.abspath(
+        os.path.join(output_directory, 'run_report.json')
+    )
+    with _working_directory(output_directory):
+        for directory in [
+            DATA_DIRECTORY, os.path.dirname(WORKS_TAGS_PARQUET)
+        ]:
+            os.makedirs(directory, exist_ok=True)
+        preprocess_data(
+            works_csv_location,
+            tags_csv_location,
+            minimum_work_count,
+            chunksize=chunksize,
+            processes=processes,
+            report_location=report_location,
+        )
+    with open(report_location) as f:
+        report = json.load(f)
+    results = {
+        stage: {
+            'seconds': measurements['wall_seconds'],
+            'peak_mb': measurements['rss_growth_mb'],
+        }
+        for stage, measurements in report['stages'].items()
+    }
+    results['run'] = {'seconds': report['run']['wall_seconds']}
+    for stage, measurements in results.items():
+        logger.info(
+            f'{stage}: {measurements["seconds"]:.2f}s'
+            + (
+                f', +{measurements["peak_mb"]} MB peak'
+                if 'peak_mb' in measurements else ''
+            )
+        )
+    return results
+
+
+def baseline_key(works_num, chunksize, processes):
+    """
+    Key of the baseline of a configuration, as the stages and their times
+        depend on the batches and processes
+    :rtype: str
+    """
+    return f'{works_num}_works_{chunksize}_chunksize_{processes}_processes'
+
+
+def compare_to_baseline(results, baseline):
+    """
+    Compares stage measurements with a baseline
+    :param results: Output of benchmark_preprocessing
+    :type results: dict
+    :param baseline: Baseline measurements in the same format
+    :type baseline: dict
+    :return:
+        - One row per stage and measurement with the ratio to baseline
+        - Whether any stage regressed
+    :rtype:
+        - pandas DataFrame
+        - bool
+    """
+    rows = []
+    for stage, measurements in results.items():
+        for measurement, value in measurements.items():
+            baseline_value = baseline.get(stage, {}).get(measurement)
+            ratio = (
+                value / baseline_value if baseline_value else float('nan')
+            )
+            rows.append(
+                {
+                    'stage': stage,
+                    'measurement': measurement,
+                    'value': value,
+                    'baseline': baseline_value,
+                    'ratio': round(ratio, 2),
+                    'regressed': (
+                        ratio > BENCHMARK_REGRESSION_TOLERANCE
+                        and value - baseline_value
+                        > BENCHMARK_NOISE_FLOOR[measurement]
+                    ),
+                }
+            )
+    comparison = pd.DataFrame(rows)
+    return comparison, bool(comparison['regressed'].any())
+
+
+def load_baselines(baselines_location=BENCHMARK_BASELINES_LOC):
+    if not os.path.exists(baselines_location):
+        return {}
+    with open(baselines_location) as f:
+        return json.load(f)
+
+
+def save_baselines(baselines, baselines_location=BENCHMARK_BASELINES_LOC):
+    with open(baselines_location, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+    logger.info(f'Baselines saved to {baselines_location}')
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark preprocessing stages on a synthetic dump'
+    )
+    parser.add_argument('--works-num', type=int, default=100000)
+    parser.add_argument('--chunksize', type=int, default=WORKS_CSV_CHUNKSIZE)
+    parser.add_argument(
+        '--processes', type=int, default=PREPROCESS_PROCESSES
+    )
+    parser.add_argument(
+        '--dump-directory',
+        help='Where to keep the synthetic dump between runs. It is generated '
+        'if missing. Defaults to a temporary directory',
+    )
+    parser.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help='Store the results as the baseline for this number of works, '
+        'chunksize and number of processes',
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        dump_directory = args.dump_directory or temporary_directory
+        os.makedirs(dump_directory, exist_ok=True)
+        works_csv = os.path.join(dump_directory, f'works_{args.works_num}.csv')
+        tags_csv = os.path.join(dump_directory, f'tags_{args.works_num}.csv')
+        if not (os.path.exists(works_csv) and os.path.exists(tags_csv)):
+            generate_synthetic_dump(args.works_num, works_csv, tags_csv)
+        output_directory = os.path.join(temporary_directory, 'output')
+        os.makedirs(output_directory)
+        benchmark_results = benchmark_preprocessing(
+            works_csv,
+            tags_csv,
+            output_directory,
+            chunksize=args.chunksize,
+            processes=args.processes,
+        )
+    key = baseline_key(args.works_num, args.chunksize, args.processes)
+    baselines = load_baselines()
+    if args.save_baseline:
+        baselines[key] = benchmark_results
+        save_baselines(baselines)
+    elif key in baselines:
+        comparison_df, regressed = compare_to_baseline(
+            benchmark_results, baselines[key]
+        )
+        print(comparison_df.to_string(index=False))
+        if regressed:
+            raise SystemExit('Preprocessing regressed against the baseline')
+    else:
+        print(json.dumps(benchmark_results, indent=2))
+        logger.info(
+            f'No baseline for {key}, run with --save-baseline to store one'
+        )
@@ -0,0 +1,154 @@
+import argparse
+import http.client
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from query_service import (
+    QUERY_SERVICE_FANDOM_ENDPOINTS,
+    QUERY_SERVICE_HOST,
+    QUERY_SERVICE_PORT,
+)
+from utils import logger
+
+LOAD_REQUESTS_NUM = 10000
+LOAD_CONCURRENCY = 8
+# Queries are spread over this many of the most popular fandoms
+LOAD_FANDOMS_NUM = 100
+
+
+def _get(connection, path):
+    connection.request('GET', path)
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def _send_requests(url, paths):
+    """
+    Sends requests one after the other over one keep-alive connection
+    :return: One tuple per request with the endpoint, latency in seconds and
+        status
+    :rtype: list
+    """
+    split_url = urlsplit(url)
+    connection = http.client.HTTPConnection(split_url.hostname, split_url.port)
+    results = []
+    try:
+        for endpoint, path in paths:
+            start = time.perf_counter()
+            status, _ = _get(connection, path)
+            results.append((endpoint, time.perf_counter() - start, status))
+    finally:
+        connection.close()
+    return results
+
+
+def generate_load(
+    url=f'http://{QUERY_SERVICE_HOST}:{QUERY_SERVICE_PORT}',
+    requests_num=LOAD_REQUESTS_NUM,
+    concurrency=LOAD_CONCURRENCY,
+    fandoms_num=LOAD_FANDOMS_NUM,
+    seed=0,
+):
+    """
+    Sends random queries to a running query service from concurrent clients
+    :param url: Address of the query service
+    :type url: str
+    :param requests_num: Number of requests
+    :type requests_num: int
+    :param concurrency: Number of clients sending requests at the same time
+    :type concurrency: int
+    :param fandoms_num: Number of fandoms queried, by number of works
+    :type fandoms_num: int
+    :param seed: Seed of the random queries
+    :type seed: int
+    :return: Requests per second and p50 and p99 latency in milliseconds,
+        overall and per endpoint, and the cache statistics of the service
+    :rtype: dict
+    """
+    split_url = urlsplit(url)
+    connection = http.client.HTTPConnection(split_url.hostname, split_url.port)
+    _, body = _get(connection, f'/fandoms?limit={fandoms_num}')
+    connection.close()
+    fandom_names = [fandom['fandom_name'] for fandom in json.loads(body)]
+    rng = random.Random(seed)
+    paths = []
+    for _ in range(requests_num):
+        endpoint = rng.choice(QUERY_SERVICE_FANDOM_ENDPOINTS)
+        fandom_name = quote(rng.choice(fandom_names), safe='')
+        paths.append((endpoint, f'/fandoms/{fandom_name}/{endpoint}'))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = [
+            result
+            for client_results in executor.map(
+                lambda i: _send_requests(url, paths[i::concurrency]),
+                range(concurrency),
+            )
+            for result in client_results
+        ]
+    seconds = time.perf_counter() - start
+    # Idle during the load, so the service may have closed it
+    connection = http.client.HTTPConnection(split_url.hostname, split_url.port)
+    _, body = _get(connection, '/metrics')
+    connection.close()
+    results_df = pd.DataFrame(
+        results, columns=['endpoint', 'seconds', 'status']
+    )
+    results_df['ms'] = results_df['seconds'] * 1000
+
+    def summarize(df):
+        return {
+            'requests': len(df),
+            'errors': int((df['status'] >= 400).sum()),
+            'p50_ms': round(float(np.percentile(df['ms'], 50)), 3),
+            'p99_ms': round(float(np.percentile(df['ms'], 99)), 3),
+        }
+
+    summary = {
+        **summarize(results_df),
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(len(results_df) / seconds, 1),
+        'endpoints': {
+            endpoint: summarize(df)
+            for endpoint, df in results_df.groupby('endpoint')
+        },
+        'service_cache': json.loads(body)['cache'],
+    }
+    logger.info(
+        f'{summary["requests"]} requests in {summary["seconds"]}s: '
+        f'{summary["requests_per_second"]} requests/s, '
+        f'p50 {summary["p50_ms"]} ms, p99 {summary["p99_ms"]} ms'
+    )
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Send random queries to a running query service'
+    )
+    parser.add_argument(
+        '--url', default=f'http://{QUERY_SERVICE_HOST}:{QUERY_SERVICE_PORT}'
+    )
+    parser.add_argument('--requests', type=int, default=LOAD_REQUESTS_NUM)
+    parser.add_argument('--concurrency', type=int, default=LOAD_CONCURRENCY)
+    parser.add_argument('--fandoms', type=int, default=LOAD_FANDOMS_NUM)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(
+        json.dumps(
+            generate_load(
+                args.url,
+                args.requests,
+                args.concurrency,
+                args.fandoms,
+                args.seed,
+            ),
+            indent=2,
+        )
+    )
@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+from utils import logger
+
+STARTUP_BENCHMARK_REPEATS = 3
+STARTUP_BENCHMARK_TOP_PACKAGES = 15
+REPOSITORY_DIRECTORY = os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))
+)
+IMPORT_TIME_PATTERN = re.compile(
+    r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$'
+)
+# Run in a new interpreter, so nothing is imported or cached beforehand.
+# Streamlit commands run without a server in bare mode, so this measures
+# loading the data and building the charts but not sending them to a browser
+FIRST_RENDER_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.load_analysis(sys.argv[1])()
+rendered = time.perf_counter()
+print(json.dumps({
+    'import_app_seconds': imported - start,
+    'render_seconds': rendered - imported,
+}))
+'''
+
+
+def _run_python(args, app_directory):
+    """
+    Runs the interpreter of this process in app_directory, where the data is,
+        with the repository importable
+    :return: Completed process and its wall time in seconds
+    :rtype: tuple
+    """
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(
+            filter(None, [REPOSITORY_DIRECTORY, os.environ.get('PYTHONPATH')])
+        ),
+    )
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, *args],
+        cwd=app_directory,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    seconds = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(
+            f'{" ".join(args)} failed:\n{completed.stderr[-2000:]}'
+        )
+    return completed, seconds
+
+
+def measure_import_times(module='app', app_directory='.'):
+    """
+    Imports a module in a new interpreter with -X importtime
+    :param module: Module to import
+    :type module: str
+    :param app_directory: Directory to run from
+    :type app_directory: str
+    :return:
+        - One row per imported top-level package with the time spent
+            importing its modules, slowest first
+        - Seconds from starting the interpreter to the end of the import
+    :rtype:
+        - pandas DataFrame
+        - float
+    """
+    completed, seconds = _run_python(
+        ['-X', 'importtime', '-c', f'import {module}'], app_directory
+    )
+    rows = []
+    for line in completed.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append(
+                {
+                    'package': name.split('.')[0],
+                    'module': name,
+                    'depth': len(indent) // 2,
+                    'self_ms': int(self_us) / 1000,
+                    'cumulative_ms': int(cumulative_us) / 1000,
+                }
+            )
+    imports_df = pd.DataFrame(rows)
+    import_times = (
+        imports_df.groupby('package')
+        .agg(modules=('module', 'size'), self_ms=('self_ms', 'sum'))
+        .sort_values('self_ms', ascending=False)
+        .reset_index()
+    )
+    return import_times, seconds
+
+
+def measure_first_render(analysis_type, app_directory='.'):
+    """
+    Starts the app in a new interpreter and renders one analysis
+    :param analysis_type: Key of app.ANALYSIS_TYPES
+    :type analysis_type: str
+    :param app_directory: Directory with the preprocessed data
+    :type app_directory: str
+    :return: Seconds to import app, seconds to render the analysis after
+        that, and seconds from starting the interpreter to the end of the
+        render
+    :rtype: dict
+    """
+    completed, seconds = _run_python(
+        ['-c', FIRST_RENDER_SCRIPT, analysis_type], app_directory
+    )
+    measurements = json.loads(completed.stdout.strip().splitlines()[-1])
+    measurements['total_seconds'] = seconds
+    return measurements
+
+
+def benchmark_startup(
+    app_directory='.',
+    analysis_types=None,
+    repeats=STARTUP_BENCHMARK_REPEATS,
+):
+    """
+    Measures cold starts of the app: import time per package and time to
+        first render of each analysis. Every measurement is taken in a new
+        interpreter and the median of the repeats is reported
+    :param app_directory: Directory with the preprocessed data
+    :type app_directory: str
+    :param analysis_types: Analyses to render. Defaults to all of them
+    :type analysis_types: list
+    :param repeats: Number of times each measurement is taken
+    :type repeats: int
+    :return: Milliseconds per package imported by app (the slowest ones),
+        seconds to import app and seconds to first render per analysis
+    :rtype: dict
+    """
+    from app import ANALYSIS_TYPES
+
+    import_runs = [
+        measure_import_times('app', app_directory) for _ in range(repeats)
+    ]
+    import_times = (
+        pd.concat([import_times for import_times, _ in import_runs])
+        .groupby('package')[['modules', 'self_ms']]
+        .median()
+        .sort_values('self_ms', ascending=False)
+    )
+    results = {
+        'import_app_seconds': statistics.median(
+            seconds for _, seconds in import_runs
+        ),
+        'import_ms_by_package': import_times['self_ms']
+        .head(STARTUP_BENCHMARK_TOP_PACKAGES)
+        .round(1)
+        .to_dict(),
+        'first_render': {},
+    }
+    for analysis_type in analysis_types or list(ANALYSIS_TYPES):
+        render_runs = [
+            measure_first_render(analysis_type, app_directory)
+            for _ in range(repeats)
+        ]
+        results['first_render'][analysis_type] = {
+            measurement: round(
+                statistics.median(run[measurement] for run in render_runs), 3
+            )
+            for measurement in render_runs[0]
+        }
+    logger.info(f'import app: {results["import_app_seconds"]:.2f}s')
+    for analysis_type, measurements in results['first_render'].items():
+        logger.info(
+            f'{analysis_type}: first render after '
+            f'{measurements["total_seconds"]:.2f}s'
+        )
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark cold starts of the app'
+    )
+    parser.add_argument(
+        '--app-directory',
+        default='.',
+        help='Directory with the preprocessed data the app is run from',
+    )
+    parser.add_argument(
+        '--analysis',
+        action='append',
+        dest='analysis_types',
+        help='Analysis to render, can be repeated. Defaults to all of them',
+    )
+    parser.add_argument(
+        '--repeats', type=int, default=STARTUP_BENCHMARK_REPEATS
+    )
+    args = parser.parse_args()
+    print(
+        json.dumps(
+            benchmark_startup(
+                args.app_directory, args.analysis_types, args.repeats
+            ),
+            indent=2,
+        )
+    )
@@ -0,0 +1,253 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils import logger
+
+# Share of tags of each type, roughly as in the 2021 dump
+SYNTHETIC_TAG_TYPE_SHARES = {
+    'Freeform': 0.45,
+    'Character': 0.25,
+    'Relationship': 0.2,
+    'Fandom': 0.08,
+    'Rating': 0.0005,
+    'ArchiveWarnings': 0.0005,
+    'Category': 0.0005,
+    'UnsortedTag': 0.0185,
+}
+SYNTHETIC_TAGS_PER_WORK = 12
+SYNTHETIC_FANDOMS_PER_WORK = 1.3
+SYNTHETIC_ZIPF_EXPONENT = 1.1
+SYNTHETIC_MERGED_SHARE = 0.3
+SYNTHETIC_REDACTED_SHARE = 0.02
+SYNTHETIC_NO_WORD_COUNT_SHARE = 0.005
+SYNTHETIC_CHARACTERS_PER_FANDOM = 40
+SYNTHETIC_DATE_RANGE = ('2008-09-13', '2021-02-26')
+SYNTHETIC_CHUNKSIZE = 200000
+
+
+def generate_synthetic_dump(
+    works_num,
+    works_csv_location,
+    tags_csv_location,
+    tags_num=None,
+    seed=0,
+):
+    """
+    Writes works and tags CSVs with the schema of the AO3 data dump, so
+        preprocessing can be run and benchmarked without the real data
+    Tag and fandom popularity follow a Zipf-like distribution, a share of
+        tags are merged into other tags (including chains of mergers) and a
+        share are redacted
+    :param works_num: Number of works to generate
+    :type works_num: int
+    :param works_csv_location: Location to write the works CSV to
+    :type works_csv_location: str
+    :param tags_csv_location: Location to write the tags CSV to
+    :type tags_csv_location: str
+    :param tags_num: Number of tags to generate. Defaults to one tag per
+        five works (at least 1000)
+    :type tags_num: int
+    :param seed: Random seed
+    :type seed: int
+    :return: None
+    :rtype: None
+    """
+    rng = np.random.default_rng(seed)
+    tags_num = tags_num or max(works_num // 5, 1000)
+    logger.info(f'Generating {tags_num} synthetic tags')
+    tags_df = generate_synthetic_tags(tags_num, rng)
+    tags_df.to_csv(tags_csv_location, index=False)
+    logger.info(f'Data saved to {tags_csv_location}')
+    logger.info(f'Generating {works_num} synthetic works')
+    for start in range(0, works_num, SYNTHETIC_CHUNKSIZE):
+        works_df = generate_synthetic_works(
+            min(SYNTHETIC_CHUNKSIZE, works_num - start), tags_df, rng
+        )
+        works_df.to_csv(
+            works_csv_location,
+            index=False,
+            mode='w' if start == 0 else 'a',
+            header=start == 0,
+        )
+    logger.info(f'Data saved to {works_csv_location}')
+    return None
+
+
+def generate_synthetic_tags(tags_num, rng):
+    """
+    Generates a tags table with the columns of the dump's tags CSV
+    :param tags_num: Number of tags
+    :type tags_num: int
+    :param rng: Random number generator
+    :type rng: numpy Generator
+    :return: One row per tag
+    :rtype: pandas DataFrame
+    """
+    tag_types = np.array(list(SYNTHETIC_TAG_TYPE_SHARES))
+    shares = np.array(list(SYNTHETIC_TAG_TYPE_SHARES.values()))
+    types = rng.choice(tag_types, tags_num, p=shares / shares.sum())
+    # Make sure every type exists even for small dumps
+    types[:len(tag_types)] = tag_types
+    ids = np.arange(1, tags_num + 1)
+    names = pd.Series(types).str.cat(ids.astype(str), sep=' ').to_numpy()
+    is_fandom = types == 'Fandom'
+    fandom_names = names[is_fandom]
+    is_relationship = np.flatnonzero(types == 'Relationship')
+    relationship_fandoms = fandom_names[
+        zipf_choice(len(fandom_names), len(is_relationship), rng)
+    ]
+    names[is_relationship] = [
+        generate_synthetic_relationship_name(fandom_name, rng)
+        for fandom_name in relationship_fandoms
+    ]
+    names[rng.random(tags_num) < SYNTHETIC_REDACTED_SHARE] = 'Redacted'
+    # Merge a share of tags into an earlier tag of the same type, which may
+    # itself be merged, giving chains of mergers
+    merger_id = np.full(tags_num, np.nan)
+    for tag_type in tag_types:
+        type_rows = np.flatnonzero(types == tag_type)
+        merged = type_rows[1:][
+            rng.random(len(type_rows) - 1) < SYNTHETIC_MERGED_SHARE
+        ]
+        if not len(merged):
+            continue
+        earlier = rng.integers(0, np.searchsorted(type_rows, merged))
+        merger_id[merged] = ids[type_rows[earlier]]
+    return pd.DataFrame(
+        {
+            'id': ids,
+            'type': types,
+            'name': names,
+            'canonical': np.isnan(merger_id) & (names != 'Redacted'),
+            'cached_count': rng.zipf(2.0, tags_num),
+            'merger_id': merger_id,
+        }
+    )
+
+
+def generate_synthetic_relationship_name(fandom_name, rng):
+    """
+    Generates a relationship name such as 'A (F)/B (F)' or 'A (F) & B (F)',
+        occasionally with more than two characters
+    :param fandom_name: Name of the fandom the characters are from
+    :type fandom_name: str
+    :param rng: Random number generator
+    :type rng: numpy Generator
+    :return: Relationship name
+    :rtype: str
+    """
+    characters_num = 2 + rng.binomial(3, 0.05)
+    characters = rng.choice(
+        SYNTHETIC_CHARACTERS_PER_FANDOM, characters_num, replace=False
+    )
+    separator = '/' if rng.random() < 0.7 else ' & '
+    return separator.join(
+        f'Character {c} ({fandom_name})' for c in characters
+    )
+
+
+def generate_synthetic_works(works_num, tags_df, rng):
+    """
+    Generates works with the columns of the dump's works CSV
+    :param works_num: Number of works
+    :type works_num: int
+    :param tags_df: Tags table from generate_synthetic_tags
+    :type tags_df: pandas DataFrame
+    :param rng: Random number generator
+    :type rng: numpy Generator
+    :return: One row per work
+    :rtype: pandas DataFrame
+    """
+    tag_ids = tags_df['id'].to_numpy()
+    tag_types = tags_df['type'].to_numpy()
+    fandom_ids = tag_ids[tag_types == 'Fandom']
+    other_ids = tag_ids[tag_types != 'Fandom']
+    # Every work has a rating and a warning
+    ratings = rng.choice(tag_ids[tag_types == 'Rating'], works_num)
+    warnings = rng.choice(tag_ids[tag_types == 'ArchiveWarnings'], works_num)
+    fandoms_num = 1 + rng.poisson(SYNTHETIC_FANDOMS_PER_WORK - 1, works_num)
+    others_num = rng.poisson(SYNTHETIC_TAGS_PER_WORK, works_num)
+    fandoms = fandom_ids[
+        zipf_choice(len(fandom_ids), fandoms_num.sum(), rng)
+    ]
+    others = other_ids[zipf_choice(len(other_ids), others_num.sum(), rng)]
+    fandom_offsets = np.concatenate([[0], np.cumsum(fandoms_num)])
+    other_offsets = np.concatenate([[0], np.cumsum(others_num)])
+    fandoms = fandoms.astype(str)
+    others = others.astype(str)
+    ratings = ratings.astype(str)
+    warnings = warnings.astype(str)
+    tags = [
+        '+'.join(
+            [
+                ratings[i],
+                warnings[i],
+                *fandoms[fandom_offsets[i]:fandom_offsets[i + 1]],
+                *others[other_offsets[i]:other_offsets[i + 1]],
+            ]
+        )
+        for i in range(works_num)
+    ]
+    date_start, date_end = (
+        pd.Timestamp(date) for date in SYNTHETIC_DATE_RANGE
+    )
+    # More recent works are more common
+    days = (
+        (date_end - date_start).days
+        * np.sqrt(rng.random(works_num))
+    ).astype(int)
+    creation_dates = date_start + pd.to_timedelta(days, unit='D')
+    word_count = np.round(rng.lognormal(8.3, 1.3, works_num))
+    word_count[rng.random(works_num) < SYNTHETIC_NO_WORD_COUNT_SHARE] = np.nan
+    return pd.DataFrame(
+        {
+            'creation date': creation_dates.strftime('%Y-%m-%d'),
+            'language': rng.choice(['en', 'zh', 'es', 'ru'], works_num,
+                                   p=[0.9, 0.04, 0.03, 0.03]),
+            'restricted': rng.random(works_num) < 0.2,
+            'complete': rng.random(works_num) < 0.7,
+            'word_count': word_count,
+            'tags': tags,
+            'Unnamed: 6': np.nan,
+        }
+    )
+
+
+def zipf_choice(n, size, rng, exponent=SYNTHETIC_ZIPF_EXPONENT):
+    """
+    Draws positions in range(n) with probability proportional to
+        1 / (position + 1) ** exponent
+    :param n: Number of positions
+    :type n: int
+    :param size: Number of draws
+    :type size: int
+    :param rng: Random number generator
+    :type rng: numpy Generator
+    :param exponent: Zipf exponent
+    :type exponent: float
+    :return: Drawn positions
+    :rtype: numpy array
+    """
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    cdf = np.cumsum(weights)
+    return np.searchsorted(cdf, rng.random(size) * cdf[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic AO3 data dump'
+    )
+    parser.add_argument('works_num', type=int)
+    parser.add_argument('output_directory')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    os.makedirs(args.output_directory, exist_ok=True)
+    generate_synthetic_dump(
+        args.works_num,
+        os.path.join(args.output_directory, 'works.csv'),
+        os.path.join(args.output_directory, 'tags.csv'),
+        seed=args.seed,
+    )
@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import random
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils import (
+    logger,
+    retrieve_fandom_rows,
+    FANDOM_WORKS_COUNT_LOC,
+    MONTHLY_WORK_SKETCHES_LOC,
+    WORK_SKETCHES_LOC,
+    WORKS_WITH_FANDOM_LOC,
+)
+from work_sketches import (
+    WORK_SKETCH_PRECISION,
+    ExactWorkCounter,
+    WorkSketchIndex,
+)
+
+VALIDATION_FANDOMS_NUM = 20
+VALIDATION_QUERIES_NUM = 100
+
+
+def _relative_errors(estimates, exact):
+    estimates, exact = np.asarray(estimates), np.asarray(exact)
+    return np.abs(estimates - exact) / np.maximum(exact, 1)
+
+
+def _summarize_errors(errors):
+    return {
+        'p50': round(float(np.percentile(errors, 50)), 4),
+        'p99': round(float(np.percentile(errors, 99)), 4),
+        'max': round(float(np.max(errors)), 4),
+    }
+
+
+def validate_work_sketches(
+    fandoms_num=VALIDATION_FANDOMS_NUM,
+    queries_num=VALIDATION_QUERIES_NUM,
+    seed=0,
+):
+    """
+    Compares the estimates of the work sketches with exact counts from the
+        work ids, over the fandoms with most works: the count of each fandom
+        and the union and intersection of random pairs and triples of them,
+        over all time and, with monthly sketches, random date ranges
+    :param fandoms_num: Number of fandoms queried, by number of works
+    :type fandoms_num: int
+    :param queries_num: Number of random queries of each kind
+    :type queries_num: int
+    :param seed: Seed of the random queries
+    :type seed: int
+    :return: Relative errors (p50, p99 and max) of each kind of query, with
+        the expected relative standard error of the sketches, and the mean
+        microseconds per query (a union and, for several fandoms, an
+        intersection) from the sketches and exactly. Intersection errors
+        are relative to the union, as an intersection is a difference of
+        unions and inherits their error
+    :rtype: dict
+    """
+    fandom_names = (
+        pd.read_parquet(FANDOM_WORKS_COUNT_LOC)['works_num']
+        .nlargest(fandoms_num)
+        .index.astype(str)
+        .tolist()
+    )
+    monthly_work_sketches = (
+        pd.read_parquet(MONTHLY_WORK_SKETCHES_LOC)
+        if os.path.exists(MONTHLY_WORK_SKETCHES_LOC) else None
+    )
+    index = WorkSketchIndex(
+        pd.read_parquet(WORK_SKETCHES_LOC), monthly_work_sketches
+    )
+    works = {
+        fandom_name: retrieve_fandom_rows(
+            WORKS_WITH_FANDOM_LOC, fandom_name
+        ).droplevel('fandom_name')
+        for fandom_name in fandom_names
+    }
+    exact = ExactWorkCounter(works.get)
+    rng = random.Random(seed)
+    queries = {
+        'count': [[fandom_name] for fandom_name in fandom_names],
+        'pair': [rng.sample(fandom_names, 2) for _ in range(queries_num)],
+        'triple': [rng.sample(fandom_names, 3) for _ in range(queries_num)],
+    }
+    windows = [(None, None)]
+    if monthly_work_sketches is not None:
+        months = np.unique(index.months)
+        for _ in range(queries_num):
+            first, last = sorted(rng.sample(range(len(months) + 1), 2))
+            windows.append(
+                (
+                    months[first],
+                    months[last] if last < len(months) else None,
+                )
+            )
+    results = {
+        'expected_relative_error': round(
+            1.04 / np.sqrt(2 ** WORK_SKETCH_PRECISION), 4
+        ),
+    }
+    estimate_seconds, exact_seconds = [], []
+    for kind, kind_queries in queries.items():
+        for windowed in [False, True] if len(windows) > 1 else [False]:
+            unions, exact_unions = [], []
+            intersections, exact_intersections = [], []
+            for i, query in enumerate(kind_queries):
+                start, end = (
+                    windows[1 + i % (len(windows) - 1)] if windowed
+                    else windows[0]
+                )
+                begin = time.perf_counter()
+                unions.append(index.union_count(query, start, end))
+                if len(query) > 1:
+                    intersections.append(
+                        index.intersection_count(query, start, end)
+                    )
+                estimate_seconds.append(time.perf_counter() - begin)
+                begin = time.perf_counter()
+                exact_unions.append(exact.union_count(query, start, end))
+                if len(query) > 1:
+                    exact_intersections.append(
+                        exact.intersection_count(query, start, end)
+                    )
+                exact_seconds.append(time.perf_counter() - begin)
+            name = f'{kind}_in_date_range' if windowed else kind
+            results[name] = {
+                'union': _summarize_errors(
+                    _relative_errors(unions, exact_unions)
+                ),
+            }
+            if intersections:
+                results[name]['intersection'] = _summarize_errors(
+                    np.abs(
+                        np.asarray(intersections)
+                        - np.asarray(exact_intersections)
+                    ) / np.maximum(exact_unions, 1)
+                )
+    results['estimate_us'] = round(float(np.mean(estimate_seconds)) * 1e6, 1)
+    # Includes slicing the works of the fandoms, which are already in memory
+    results['exact_us'] = round(float(np.mean(exact_seconds)) * 1e6, 1)
+    logger.info(
+        f'Fandom count p99 relative error {results["count"]["union"]["p99"]} '
+        f'(expected {results["expected_relative_error"]}), '
+        f'{results["estimate_us"]} us per query from the sketches, '
+        f'{results["exact_us"]} us exactly'
+    )
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Validate the work sketches against exact counts'
+    )
+    parser.add_argument(
+        '--fandoms', type=int, default=VALIDATION_FANDOMS_NUM
+    )
+    parser.add_argument(
+        '--queries', type=int, default=VALIDATION_QUERIES_NUM
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(
+        json.dumps(
+            validate_work_sketches(args.fandoms, args.queries, args.seed),
+            indent=2,
+        )
+    )
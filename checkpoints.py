@@ -0,0 +1,206 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import pandas as pd
+
+from utils import logger, CHECKPOINT_DIRECTORY
+
+# Bump when the output of a stage changes, so older checkpoints are not reused
+CHECKPOINT_FORMAT_VERSION = 2
+FINGERPRINT_BLOCK_SIZE = 16 * 2 ** 20
+CHECKPOINT_META_FILE = 'meta.json'
+
+
+def fingerprint_file(file_location):
+    """
+    Hashes the content of a file
+    :param file_location: Location of the file
+    :type file_location: str
+    :return: Hex digest of the content
+    :rtype: str
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_location, 'rb') as f:
+        for block in iter(lambda: f.read(FINGERPRINT_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def stage_key(*parts):
+    """
+    Key of a stage output, from everything the output depends on: input
+        fingerprints, upstream stage keys and parameters
+    :param parts: JSON-serializable inputs and parameters of the stage
+    :return: Hex digest
+    :rtype: str
+    """
+    payload = json.dumps(
+        [CHECKPOINT_FORMAT_VERSION, *parts], sort_keys=True, default=str
+    )
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+def load_or_compute(stage, key, compute, checkpoint_directory=None):
+    """
+    Loads the output of a stage from its checkpoint if there is one for key,
+        otherwise computes it and saves the checkpoint
+    :param stage: Name of the stage
+    :type stage: str
+    :param key: Key of the output, from stage_key
+    :type key: str
+    :param compute: Function without arguments returning a DataFrame or a
+        tuple of DataFrames
+    :type compute: function
+    :param checkpoint_directory: Directory of the checkpoints. If None,
+        checkpoints are not used
+    :type checkpoint_directory: str
+    :return: Output of compute
+    :rtype: pandas DataFrame or tuple
+    """
+    if checkpoint_directory is None:
+        return compute()
+    location = os.path.join(checkpoint_directory, stage, key)
+    if os.path.exists(os.path.join(location, CHECKPOINT_META_FILE)):
+        logger.info(f'Loading {stage} from checkpoint {key}')
+        return read_checkpoint(location)
+    output = compute()
+    write_checkpoint(output, location)
+    logger.info(f'Saved {stage} to checkpoint {key}')
+    return output
+
+
+def write_checkpoint(output, location):
+    """
+    Writes a stage output to a temporary directory and then moves it into
+        place, so a run that dies mid-write does not leave a partial
+        checkpoint behind
+    :param output: DataFrame or tuple of DataFrames
+    :param location: Directory of the checkpoint
+    :type location: str
+    :return: None
+    :rtype: None
+    """
+    is_tuple = isinstance(output, tuple)
+    dfs = output if is_tuple else (output,)
+    temporary_location = f'{location}.tmp'
+    shutil.rmtree(temporary_location, ignore_errors=True)
+    os.makedirs(temporary_location)
+    for i, df in enumerate(dfs):
+        df.to_parquet(os.path.join(temporary_location, f'{i}.parquet'))
+    with open(
+        os.path.join(temporary_location, CHECKPOINT_META_FILE), 'w'
+    ) as f:
+        json.dump({'outputs_num': len(dfs), 'is_tuple': is_tuple}, f)
+    shutil.rmtree(location, ignore_errors=True)
+    os.replace(temporary_location, location)
+    return None
+
+
+def read_checkpoint(location):
+    with open(os.path.join(location, CHECKPOINT_META_FILE)) as f:
+        meta = json.load(f)
+    dfs = tuple(
+        pd.read_parquet(os.path.join(location, f'{i}.parquet'))
+        for i in range(meta['outputs_num'])
+    )
+    return dfs if meta['is_tuple'] else dfs[0]
+
+
+def list_checkpoints(checkpoint_directory=CHECKPOINT_DIRECTORY):
+    """
+    Lists saved checkpoints
+    :param checkpoint_directory: Directory of the checkpoints
+    :type checkpoint_directory: str
+    :return: One row per checkpoint with its stage, key, size and when it was
+        last written
+    :rtype: pandas DataFrame
+    """
+    rows = []
+    if os.path.isdir(checkpoint_directory):
+        for stage in sorted(os.listdir(checkpoint_directory)):
+            stage_directory = os.path.join(checkpoint_directory, stage)
+            for key in sorted(os.listdir(stage_directory)):
+                location = os.path.join(stage_directory, key)
+                if not os.path.exists(
+                    os.path.join(location, CHECKPOINT_META_FILE)
+                ):
+                    continue
+                files = [
+                    os.path.join(location, f) for f in os.listdir(location)
+                ]
+                rows.append(
+                    {
+                        'stage': stage,
+                        'key': key,
+                        'size_mb': round(
+                            sum(os.path.getsize(f) for f in files) / 2 ** 20,
+                            1,
+                        ),
+                        'modified': pd.Timestamp(
+                            max(os.path.getmtime(f) for f in files), unit='s'
+                        ),
+                    }
+                )
+    return pd.DataFrame(
+        rows, columns=['stage', 'key', 'size_mb', 'modified']
+    )
+
+
+def evict_checkpoints(
+    checkpoint_directory=CHECKPOINT_DIRECTORY,
+    stage=None,
+    key=None,
+    older_than_days=None,
+):
+    """
+    Deletes checkpoints matching all of the given filters
+    :param checkpoint_directory: Directory of the checkpoints
+    :type checkpoint_directory: str
+    :param stage: Only evict checkpoints of this stage
+    :type stage: str
+    :param key: Only evict the checkpoint with this key
+    :type key: str
+    :param older_than_days: Only evict checkpoints last written more than this
+        many days ago
+    :type older_than_days: float
+    :return: Evicted checkpoints
+    :rtype: pandas DataFrame
+    """
+    checkpoints_df = list_checkpoints(checkpoint_directory)
+    if stage is not None:
+        checkpoints_df = checkpoints_df.loc[checkpoints_df['stage'] == stage]
+    if key is not None:
+        checkpoints_df = checkpoints_df.loc[checkpoints_df['key'] == key]
+    if older_than_days is not None:
+        cutoff = pd.Timestamp(time.time(), unit='s') - pd.Timedelta(
+            days=older_than_days
+        )
+        checkpoints_df = checkpoints_df.loc[
+            checkpoints_df['modified'] < cutoff
+        ]
+    for row in checkpoints_df.itertuples():
+        shutil.rmtree(os.path.join(checkpoint_directory, row.stage, row.key))
+        logger.info(f'Evicted {row.stage} checkpoint {row.key}')
+    return checkpoints_df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='List or evict preprocessing checkpoints'
+    )
+    parser.add_argument('action', choices=['list', 'evict'])
+    parser.add_argument('--directory', default=CHECKPOINT_DIRECTORY)
+    parser.add_argument('--stage')
+    parser.add_argument('--key')
+    parser.add_argument('--older-than-days', type=float)
+    args = parser.parse_args()
+    if args.action == 'list':
+        print(list_checkpoints(args.directory).to_string(index=False))
+    else:
+        evict_checkpoints(
+            args.directory, args.stage, args.key, args.older_than_days
+        )
@@ -0,0 +1,250 @@
+import argparse
+import io
+import multiprocessing
+import os
+import shutil
+
+import pandas as pd
+
+from checkpoints import stage_key
+from fandom import (
+    CHORD_CHART_SAVEFIG_CONFIG,
+    Fandom,
+    apply_matplotlib_style,
+)
+from utils import (
+    logger,
+    CHARACTER_PAIRS_LOC,
+    CHARACTERS_LOC,
+    FANDOM_WORKS_COUNT_LOC,
+    CHORD_CHART_CACHE_DIRECTORY,
+)
+
+# Bump when the look of the chart changes, so cached charts are redrawn
+CHORD_CHART_STYLE = 'ggplot-gradient-v1'
+CHORD_CHART_RELATIONSHIP_TYPES = ['romantic', 'platonic']
+CHORD_CHART_TOP_N = 50
+
+
+def chord_chart_data_version():
+    """
+    Version of the data the chord charts are drawn from, which changes
+        whenever preprocessing rewrites it
+    :return: Hex digest of the size and modification time of the data files
+    :rtype: str
+    """
+    return stage_key(
+        *[
+            (os.path.getsize(loc), os.stat(loc).st_mtime_ns)
+            for loc in [CHARACTER_PAIRS_LOC, CHARACTERS_LOC]
+        ]
+    )
+
+
+def chord_chart_location(
+    fandom_name,
+    relationship_type,
+    top_n=CHORD_CHART_TOP_N,
+    image_format='png',
+    cache_directory=CHORD_CHART_CACHE_DIRECTORY,
+    data_version=None,
+):
+    """
+    Location of a rendered chord chart in the cache. Charts of other versions
+        of the data are in other directories, so they are never served
+    :param fandom_name: Name of the fandom
+    :type fandom_name: str
+    :param relationship_type: 'romantic' or 'platonic'
+    :type relationship_type: str
+    :param top_n: Number of character pairs in the chart
+    :type top_n: int
+    :param image_format: 'png' or 'svg'
+    :type image_format: str
+    :param cache_directory: Directory of the cache
+    :type cache_directory: str
+    :param data_version: Output of chord_chart_data_version, computed if None
+    :type data_version: str
+    :return: Location of the image
+    :rtype: str
+    """
+    chart_key = stage_key(
+        fandom_name, relationship_type, top_n, image_format, CHORD_CHART_STYLE
+    )
+    return os.path.join(
+        cache_directory,
+        data_version or chord_chart_data_version(),
+        f'{chart_key}.{image_format}',
+    )
+
+
+def render_chord_chart(
+    fandom, relationship_type, top_n=CHORD_CHART_TOP_N, image_format='png'
+):
+    """
+    Renders the relationship chord chart of a fandom
+    :param fandom: Fandom to draw
+    :type fandom: Fandom
+    :param relationship_type: 'romantic' or 'platonic'
+    :type relationship_type: str
+    :param top_n: Number of character pairs in the chart
+    :type top_n: int
+    :param image_format: 'png' or 'svg'
+    :type image_format: str
+    :return: Image
+    :rtype: bytes
+    """
+    from matplotlib.figure import Figure
+
+    apply_matplotlib_style()
+    # Not a pyplot figure, so sessions can render at the same time
+    fig = Figure()
+    ax = fig.subplots()
+    fandom.generate_relationship_chord_chart(
+        relationship_type=relationship_type, top_n=top_n, ax=ax
+    )
+    image = io.BytesIO()
+    fig.savefig(image, format=image_format, **CHORD_CHART_SAVEFIG_CONFIG)
+    return image.getvalue()
+
+
+def retrieve_chord_chart(
+    fandom,
+    relationship_type,
+    top_n=CHORD_CHART_TOP_N,
+    image_format='png',
+    cache_directory=CHORD_CHART_CACHE_DIRECTORY,
+    data_version=None,
+):
+    """
+    Returns the rendered chord chart from the cache, rendering and caching it
+        if it is not there
+    :param fandom: Fandom to draw
+    :type fandom: Fandom
+    :param relationship_type: 'romantic' or 'platonic'
+    :type relationship_type: str
+    :param top_n: Number of character pairs in the chart
+    :type top_n: int
+    :param image_format: 'png' or 'svg'
+    :type image_format: str
+    :param cache_directory: Directory of the cache
+    :type cache_directory: str
+    :param data_version: Output of chord_chart_data_version, computed if None
+    :type data_version: str
+    :return: Image
+    :rtype: bytes
+    """
+    location = chord_chart_location(
+        fandom.name,
+        relationship_type,
+        top_n,
+        image_format,
+        cache_directory,
+        data_version,
+    )
+    if os.path.exists(location):
+        with open(location, 'rb') as f:
+            return f.read()
+    image = render_chord_chart(fandom, relationship_type, top_n, image_format)
+    os.makedirs(os.path.dirname(location), exist_ok=True)
+    # Written aside and moved into place, so readers never see a partial image
+    temporary_location = f'{location}.{os.getpid()}.tmp'
+    with open(temporary_location, 'wb') as f:
+        f.write(image)
+    os.replace(temporary_location, location)
+    return image
+
+
+def pre_render_chord_charts(
+    fandoms_num,
+    processes=None,
+    top_n=CHORD_CHART_TOP_N,
+    image_format='png',
+    cache_directory=CHORD_CHART_CACHE_DIRECTORY,
+    prune=False,
+):
+    """
+    Renders the chord charts of the most popular fandoms into the cache with
+        a pool of processes
+    :param fandoms_num: Number of fandoms, by number of works
+    :type fandoms_num: int
+    :param processes: Number of processes. Defaults to the number of CPUs
+    :type processes: int
+    :param top_n: Number of character pairs in the charts
+    :type top_n: int
+    :param image_format: 'png' or 'svg'
+    :type image_format: str
+    :param cache_directory: Directory of the cache
+    :type cache_directory: str
+    :param prune: Whether to delete charts of other versions of the data
+    :type prune: bool
+    :return: None
+    :rtype: None
+    """
+    data_version = chord_chart_data_version()
+    fandom_names = (
+        pd.read_parquet(FANDOM_WORKS_COUNT_LOC)['works_num']
+        .nlargest(fandoms_num)
+        .index.astype(str)
+    )
+    logger.info(f'Pre-rendering chord charts of {len(fandom_names)} fandoms')
+    tasks = [
+        (
+            fandom_name,
+            top_n,
+            image_format,
+            cache_directory,
+            data_version,
+        )
+        for fandom_name in fandom_names
+    ]
+    with multiprocessing.Pool(processes) as pool:
+        for i, fandom_name in enumerate(
+            pool.imap_unordered(_pre_render_fandom_chord_charts, tasks)
+        ):
+            logger.info(
+                f'Rendered {fandom_name} ({i + 1}/{len(fandom_names)})'
+            )
+    if prune and os.path.isdir(cache_directory):
+        for version in os.listdir(cache_directory):
+            if version != data_version:
+                shutil.rmtree(os.path.join(cache_directory, version))
+                logger.info(f'Pruned chord charts of data version {version}')
+    return None
+
+
+def _pre_render_fandom_chord_charts(task):
+    fandom_name, top_n, image_format, cache_directory, data_version = task
+    fandom = Fandom(fandom_name)
+    for relationship_type in CHORD_CHART_RELATIONSHIP_TYPES:
+        retrieve_chord_chart(
+            fandom,
+            relationship_type,
+            top_n,
+            image_format,
+            cache_directory,
+            data_version,
+        )
+    return fandom_name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Pre-render the chord charts of the most popular fandoms'
+    )
+    parser.add_argument('fandoms_num', type=int)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--top-n', type=int, default=CHORD_CHART_TOP_N)
+    parser.add_argument('--format', choices=['png', 'svg'], default='png')
+    parser.add_argument(
+        '--prune',
+        action='store_true',
+        help='Delete charts of other versions of the data',
+    )
+    args = parser.parse_args()
+    pre_render_chord_charts(
+        args.fandoms_num,
+        args.processes,
+        args.top_n,
+        args.format,
+        prune=args.prune,
+    )
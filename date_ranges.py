@@ -0,0 +1,171 @@
+import numpy as np
+import pandas as pd
+
+from relationships import build_top_relationships
+
+# Relationships of each fandom counted per month, by works over all time. The
+# top relationships of a date range are ranked among these
+DATE_RANGE_RELATIONSHIPS_K = 100
+DATE_RANGE_COLUMNS = ['works_num', 'word_count_sum', 'word_count_n']
+
+
+def build_monthly_relationships(
+    relationships_by_month,
+    non_fandom_tags_agg,
+    fandom_works_count,
+    k=DATE_RANGE_RELATIONSHIPS_K,
+):
+    """
+    Works created per month with each of the k most popular relationships of
+        every fandom
+    :param relationships_by_month: One row per fandom per relationship per
+        month with count of works, output of aggregate_works_tags_df
+    :type relationships_by_month: pandas DataFrame
+    :param non_fandom_tags_agg: One row per fandom per non-fandom tag with
+        count of works, output of aggregate_works_tags_df
+    :type non_fandom_tags_agg: pandas DataFrame
+    :param fandom_works_count: One row per fandom with count of works
+    :type fandom_works_count: pandas DataFrame
+    :param k: Number of relationships per fandom
+    :type k: int
+    :return: One row per fandom per month per top relationship with works
+        that month, indexed by fandom and month and sorted. Months without
+        works are left out
+    :rtype: pandas DataFrame
+    """
+    top = build_top_relationships(
+        non_fandom_tags_agg, fandom_works_count, k
+    )[['fandom_name', 'name_final']]
+    monthly_relationships = relationships_by_month.astype(
+        {'fandom_name': str, 'name_final': str}
+    ).merge(top, on=['fandom_name', 'name_final'], how='inner')
+    return (
+        monthly_relationships.set_index(['fandom_name', 'creation_month'])
+        .sort_index(kind='stable')[['name_final', 'works_num']]
+    )
+
+
+class FandomTimeline:
+    """
+    Prefix sums over the months of one fandom, so the works, word counts and
+        relationship counts of any range of months are the difference of two
+        prefix sums, with the range found by binary search over the months
+        rather than by filtering works
+    """
+    def __init__(self, monthly_works, monthly_relationships):
+        """
+        :param monthly_works: Months of the fandom from build_monthly_works,
+            indexed by month
+        :type monthly_works: pandas DataFrame
+        :param monthly_relationships: Rows of the fandom from
+            build_monthly_relationships, indexed by month
+        :type monthly_relationships: pandas DataFrame
+        """
+        self.months = monthly_works.index.to_numpy(dtype='datetime64[ns]')
+        # Row i holds the sums of the months before month i
+        self.cumulative_works = np.zeros(
+            (len(self.months) + 1, len(DATE_RANGE_COLUMNS)), dtype=np.int64
+        )
+        np.cumsum(
+            monthly_works[DATE_RANGE_COLUMNS].to_numpy(np.int64),
+            axis=0,
+            out=self.cumulative_works[1:],
+        )
+        relationship_codes, relationship_names = pd.factorize(
+            monthly_relationships['name_final'].astype(str)
+        )
+        self.relationship_names = np.asarray(relationship_names)
+        self.cumulative_relationships = np.zeros(
+            (len(self.months) + 1, len(self.relationship_names)),
+            dtype=np.int64,
+        )
+        np.add.at(
+            self.cumulative_relationships,
+            (
+                np.searchsorted(
+                    self.months,
+                    monthly_relationships.index.to_numpy(
+                        dtype='datetime64[ns]'
+                    ),
+                ) + 1,
+                relationship_codes,
+            ),
+            monthly_relationships['works_num'].to_numpy(np.int64),
+        )
+        np.cumsum(
+            self.cumulative_relationships,
+            axis=0,
+            out=self.cumulative_relationships,
+        )
+
+    @property
+    def nbytes(self):
+        return (
+            self.months.nbytes
+            + self.cumulative_works.nbytes
+            + self.cumulative_relationships.nbytes
+        )
+
+    def month_positions(self, start=None, end=None):
+        """
+        Months from start (included) to end (excluded), i.e. whole months
+            starting in [start, end)
+        :param start: First date, or None for the first month
+        :type start: str, datetime or pandas Timestamp
+        :param end: Date after the last, or None for after the last month
+        :type end: str, datetime or pandas Timestamp
+        :return: Position of the first month and after the last month
+        :rtype: tuple
+        """
+        first, last = 0, len(self.months)
+        if start is not None:
+            first = int(
+                np.searchsorted(self.months, pd.Timestamp(start).asm8)
+            )
+        if end is not None:
+            last = int(np.searchsorted(self.months, pd.Timestamp(end).asm8))
+        return first, max(first, last)
+
+    def summary(self, start=None, end=None):
+        """
+        :param start: See month_positions
+        :param end: See month_positions
+        :return: Number of works created from start to end and their mean
+            word count (NaN without word counts)
+        :rtype: dict
+        """
+        first, last = self.month_positions(start, end)
+        works_num, word_count_sum, word_count_n = (
+            self.cumulative_works[last] - self.cumulative_works[first]
+        )
+        return {
+            'works_num': int(works_num),
+            'word_count_mean': (
+                word_count_sum / word_count_n if word_count_n else np.nan
+            ),
+        }
+
+    def top_relationships(self, start=None, end=None, k=10):
+        """
+        :param start: See month_positions
+        :param end: See month_positions
+        :param k: Number of relationships
+        :type k: int
+        :return: Relationships with most works created from start to end,
+            most first, among the top relationships of the fandom over all
+            time (see build_monthly_relationships)
+        :rtype: pandas DataFrame
+        """
+        first, last = self.month_positions(start, end)
+        works_num = (
+            self.cumulative_relationships[last]
+            - self.cumulative_relationships[first]
+        )
+        order = np.argsort(-works_num, kind='stable')[:k]
+        order = order[works_num[order] > 0]
+        return pd.DataFrame(
+            {
+                'relationship_name': self.relationship_names[order],
+                'works_num': works_num[order],
+            }
+        )
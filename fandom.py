@@ -1,16 +1,21 @@
-import itertools
+import functools
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mticker
-from matplotlib.colors import LinearSegmentedColormap
-from mpl_chord_diagram import chord_diagram
-import plotly.express as px
 
+from date_ranges import FandomTimeline
+from monthly_works import fandom_active_months, roll_up_monthly_works
+from relationships import classify_relationships, character_pair_matrix
 from utils import (
-    format_number, TAG_TYPES_TO_KEEP, PX_TEMPLATE,
-    PX_FONT_SIZE_AXES, PX_FONT_SIZE_TICKS
+    format_number, retrieve_fandom_rows, retrieve_character_names,
+    TAG_TYPES_TO_KEEP, PX_TEMPLATE, PX_FONT_SIZE_AXES, PX_FONT_SIZE_TICKS,
+    NON_FANDOM_TAGS_AGG_LOC, WORKS_WITH_FANDOM_LOC, CHARACTER_PAIRS_LOC,
+    WORD_COUNT_HISTOGRAMS_LOC, WORD_COUNT_SKETCHES_LOC, MONTHLY_WORKS_LOC,
+    MONTHLY_RELATIONSHIPS_LOC
+)
+from word_counts import (
+    rebin_word_count_histogram, word_count_histogram_mean,
+    word_count_sketch_quantile
 )
 
 PLT_RC_PARAMS = {
@@ -19,10 +24,9 @@ PLT_RC_PARAMS = {
     'xtick.labelsize': 15,
     'ytick.labelsize': 15,
 }
-plt.style.use('ggplot')
-for k, v in PLT_RC_PARAMS.items():
-    plt.rcParams[k] = v
-colors = [
+# Same as st.pyplot
+CHORD_CHART_SAVEFIG_CONFIG = {'dpi': 200, 'bbox_inches': 'tight'}
+CHORD_CHART_COLORS = [
     'lightseagreen',
     'tomato',
     'gold',
@@ -32,31 +36,83 @@ colors = [
     'lightskyblue',
     'darkorange',
 ]
-custom_cmap = LinearSegmentedColormap.from_list('mycmap', colors)
 
-RELATIONSHIP_SEPARATOR_LU = {'romantic': '/', 'platonic': '&'}
-CHARACTER_COLUMN_NAMES = ['char_1', 'char_2']
+
+@functools.lru_cache(maxsize=None)
+def apply_matplotlib_style():
+    """
+    Imports matplotlib and applies the style of the charts, the first time a
+        chart is drawn rather than when the app starts
+    Figures take the style when they are created, so this is called before
+        creating them
+    :return: Colormap of the chord charts
+    :rtype: matplotlib LinearSegmentedColormap
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LinearSegmentedColormap
+
+    plt.style.use('ggplot')
+    for k, v in PLT_RC_PARAMS.items():
+        plt.rcParams[k] = v
+    return LinearSegmentedColormap.from_list('mycmap', CHORD_CHART_COLORS)
 
 
 class Fandom:
-    def __init__(self, name, works_with_fandom, non_fandom_tags_agg):
+    def __init__(self, name):
         self.name = name
-        non_fandom_tags_agg_for_fandom = non_fandom_tags_agg.loc[name, :].compute().droplevel('fandom_name')
-        self.works = works_with_fandom.loc[self.name].compute()
+        # Only the row groups holding this fandom are read
+        non_fandom_tags_agg_for_fandom = retrieve_fandom_rows(
+            NON_FANDOM_TAGS_AGG_LOC, name
+        ).droplevel('fandom_name')
         self.relationships = self.retrieve_tags_by_type(
             non_fandom_tags_agg_for_fandom, 'Relationship'
         )
-        relationship_conditions = [
-            np.array(self.relationships['relationship_name'].str.contains(split), dtype=bool)
-            for split in RELATIONSHIP_SEPARATOR_LU.values()
-        ]
-        self.relationships['relationship_type'] = np.select(
-            relationship_conditions,
-            [rel_type for rel_type in RELATIONSHIP_SEPARATOR_LU],
+        self.relationships['relationship_type'] = classify_relationships(
+            self.relationships['relationship_name']
         )
+        # Precomputed in preprocessing, see build_character_pairs
+        self.character_pairs = retrieve_fandom_rows(
+            CHARACTER_PAIRS_LOC, name
+        ).reset_index(drop=True)
         self.freeform_tags = self.retrieve_tags_by_type(
             non_fandom_tags_agg_for_fandom, 'Freeform'
         )
+        # Precomputed in preprocessing, see build_word_count_summaries
+        self.word_count_histogram = retrieve_fandom_rows(
+            WORD_COUNT_HISTOGRAMS_LOC, name
+        ).reset_index()
+        self.word_count_sketch = retrieve_fandom_rows(
+            WORD_COUNT_SKETCHES_LOC, name
+        ).reset_index()
+        self.monthly_works = fandom_active_months(
+            retrieve_fandom_rows(MONTHLY_WORKS_LOC, name).droplevel(
+                'fandom_name'
+            )
+        )
+        # Date ranges are answered from prefix sums over the months, see
+        # FandomTimeline
+        self.timeline = FandomTimeline(
+            self.monthly_works,
+            retrieve_fandom_rows(
+                MONTHLY_RELATIONSHIPS_LOC, name
+            ).droplevel('fandom_name'),
+        )
+        self._works = None
+        self._memory_usage = None
+
+    @property
+    def works(self):
+        """
+        Works of the fandom, only read when used as the charts are served from
+            precomputed tables
+        """
+        if self._works is None:
+            self._works = retrieve_fandom_rows(
+                WORKS_WITH_FANDOM_LOC, self.name
+            ).droplevel('fandom_name')
+            # Measured again with the works, see memory_usage
+            self._memory_usage = None
+        return self._works
 
     @staticmethod
     def retrieve_tags_by_type(non_fandom_tags_agg, tag_type):
@@ -70,8 +126,9 @@ class Fandom:
             type
         """
         assert tag_type in [s for s in TAG_TYPES_TO_KEEP if s != 'Fandom']
+        # Masked rather than looked up, as a fandom may have no tags of a type
         df = (
-            non_fandom_tags_agg.loc[tag_type]
+            non_fandom_tags_agg.loc[non_fandom_tags_agg.index == tag_type]
             .rename(columns={'name_final': f'{tag_type.lower()}_name'})
             .reset_index(drop=True)
         )
@@ -90,78 +147,69 @@ class Fandom:
         :return: None
         """
         assert relationship_type in ('romantic', 'platonic')
-        rel_df = self.parse_relationships_to_characters(relationship_type)
-        rel_df.drop(columns='word_count_mean', inplace=True)
-        # Need to group again because of how we parse poly pairings
-        rel_count = (
-            rel_df.groupby(by=CHARACTER_COLUMN_NAMES)
-            .sum()[['works_num']]
-            .reset_index()
-        )
-        rel_count = rel_count.sort_values(
-            by='works_num', ascending=False
-        ).head(top_n)
-        # Issue is right now 'A/B' is counted differently from 'B/A'.
-        # In some cases, 'B/A' won't even exist, so we force it
-        matrix = rel_count.pivot(
-            index=CHARACTER_COLUMN_NAMES[0],
-            columns=CHARACTER_COLUMN_NAMES[1],
-            values='works_num',
-        )
-        # Getting total list of unique characters
-        characters = np.unique(rel_count[CHARACTER_COLUMN_NAMES].values)
-        # Reindexing so both rows and columns contain all characters
-        matrix = matrix.reindex(index=characters, columns=characters)
-        # Make it so the value of 'A/B' equals the value of 'B/A'
-        matrix = matrix.add(matrix.T, fill_value=0)
-        matrix.fillna(0, inplace=True)
-        chord_diagram(
-            matrix,
-            names=matrix.columns,
-            rotate_names=[True for c in matrix.columns],
-            use_gradient=True,
-            cmap=custom_cmap,
-            ax=ax,
-        )
+        import matplotlib.pyplot as plt
+        from mpl_chord_diagram import chord_diagram
+
+        custom_cmap = apply_matplotlib_style()
+        if ax is None:
+            ax = plt.gca()
+        # Pairs are sorted by number of works within each relationship type
+        rel_count = self.character_pairs.loc[
+            self.character_pairs['relationship_type'] == relationship_type
+        ].head(top_n)
+        if rel_count.empty:
+            ax.text(
+                0.5,
+                0.5,
+                f'No {relationship_type} relationships between two '
+                f'characters in {self.name}',
+                ha='center',
+                va='center',
+                fontsize=PLT_RC_PARAMS['axes.labelsize'],
+                transform=ax.transAxes,
+            )
+            ax.axis('off')
+        else:
+            matrix, character_ids = character_pair_matrix(rel_count)
+            names = retrieve_character_names()[character_ids]
+            chord_diagram(
+                matrix,
+                names=names,
+                rotate_names=[True for c in names],
+                use_gradient=True,
+                cmap=custom_cmap,
+                ax=ax,
+            )
         if save_fig:
-            plt.savefig(
+            # The figure drawn on, which pyplot may not consider current
+            ax.figure.savefig(
                 f'not_added_to_git/images/{self.name.replace(" ", "_")}'
-                f'_chord_chart.png'
+                f'_chord_chart.png',
+                **CHORD_CHART_SAVEFIG_CONFIG,
             )
         return None
 
-    def parse_relationships_to_characters(self, relationship_type):
+    def memory_usage(self):
         """
-        Parses the characters in relationships
-        Note that currently poly relationships are split to pairs
-            (e.g., A/B/C -> A/B, A/C, B/C)
-        :param relationship_type: 'romantic' or 'platonic'
-        :return: relationship dataframe with two new columns indicating the
-            characters in that ship
+        Memory used by the tables of the fandom, including the works once they
+            are read. Measured once and again only after the works are read,
+            as measuring scans every string
+        :return: Bytes
+        :rtype: int
         """
-        # Filtering by relationship type
-        relationship_split = RELATIONSHIP_SEPARATOR_LU[relationship_type]
-        rel_df = self.relationships.query(
-            f'relationship_type == "{relationship_type}"'
-        ).copy()
-        rel_df['relationship_chars'] = rel_df.relationship_name.str.split(
-            relationship_split
-        )
-        # Assess the number of characters in the ship to filter poly ships
-        rel_df['relationship_chars_combo'] = rel_df[
-            'relationship_chars'
-        ].apply(lambda x: list(itertools.combinations(x, 2)))
-        rel_df = rel_df.explode('relationship_chars_combo')
-        character_column_names = CHARACTER_COLUMN_NAMES
-        rel_df[character_column_names] = pd.DataFrame(
-            rel_df['relationship_chars_combo'].tolist(), index=rel_df.index
-        )
-        for col in character_column_names:
-            # Clean up character names so ' Gamora (Marvel)' becomes 'Gamora'
-            rel_df[col] = rel_df[col].str.strip()
-            rel_df[col] = rel_df[col].str.replace(' \(.+\)', '', regex=True)
-
-        return rel_df
+        if self._memory_usage is None:
+            tables = [
+                value for value in vars(self).values()
+                if isinstance(value, pd.DataFrame)
+            ]
+            self._memory_usage = int(
+                sum(
+                    df.memory_usage(index=True, deep=True).sum()
+                    for df in tables
+                )
+                + self.timeline.nbytes
+            )
+        return self._memory_usage
 
     def word_count_distribution(
         self,
@@ -172,6 +220,8 @@ class Fandom:
     ):
         """
         Provides visualizations, statistics on binned word count distribution
+        Bins are served from the fandom's fine word count histogram and the
+            median from its quantile sketch, so works are not read
         :param low_wc_upper_boundary: Upper boundary for fic to be considered
             "low" word count
         :param low_wc_step: Bin steps for low word count bins
@@ -181,7 +231,8 @@ class Fandom:
         :param high_wc_step: Bin steps for high word count bins
         :return: Plotly figure containing the binned word count distribution
             Mean word count
-            Median word count
+            Median word count (within 1% of the exact median)
+            Both are '-' if no work of the fandom has a word count
         """
         wc_bins, wc_bin_labels = self.generate_word_count_bins(
             low_wc_upper_boundary,
@@ -189,18 +240,30 @@ class Fandom:
             high_wc_upper_boundary,
             high_wc_step,
         )
-        works_df = self.works.copy()
-        mean_word_count = int(works_df['word_count'].mean())
-        median_word_count = int(works_df['word_count'].median())
-        works_df['word_count_bin'] = pd.cut(
-            works_df['word_count'],
-            wc_bins,
-            labels=wc_bin_labels,
-            include_lowest=True,
+        if self.word_count_histogram.empty:
+            mean_word_count = median_word_count = '-'
+        else:
+            mean_word_count = int(
+                word_count_histogram_mean(self.word_count_histogram)
+            )
+            median_word_count = int(
+                word_count_sketch_quantile(self.word_count_sketch, 0.5)
+            )
+        works_grouped_wc = pd.DataFrame(
+            {
+                'word_count': rebin_word_count_histogram(
+                    self.word_count_histogram, wc_bins
+                )
+            },
+            index=pd.CategoricalIndex(
+                wc_bin_labels,
+                categories=wc_bin_labels,
+                ordered=True,
+                name='word_count_bin',
+            ),
         )
-        works_grouped_wc = works_df.groupby(
-            by=['word_count_bin']
-        )[['word_count']].count()
+        import plotly.express as px
+
         fig = px.bar(
             works_grouped_wc,
             labels={
@@ -262,11 +325,17 @@ class Fandom:
         wc_bins_labels.insert(0, '<' + format_number(low_wc_step))
         return wc_bins, wc_bins_labels
 
-    def year_month_distribution(self):
-        self.works['creation_month'] = self.works['creation date'] + pd.offsets.MonthBegin(-1)
-        works_grouped_ym = self.works.groupby(
-            by=['creation_month']
-        )[['word_count']].count()
+    def year_month_distribution(self, start=None, end=None):
+        """
+        Number of works created per month
+        :param start: First date, or None for the first month
+        :param end: Date after the last, or None for after the last month
+        :return: Plotly figure
+        """
+        import plotly.express as px
+
+        first, last = self.timeline.month_positions(start, end)
+        works_grouped_ym = self.monthly_works[['works_num']].iloc[first:last]
         fig = px.bar(
             works_grouped_ym,
             labels={
@@ -287,3 +356,15 @@ class Fandom:
             marker_color='#6eaf28',
         )
         return fig
+
+    def year_distribution(self):
+        """
+        Number of works created, total and mean word count per year
+        :return: One row per year
+        :rtype: pandas DataFrame
+        """
+        works_by_year = roll_up_monthly_works(self.monthly_works)
+        works_by_year['word_count_mean'] = (
+            works_by_year['word_count_sum'] / works_by_year['word_count_n']
+        )
+        return works_by_year
@@ -0,0 +1,118 @@
+import collections
+import threading
+
+import streamlit as st
+
+from fandom import Fandom
+from utils import logger, FANDOM_CACHE_MAX_BYTES
+
+
+class FandomCache:
+    """
+    Least recently used cache of Fandom objects, bounded by the memory used by
+        their tables rather than by the number of fandoms. Safe to share
+        between the threads of concurrent Streamlit sessions
+    """
+    def __init__(self, max_bytes=FANDOM_CACHE_MAX_BYTES):
+        """
+        :param max_bytes: Memory budget of the cached fandoms
+        :type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self._fandoms = collections.OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name):
+        """
+        Returns the Fandom of name, constructing it if it is not cached
+        Fandoms grow when their works are read, so the size of a fandom is
+            taken again every time it is returned from the cache. Fandoms keep
+            their size, so this does not measure their tables again
+        :param name: Name of the fandom
+        :type name: str
+        :return: Fandom object, shared with other sessions
+        :rtype: Fandom
+        """
+        with self._lock:
+            fandom = self._fandoms.get(name)
+            if fandom is not None:
+                self.hits += 1
+                self._fandoms.move_to_end(name)
+                self._set_size(name, fandom.memory_usage())
+                return fandom
+            self.misses += 1
+        # Constructed outside the lock so other fandoms can be served
+        # meanwhile. Two sessions missing the same fandom at once both
+        # construct it and the second one is dropped
+        fandom = Fandom(name)
+        size = fandom.memory_usage()
+        with self._lock:
+            if name in self._fandoms:
+                return self._fandoms[name]
+            if size > self.max_bytes:
+                logger.info(
+                    f'{name} needs {size} bytes, more than the fandom cache '
+                    f'budget, not caching it'
+                )
+                return fandom
+            self._fandoms[name] = fandom
+            self._set_size(name, size)
+        logger.info(f'Fandom cache: {self.stats()}')
+        return fandom
+
+    def _set_size(self, name, size):
+        """
+        Records the size of a cached fandom and evicts the least recently used
+            other fandoms until the cache fits its budget. Called with the
+            lock held
+        """
+        self.bytes += size - self._sizes.get(name, 0)
+        self._sizes[name] = size
+        while self.bytes > self.max_bytes and len(self._fandoms) > 1:
+            evicted_name = next(iter(self._fandoms))
+            if evicted_name == name:
+                break
+            del self._fandoms[evicted_name]
+            self.bytes -= self._sizes.pop(evicted_name)
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Counters to size the budget with
+        :return: Number of cached fandoms, bytes used, budget, hits, misses,
+            evictions and hit rate
+        :rtype: dict
+        """
+        requests_num = self.hits + self.misses
+        return {
+            'fandoms': len(self._fandoms),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (
+                round(self.hits / requests_num, 3) if requests_num else None
+            ),
+        }
+
+    def clear(self):
+        with self._lock:
+            self._fandoms.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+
+@st.experimental_singleton
+def retrieve_fandom_cache():
+    """
+    Fandom cache of this process, shared by all sessions
+    :return: Fandom cache
+    :rtype: FandomCache
+    """
+    return FandomCache()
@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+FANDOM_SIMILARITY_K = 10
+# Rows of the fandom x tag matrix multiplied at once when computing all
+# similarities, bounding memory to this many rows of dense similarities
+FANDOM_SIMILARITY_BLOCK_SIZE = 256
+
+
+def build_fandom_tag_weights(non_fandom_tags_agg):
+    """
+    TF-IDF weight of every tag in every fandom, with the weights of each
+        fandom normalized to unit length so the dot product of two fandoms is
+        their cosine similarity. Term frequency is log(1 + works with the
+        tag), inverse document frequency is log((1 + fandoms) / (1 + fandoms
+        with the tag)), so tags of nearly every fandom (e.g. ratings) weigh
+        next to nothing
+    :param non_fandom_tags_agg: One row per fandom per non-fandom tag with
+        count of works, output of aggregate_works_tags_df
+    :type non_fandom_tags_agg: pandas DataFrame
+    :return: One row per fandom per tag with the id of the tag and its
+        weight, indexed by fandom and sorted
+    :rtype: pandas DataFrame
+    """
+    fandom_codes, fandom_names = pd.factorize(
+        non_fandom_tags_agg.index.get_level_values('fandom_name'), sort=True
+    )
+    type_codes, _ = pd.factorize(
+        non_fandom_tags_agg.index.get_level_values('type_final')
+    )
+    name_codes, names = pd.factorize(non_fandom_tags_agg['name_final'])
+    # Same name with another type is another tag
+    tag_ids, _ = pd.factorize(
+        type_codes.astype(np.int64) * len(names) + name_codes
+    )
+    fandoms_num = len(fandom_names)
+    fandoms_with_tag = np.bincount(tag_ids)
+    idf = np.log((1 + fandoms_num) / (1 + fandoms_with_tag))
+    weights = (
+        np.log1p(non_fandom_tags_agg['works_num'].to_numpy(np.float64))
+        * idf[tag_ids]
+    )
+    norms = np.sqrt(
+        np.bincount(fandom_codes, weights=weights ** 2, minlength=fandoms_num)
+    )
+    weights = weights / np.where(norms > 0, norms, 1)[fandom_codes]
+    keep = weights > 0
+    order = np.argsort(fandom_codes[keep], kind='stable')
+    return pd.DataFrame(
+        {
+            'tag_id': tag_ids[keep][order].astype(np.int32),
+            'weight': weights[keep][order].astype(np.float32),
+        },
+        index=pd.Index(
+            np.asarray(fandom_names)[fandom_codes[keep][order]],
+            name='fandom_name',
+        ),
+    )
+
+
+def fandom_tag_matrix(fandom_tag_weights):
+    """
+    Sparse fandom x tag matrix of the weights
+    :param fandom_tag_weights: Output of build_fandom_tag_weights
+    :type fandom_tag_weights: pandas DataFrame
+    :return:
+        - Matrix with one row per fandom and one column per tag
+        - Name of the fandom of each row
+    :rtype:
+        - scipy CSR matrix
+        - numpy array
+    """
+    fandom_codes, fandom_names = pd.factorize(
+        fandom_tag_weights.index, sort=True
+    )
+    tag_ids = fandom_tag_weights['tag_id'].to_numpy()
+    matrix = sp.csr_matrix(
+        (
+            fandom_tag_weights['weight'].to_numpy(np.float32),
+            (fandom_codes, tag_ids),
+        ),
+        shape=(len(fandom_names), int(tag_ids.max(initial=-1)) + 1),
+    )
+    return matrix, np.asarray(fandom_names).astype(str)
+
+
+def top_k_similarities(similarities, k, exclude=None):
+    """
+    Largest positive similarities of each row, most similar first
+    :param similarities: Dense similarities, one row per query
+    :type similarities: numpy array
+    :param k: Number of similarities per row
+    :type k: int
+    :param exclude: Column to leave out of each row, i.e. the query itself
+    :type exclude: numpy array
+    :return: Row, column and similarity of each kept similarity
+    :rtype: tuple
+    """
+    rows_num, columns_num = similarities.shape
+    if exclude is not None:
+        similarities[np.arange(rows_num), exclude] = -np.inf
+    k = min(k, columns_num)
+    if k == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([], dtype=similarities.dtype)
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    top_similarities = np.take_along_axis(similarities, top, axis=1)
+    order = np.argsort(-top_similarities, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1)
+    top_similarities = np.take_along_axis(top_similarities, order, axis=1)
+    keep = top_similarities > 0
+    rows = np.broadcast_to(np.arange(rows_num)[:, None], top.shape)
+    return rows[keep], top[keep], top_similarities[keep]
+
+
+def build_similar_fandoms(
+    fandom_tag_weights,
+    k=FANDOM_SIMILARITY_K,
+    block_size=FANDOM_SIMILARITY_BLOCK_SIZE,
+):
+    """
+    Most similar fandoms of every fandom, multiplying the fandom x tag matrix
+        by its transpose a block of rows at a time
+    :param fandom_tag_weights: Output of build_fandom_tag_weights
+    :type fandom_tag_weights: pandas DataFrame
+    :param k: Number of similar fandoms per fandom
+    :type k: int
+    :param block_size: Number of fandoms per block
+    :type block_size: int
+    :return: One row per fandom per similar fandom with its rank and cosine
+        similarity. Fandoms sharing no weighted tag are not similar
+    :rtype: pandas DataFrame
+    """
+    matrix, fandom_names = fandom_tag_matrix(fandom_tag_weights)
+    matrix_t = matrix.T.tocsr()
+    rows = [np.array([], dtype=np.int64)]
+    columns = [np.array([], dtype=np.int64)]
+    similarities = [np.array([], dtype=np.float32)]
+    for start in range(0, matrix.shape[0], block_size):
+        block_similarities = (
+            matrix[start:start + block_size] @ matrix_t
+        ).toarray()
+        block_rows, block_columns, top_similarities = top_k_similarities(
+            block_similarities,
+            k,
+            exclude=np.arange(start, start + block_similarities.shape[0]),
+        )
+        rows.append(block_rows + start)
+        columns.append(block_columns)
+        similarities.append(top_similarities)
+    similar_fandoms = pd.DataFrame(
+        {
+            'fandom_name': fandom_names[np.concatenate(rows)],
+            'similar_fandom_name': fandom_names[np.concatenate(columns)],
+            'similarity': np.concatenate(similarities).astype(np.float32),
+        }
+    )
+    similar_fandoms.insert(
+        1, 'rank', similar_fandoms.groupby('fandom_name').cumcount() + 1
+    )
+    return similar_fandoms
+
+
+class FandomSimilarityIndex:
+    """
+    Fandom x tag matrix held in memory to answer most similar fandom queries,
+        each a sparse row times the transposed matrix
+    """
+    def __init__(self, fandom_tag_weights):
+        """
+        :param fandom_tag_weights: Output of build_fandom_tag_weights
+        :type fandom_tag_weights: pandas DataFrame
+        """
+        self.matrix, self.fandom_names = fandom_tag_matrix(fandom_tag_weights)
+        self.matrix_t = self.matrix.T.tocsr()
+        self.fandom_ids = {
+            fandom_name: i for i, fandom_name in enumerate(self.fandom_names)
+        }
+
+    def most_similar(self, fandom_name, k=FANDOM_SIMILARITY_K):
+        """
+        :param fandom_name: Name of the fandom
+        :type fandom_name: str
+        :param k: Number of similar fandoms
+        :type k: int
+        :return: Similar fandoms with their cosine similarity, most similar
+            first. Empty for fandoms without weighted tags
+        :rtype: list
+        """
+        i = self.fandom_ids.get(fandom_name)
+        if i is None:
+            return []
+        similarities = (self.matrix[i] @ self.matrix_t).toarray()
+        _, columns, top_similarities = top_k_similarities(
+            similarities, k, exclude=np.array([i])
+        )
+        return [
+            (self.fandom_names[column], float(similarity))
+            for column, similarity in zip(columns, top_similarities)
+        ]
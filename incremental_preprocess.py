@@ -0,0 +1,420 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from preprocess_data import (
+    TAGS_COLUMNS_TO_COALESCE,
+    WORKS_CSV_DTYPES,
+    TagLookup,
+    finalize_partial_aggregates,
+    merge_partial_tag_aggs,
+    parse_tag_ids,
+    process_works_batch,
+    save_aggregates,
+    save_data_to_parquet,
+    standardize_tags,
+)
+from utils import (
+    logger,
+    WORKS_CSV,
+    TAGS_CSV,
+    MINIMUM_WORK_COUNT,
+    WORKS_CSV_CHUNKSIZE,
+    INCREMENTAL_STATE_DIRECTORY,
+    TAG_GROUPBY_LIST,
+)
+
+WORKS_STATE_COLUMNS = ['creation date', 'word_count', 'tags']
+# Name of the index of the works in the state, see read_work_keys
+WORK_KEY = 'work_key'
+STATE_FILES = {
+    'works': 'works.parquet',
+    'tags_df_merger': 'tags_df_merger.parquet',
+    'works_with_fandom': 'works_with_fandom_all.parquet',
+    'tags_partial': 'tags_partial.parquet',
+}
+
+
+def update_preprocessed_data(
+    works_csv_location=WORKS_CSV,
+    tags_csv_location=TAGS_CSV,
+    minimum_work_count=MINIMUM_WORK_COUNT,
+    state_directory=INCREMENTAL_STATE_DIRECTORY,
+    chunksize=WORKS_CSV_CHUNKSIZE,
+):
+    """
+    Updates the preprocessed data with a newer AO3 data dump by only
+        processing works that were added, removed or changed since the dump
+        the state was built from. If there is no state yet, every work is
+        treated as added (equivalent to a full run)
+    The dump has no work ids, so works are identified by a key hashed from
+        their creation date, tags and word count (see read_work_keys) rather
+        than by their row in the CSV, which shifts whenever a work is removed.
+        Limitations: a work whose creation date, tags or word count changed
+        counts as one removed and one added work, and identical works cannot
+        be told apart, so only their number is tracked. Work ids in the
+        outputs are these keys, not the CSV rows used by preprocess_data
+    The new dump is read twice, a batch at a time: once to key every work and
+        once to keep only the added works. The works of the state, which are
+        needed to subtract removed works, are held in memory
+    :param works_csv_location: Location of the newer works CSV
+    :type works_csv_location: str
+    :param tags_csv_location: Location of the newer tags CSV
+    :type tags_csv_location: str
+    :param minimum_work_count: Minimum number of works fandom must have to be
+        included in analysis
+    :type minimum_work_count: int
+    :param state_directory: Directory with the mergeable state of the previous
+        run
+    :type state_directory: str
+    :param chunksize: Number of works to read or process at a time
+    :type chunksize: int
+    :return: None
+    :rtype: None
+    """
+    logger.info('Updating preprocessed data')
+    state = load_incremental_state(state_directory)
+    logger.info('Keying works')
+    work_keys = read_work_keys(works_csv_location, chunksize)
+    logger.info('Retrieving tags_df')
+    tags_df = pd.read_csv(tags_csv_location, index_col='id')
+    logger.info('Standardizing non-canonical tags')
+    tags_df_merger = standardize_tags(tags_df, TAGS_COLUMNS_TO_COALESCE)
+    (
+        added_work_ids,
+        removed_work_ids,
+        changed_work_ids,
+    ) = find_changed_works(
+        state['works'], work_keys, state['tags_df_merger'], tags_df_merger
+    )
+    logger.info(
+        f'{len(added_work_ids)} added, {len(removed_work_ids)} removed and '
+        f'{len(changed_work_ids)} changed works'
+    )
+    # Changed works are removed with their old tags and added with the new
+    outdated_work_ids = removed_work_ids.union(changed_work_ids)
+    tags_partials = [state['tags_partial']]
+    if len(outdated_work_ids):
+        _, tags_partial_removed = process_works_in_chunks(
+            state['works'].loc[outdated_work_ids],
+            TagLookup(state['tags_df_merger']),
+            chunksize,
+        )
+        # Negated so that merging subtracts the outdated works
+        tags_partials.append(-tags_partial_removed)
+    works_with_fandom = state['works_with_fandom']
+    works_with_fandom = works_with_fandom.loc[
+        ~works_with_fandom['work_id'].isin(outdated_work_ids)
+    ]
+    logger.info('Reading added works')
+    works_df = pd.concat(
+        [
+            state['works'].drop(removed_work_ids),
+            read_works(
+                works_csv_location, work_keys, added_work_ids, chunksize
+            ),
+        ]
+    )
+    new_work_ids = added_work_ids.union(changed_work_ids)
+    if len(new_work_ids):
+        (
+            works_with_fandom_added,
+            tags_partial_added,
+        ) = process_works_in_chunks(
+            works_df.loc[new_work_ids], TagLookup(tags_df_merger), chunksize
+        )
+        tags_partials.append(tags_partial_added)
+        works_with_fandom = pd.concat(
+            [works_with_fandom, works_with_fandom_added], ignore_index=True
+        )
+    tags_partial = merge_partial_tag_aggs(tags_partials)
+    # Tags that no longer have any works after removals
+    tags_partial = tags_partial.loc[tags_partial['works_num'] > 0]
+    logger.info('Finalizing aggregates')
+    (
+        non_fandom_tags_agg,
+        works_with_fandom_final,
+        fandom_works_count,
+        relationships_by_month,
+    ) = finalize_partial_aggregates(
+        works_with_fandom, tags_partial, minimum_work_count
+    )
+    save_aggregates(
+        non_fandom_tags_agg,
+        works_with_fandom_final,
+        fandom_works_count,
+        relationships_by_month,
+    )
+    save_incremental_state(
+        state_directory,
+        works=works_df,
+        tags_df_merger=tags_df_merger,
+        works_with_fandom=works_with_fandom.reset_index(drop=True),
+        tags_partial=tags_partial,
+    )
+    return None
+
+
+def read_works_csv(works_csv_location, chunksize):
+    """
+    Reads the columns of the works CSV kept in the state, a batch at a time
+    :param works_csv_location: Location of the works CSV
+    :type works_csv_location: str
+    :param chunksize: Number of works per batch
+    :type chunksize: int
+    :return: Batches of works
+    :rtype: iterator of pandas DataFrame
+    """
+    return pd.read_csv(
+        works_csv_location,
+        usecols=WORKS_STATE_COLUMNS,
+        dtype=WORKS_CSV_DTYPES,
+        chunksize=chunksize,
+    )
+
+
+def read_work_keys(works_csv_location, chunksize):
+    """
+    Keys every work of the works CSV with a hash of its creation date, tags
+        and word count and of how many works before it have the same ones.
+        Keys do not depend on the position of the work in the CSV, so they
+        are the same in every dump the work is unchanged in
+    :param works_csv_location: Location of the works CSV
+    :type works_csv_location: str
+    :param chunksize: Number of works to read at a time
+    :type chunksize: int
+    :return: Key of each work, in the order of the CSV
+    :rtype: numpy array
+    """
+    content_hashes = np.concatenate(
+        [
+            pd.util.hash_pandas_object(
+                works_df[WORKS_STATE_COLUMNS], index=False
+            ).to_numpy()
+            for works_df in read_works_csv(works_csv_location, chunksize)
+        ]
+        # For a CSV without works
+        + [np.array([], dtype=np.uint64)]
+    )
+    occurrences = (
+        pd.Series(content_hashes).groupby(content_hashes).cumcount()
+    )
+    return (
+        pd.util.hash_pandas_object(
+            pd.DataFrame(
+                {
+                    'content_hash': content_hashes,
+                    'occurrence': occurrences.to_numpy(),
+                }
+            ),
+            index=False,
+        )
+        .to_numpy()
+        .view(np.int64)
+    )
+
+
+def read_works(works_csv_location, work_keys, work_ids, chunksize):
+    """
+    Reads only some works of the works CSV, a batch at a time
+    :param works_csv_location: Location of the works CSV
+    :type works_csv_location: str
+    :param work_keys: Output of read_work_keys for the CSV
+    :type work_keys: numpy array
+    :param work_ids: Keys of the works to read
+    :type work_ids: pandas Index
+    :param chunksize: Number of works to read at a time
+    :type chunksize: int
+    :return: The works, indexed by key
+    :rtype: pandas DataFrame
+    """
+    is_read = pd.Index(work_keys).isin(work_ids)
+    works_dfs = [empty_works_df()]
+    start = 0
+    if is_read.any():
+        for works_df in read_works_csv(works_csv_location, chunksize):
+            end = start + len(works_df)
+            is_read_batch = is_read[start:end]
+            works_df = works_df.loc[is_read_batch]
+            works_df.index = pd.Index(
+                work_keys[start:end][is_read_batch], name=WORK_KEY
+            )
+            works_dfs.append(works_df)
+            start = end
+    return pd.concat(works_dfs)
+
+
+def empty_works_df():
+    return pd.DataFrame(
+        columns=WORKS_STATE_COLUMNS,
+        index=pd.Index([], dtype=np.int64, name=WORK_KEY),
+    ).astype(WORKS_CSV_DTYPES)
+
+
+def find_changed_works(
+    works_df_old, work_ids_new, tags_df_merger_old, tags_df_merger_new
+):
+    """
+    Compares the works of the state with the keys of the works of a newer
+        dump, and two versions of the standardized tags
+    Works are identified by their key (see read_work_keys), so a work whose
+        tags, word count or creation date changed shows up as removed and
+        added. A work in both versions counts as changed if any of its tags
+        were standardized differently
+    :param works_df_old: Works of the previous dump, indexed by key
+    :type works_df_old: pandas DataFrame
+    :param work_ids_new: Keys of the works of the newer dump
+    :type work_ids_new: numpy array
+    :param tags_df_merger_old: Standardized tags of the previous dump
+    :type tags_df_merger_old: pandas DataFrame
+    :param tags_df_merger_new: Standardized tags of the newer dump
+    :type tags_df_merger_new: pandas DataFrame
+    :return:
+        - Ids of added works
+        - Ids of removed works
+        - Ids of changed works
+    :rtype:
+        - pandas Index
+        - pandas Index
+        - pandas Index
+    """
+    work_ids_new = pd.Index(work_ids_new, name=WORK_KEY)
+    added_work_ids = work_ids_new.difference(works_df_old.index)
+    removed_work_ids = works_df_old.index.difference(work_ids_new)
+    common_work_ids = works_df_old.index.intersection(work_ids_new)
+    changed = np.zeros(len(common_work_ids), dtype=bool)
+    changed_tag_ids = find_changed_tags(
+        tags_df_merger_old, tags_df_merger_new
+    )
+    if len(changed_tag_ids) and len(common_work_ids):
+        # Works in both dumps have the same tags, which may have been
+        # standardized differently
+        tag_ids, tags_num = parse_tag_ids(
+            works_df_old.loc[common_work_ids, 'tags']
+        )
+        work_positions = np.repeat(np.arange(len(common_work_ids)), tags_num)
+        changed = np.bincount(
+            work_positions[np.isin(tag_ids, changed_tag_ids)],
+            minlength=len(common_work_ids),
+        ) > 0
+    changed_work_ids = common_work_ids[changed]
+    return added_work_ids, removed_work_ids, changed_work_ids
+
+
+def find_changed_tags(tags_df_merger_old, tags_df_merger_new):
+    """
+    Finds tags that were added, removed or standardized differently
+    :param tags_df_merger_old: Standardized tags of the previous dump
+    :type tags_df_merger_old: pandas DataFrame
+    :param tags_df_merger_new: Standardized tags of the newer dump
+    :type tags_df_merger_new: pandas DataFrame
+    :return: Ids of changed tags
+    :rtype: numpy array
+    """
+    all_tag_ids = tags_df_merger_old.index.union(tags_df_merger_new.index)
+    old = tags_df_merger_old.reindex(all_tag_ids)
+    new = tags_df_merger_new.reindex(all_tag_ids)[old.columns]
+    changed = ~_equal_or_both_null(old, new).all(axis=1)
+    return all_tag_ids[changed.to_numpy()].to_numpy(dtype=np.int64)
+
+
+def _equal_or_both_null(df_a, df_b):
+    return (df_a == df_b) | (df_a.isna() & df_b.isna())
+
+
+def process_works_in_chunks(works_df, tag_lookup, chunksize):
+    """
+    Runs process_works_batch over works_df a chunk at a time
+    :param works_df: A DataFrame with work info, one row per work
+    :type works_df: pandas DataFrame
+    :param tag_lookup: Lookup built from the standardized tags
+    :type tag_lookup: TagLookup
+    :param chunksize: Number of works per chunk
+    :type chunksize: int
+    :return:
+        - One row per work per fandom, for all fandoms
+        - Partial tag aggregates
+    :rtype:
+        - pandas DataFrame
+        - pandas DataFrame
+    """
+    works_with_fandom_chunks = []
+    tags_partial = None
+    for start in range(0, len(works_df), chunksize):
+        _, works_with_fandom, tags_partial_chunk = process_works_batch(
+            works_df.iloc[start:start + chunksize], tag_lookup
+        )
+        works_with_fandom_chunks.append(works_with_fandom)
+        tags_partial = merge_partial_tag_aggs(
+            [tags_partial, tags_partial_chunk]
+        )
+    return (
+        pd.concat(works_with_fandom_chunks, ignore_index=True),
+        tags_partial,
+    )
+
+
+def load_incremental_state(state_directory):
+    """
+    Loads the mergeable state saved by the previous run. If there is none, or
+        it was saved by an older version (partial tag aggregates grouped
+        differently than TAG_GROUPBY_LIST, or works not keyed by WORK_KEY),
+        returns an empty state
+    :param state_directory: Directory with the state files
+    :type state_directory: str
+    :return: Dictionary of state name to DataFrame
+    :rtype: dict
+    """
+    locations = {
+        name: os.path.join(state_directory, file_name)
+        for name, file_name in STATE_FILES.items()
+    }
+    if all(os.path.exists(loc) for loc in locations.values()):
+        tags_partial_columns = pq.read_schema(
+            locations['tags_partial']
+        ).names
+        works_columns = pq.read_schema(locations['works']).names
+        if WORK_KEY in works_columns and all(
+            col in tags_partial_columns for col in TAG_GROUPBY_LIST
+        ):
+            logger.info(f'Loading state from {state_directory}')
+            return {
+                name: pd.read_parquet(loc)
+                for name, loc in locations.items()
+            }
+        logger.info(f'State in {state_directory} is outdated, starting over')
+    else:
+        logger.info(f'No state found in {state_directory}, starting over')
+    return {
+        'works': empty_works_df(),
+        'tags_df_merger': pd.DataFrame(
+            columns=[f'{col}_final' for col in TAGS_COLUMNS_TO_COALESCE]
+        ),
+        'works_with_fandom': pd.DataFrame(
+            columns=['work_id', 'fandom_name', 'word_count', 'creation date']
+        ),
+        'tags_partial': None,
+    }
+
+
+def save_incremental_state(state_directory, **state):
+    """
+    Saves the mergeable state for the next run
+    :param state_directory: Directory to save the state files in
+    :type state_directory: str
+    :param state: DataFrames to save, keyed by the names in STATE_FILES
+    :return: None
+    :rtype: None
+    """
+    os.makedirs(state_directory, exist_ok=True)
+    for name, df in state.items():
+        save_data_to_parquet(
+            df, os.path.join(state_directory, STATE_FILES[name])
+        )
+    return None
+
+
+if __name__ == '__main__':
+    update_preprocessed_data()
@@ -0,0 +1,302 @@
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+from utils import logger
+
+RSS_SAMPLING_INTERVAL = 0.01
+TRACEMALLOC_TOP_N = 25
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+
+# Report that instrument_stage records into, set while a RunReport is open
+_active_report = None
+
+
+class RunReport:
+    """
+    Collects timing and memory measurements of instrumented stages while it
+        is open (see instrument_stage). Stages that run several times, such as
+        per batch, are summed up under one entry
+    """
+    def __init__(
+        self, profile_stage=None, profile_mode='cprofile',
+        profile_directory='.',
+    ):
+        """
+        :param profile_stage: Name of a stage to capture a profile of
+        :type profile_stage: str
+        :param profile_mode: 'cprofile' to save cProfile stats, 'tracemalloc'
+            to record the lines that allocated the most memory
+        :type profile_mode: str
+        :param profile_directory: Where to save cProfile stats
+        :type profile_directory: str
+        """
+        assert profile_mode in PROFILE_MODES
+        self.profile_stage = profile_stage
+        self.profile_mode = profile_mode
+        self.profile_directory = profile_directory
+        self.stages = {}
+        self.run = {}
+        self._previous_report = None
+
+    def __enter__(self):
+        global _active_report
+        self._previous_report = _active_report
+        _active_report = self
+        self.run['started_at'] = pd.Timestamp.now().isoformat()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = cpu_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active_report
+        _active_report = self._previous_report
+        self.run['wall_seconds'] = round(
+            time.perf_counter() - self._wall_start, 3
+        )
+        self.run['cpu_seconds'] = round(
+            cpu_time() - self._cpu_start, 3
+        )
+        self.run['peak_rss_mb'] = max(
+            [stage['peak_rss_mb'] for stage in self.stages.values()],
+            default=None,
+        )
+        return False
+
+    def record(self, name, measurements):
+        stage = self._stage(name)
+        stage['calls'] += 1
+        for key in ['wall_seconds', 'cpu_seconds']:
+            stage[key] = round(stage[key] + measurements[key], 3)
+        for key in ['peak_rss_mb', 'rss_growth_mb']:
+            stage[key] = max(stage[key], measurements[key])
+        for key in ['rows_in', 'rows_out', 'output_bytes']:
+            if measurements.get(key) is not None:
+                stage[key] = (stage[key] or 0) + int(measurements[key])
+        self._set_rows_per_second(stage)
+
+    def merge(self, stages):
+        """
+        Adds up stages recorded by another report, such as the report of a
+            pool worker. Times are summed over processes, so stages run in
+            parallel can add up to more than the wall time of the run
+        :param stages: Stages of the other report
+        :type stages: dict
+        :return: None
+        :rtype: None
+        """
+        for name, other in stages.items():
+            stage = self._stage(name)
+            stage['calls'] += other['calls']
+            for key in ['wall_seconds', 'cpu_seconds']:
+                stage[key] = round(stage[key] + other[key], 3)
+            for key in ['peak_rss_mb', 'rss_growth_mb']:
+                stage[key] = max(stage[key], other[key])
+            for key in ['rows_in', 'rows_out', 'output_bytes']:
+                if other[key] is not None:
+                    stage[key] = (stage[key] or 0) + other[key]
+            self._set_rows_per_second(stage)
+            self.run['worker_peak_rss_mb'] = max(
+                self.run.get('worker_peak_rss_mb', 0.0), other['peak_rss_mb']
+            )
+        return None
+
+    def _stage(self, name):
+        return self.stages.setdefault(
+            name,
+            {
+                'calls': 0,
+                'wall_seconds': 0.0,
+                'cpu_seconds': 0.0,
+                'peak_rss_mb': 0.0,
+                'rss_growth_mb': 0.0,
+                'rows_in': None,
+                'rows_out': None,
+                'output_bytes': None,
+            },
+        )
+
+    @staticmethod
+    def _set_rows_per_second(stage):
+        rows = stage['rows_in'] or stage['rows_out']
+        stage['rows_per_second'] = (
+            round(rows / stage['wall_seconds'])
+            if rows and stage['wall_seconds'] else None
+        )
+
+    def to_dict(self):
+        return {'run': self.run, 'stages': self.stages}
+
+    def write(self, report_location):
+        """
+        Saves the report as JSON
+        :param report_location: Location of the JSON file
+        :type report_location: str
+        :return: None
+        :rtype: None
+        """
+        os.makedirs(os.path.dirname(report_location) or '.', exist_ok=True)
+        with open(report_location, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        logger.info(f'Run report saved to {report_location}')
+        return None
+
+
+@contextlib.contextmanager
+def instrument_stage(name, rows_in=None):
+    """
+    Measures the block as a stage of the open RunReport: wall and CPU time,
+        peak resident set size (sampled from a background thread) and rows in.
+        Rows out and output bytes are taken from what is passed to set_output
+        or set_output_files. Does nothing when no report is open
+    :param name: Name of the stage
+    :type name: str
+    :param rows_in: Number of input rows
+    :type rows_in: int
+    """
+    report = _active_report
+    measurements = {'rows_in': rows_in}
+    if report is None:
+        yield measurements
+        return
+    rss_start = current_rss()
+    peak = {'rss': rss_start}
+    done = threading.Event()
+
+    def sample_rss():
+        while not done.wait(RSS_SAMPLING_INTERVAL):
+            peak['rss'] = max(peak['rss'], current_rss())
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    profiling = name == report.profile_stage
+    profiler = None
+    if profiling and report.profile_mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profiling:
+        tracemalloc.start()
+    wall_start = time.perf_counter()
+    cpu_start = cpu_time()
+    try:
+        yield measurements
+    finally:
+        measurements['wall_seconds'] = time.perf_counter() - wall_start
+        measurements['cpu_seconds'] = cpu_time() - cpu_start
+        done.set()
+        sampler.join()
+        peak['rss'] = max(peak['rss'], current_rss())
+        measurements['peak_rss_mb'] = round(peak['rss'] / 2 ** 20, 1)
+        measurements['rss_growth_mb'] = round(
+            (peak['rss'] - rss_start) / 2 ** 20, 1
+        )
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(report.profile_directory, exist_ok=True)
+            profile_location = os.path.join(
+                report.profile_directory, f'{name}.prof'
+            )
+            profiler.dump_stats(profile_location)
+            report.run['profile'] = profile_location
+        elif profiling:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            report.run['tracemalloc_top'] = [
+                str(stat)
+                for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP_N]
+            ]
+        # Not deep, which would scan every string of every batch. Python
+        # string columns are counted as their pointers
+        output = measurements.pop('output', None)
+        if output is not None:
+            dfs = output if isinstance(output, tuple) else (output,)
+            measurements['rows_out'] = sum(len(df) for df in dfs)
+            measurements['output_bytes'] = sum(
+                df.memory_usage(index=True, deep=False).sum() for df in dfs
+            )
+        report.record(name, measurements)
+
+
+def is_report_open():
+    """
+    Whether a RunReport is open in this process, i.e. whether stages are
+        measured
+    :rtype: bool
+    """
+    return _active_report is not None
+
+
+def merge_stages(stages):
+    """
+    Adds stages measured in another process to the open RunReport, see
+        RunReport.merge. Does nothing when no report is open
+    :param stages: Stages of the report of the other process
+    :type stages: dict
+    :return: None
+    :rtype: None
+    """
+    if _active_report is not None:
+        _active_report.merge(stages)
+    return None
+
+
+def set_output(measurements, output):
+    """
+    Records the output of a stage, whose rows and in-memory bytes (not
+        counting Python strings) are reported
+    :param measurements: Dictionary yielded by instrument_stage
+    :type measurements: dict
+    :param output: DataFrame or tuple of DataFrames
+    :return: output
+    """
+    measurements['output'] = output
+    return output
+
+
+def set_output_files(measurements, file_locations):
+    """
+    Records the size on disk of files written by a stage
+    :param measurements: Dictionary yielded by instrument_stage
+    :type measurements: dict
+    :param file_locations: Locations of the files
+    :type file_locations: list
+    :return: None
+    :rtype: None
+    """
+    if _active_report is None:
+        return None
+    measurements['output_bytes'] = sum(
+        os.path.getsize(loc) for loc in file_locations if os.path.exists(loc)
+    )
+    return None
+
+
+def cpu_time():
+    """
+    CPU time of this process and of the child processes it has waited for,
+        such as the workers of a terminated pool
+    :return: User and system CPU seconds
+    :rtype: float
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes (Linux only, 0 elsewhere)
+    :return: Resident set size
+    :rtype: int
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+
+from utils import NO_CREATION_MONTH
+
+
+def creation_month_ordinals(creation_dates):
+    """
+    Month of each creation date as a pandas Period ordinal, i.e. months since
+        January 1970
+    :param creation_dates: Creation dates, as dates or strings
+    :type creation_dates: pandas Series
+    :return: Month ordinals, NO_CREATION_MONTH for missing dates
+    :rtype: numpy array
+    """
+    creation_dates = pd.DatetimeIndex(creation_dates)
+    return np.where(
+        creation_dates.isna(),
+        NO_CREATION_MONTH,
+        creation_dates.to_period('M').asi8,
+    )
+
+
+def build_monthly_works(works_with_fandom):
+    """
+    Counts the works created in every month for every fandom. The months are
+        the same for all fandoms (from the first to the last month any work
+        was created), so each fandom has the same number of rows and months
+        without works are 0. See fandom_active_months for the months of one
+        fandom
+    :param works_with_fandom: One row per work per fandom, output of
+        aggregate_works_tags_df
+    :type works_with_fandom: pandas DataFrame
+    :return: One row per fandom per month with count of works, and the sum
+        and count of their word counts, indexed by fandom and month
+    :rtype: pandas DataFrame
+    """
+    fandom_codes, fandom_names = pd.factorize(
+        works_with_fandom.index.get_level_values('fandom_name'), sort=True
+    )
+    month_numbers = creation_month_ordinals(
+        works_with_fandom['creation date']
+    )
+    has_creation_date = month_numbers != NO_CREATION_MONTH
+    first_month, last_month = (
+        (month_numbers[has_creation_date].min(),
+         month_numbers[has_creation_date].max())
+        if has_creation_date.any() else (0, -1)
+    )
+    months_num = int(last_month - first_month + 1)
+    cells = (
+        fandom_codes[has_creation_date] * months_num
+        + month_numbers[has_creation_date]
+        - first_month
+    )
+    word_counts = works_with_fandom['word_count'].to_numpy(dtype=np.float64)[
+        has_creation_date
+    ]
+    has_word_count = ~np.isnan(word_counts)
+    size = len(fandom_names) * months_num
+    months = pd.period_range(
+        pd.Period(ordinal=int(first_month), freq='M'),
+        periods=months_num,
+        freq='M',
+    ).to_timestamp()
+    return pd.DataFrame(
+        {
+            'works_num': np.bincount(cells, minlength=size),
+            # Word counts are whole numbers, so the sums are exact
+            'word_count_sum': np.bincount(
+                cells,
+                weights=np.where(has_word_count, word_counts, 0),
+                minlength=size,
+            ).astype(np.int64),
+            'word_count_n': np.bincount(
+                cells, weights=has_word_count, minlength=size
+            ).astype(np.int64),
+        },
+        index=pd.MultiIndex.from_product(
+            [np.asarray(fandom_names), months],
+            names=['fandom_name', 'creation_month'],
+        ),
+    )
+
+
+def fandom_active_months(monthly_works):
+    """
+    Months of one fandom from its first to its last month with works, since
+        the rows of build_monthly_works span the months of all fandoms
+    :param monthly_works: Months of one fandom, from build_monthly_works,
+        indexed by month
+    :type monthly_works: pandas DataFrame
+    :return: The rows of monthly_works from its first to its last month with
+        works, none if the fandom has no works with a creation date
+    :rtype: pandas DataFrame
+    """
+    active_positions = np.flatnonzero(monthly_works['works_num'].to_numpy())
+    if not len(active_positions):
+        return monthly_works.iloc[:0]
+    return monthly_works.iloc[active_positions[0]:active_positions[-1] + 1]
+
+
+def roll_up_monthly_works(monthly_works, freq='YS'):
+    """
+    Adds up the months of one fandom into longer periods
+    :param monthly_works: Months of one fandom, from build_monthly_works,
+        indexed by month
+    :type monthly_works: pandas DataFrame
+    :param freq: Pandas frequency of the periods, e.g. 'YS' for years
+    :type freq: str
+    :return: One row per period with the same columns as monthly_works
+    :rtype: pandas DataFrame
+    """
+    return monthly_works.resample(freq).sum()
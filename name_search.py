@@ -0,0 +1,259 @@
+import bisect
+import unicodedata
+
+import numpy as np
+
+NAME_SEARCH_NGRAM = 3
+NAME_SEARCH_PAGE_SIZE = 20
+# Names holding the rarest n-gram of a query are checked this many at a time,
+# in rank order, until a page of results is filled
+NAME_SEARCH_CHUNK_SIZE = 512
+# Code points fit in 21 bits, so an n-gram of 3 fits in an int64
+CODE_POINT_BITS = 21
+
+
+def normalize_name(name):
+    """
+    Form of a name that is compared when searching: without diacritics and
+        case folded, so 'Pokémon' and 'POKEMON' match
+    :param name: Fandom or tag name
+    :type name: str
+    :return: Normalized name
+    :rtype: str
+    """
+    return ''.join(
+        c for c in unicodedata.normalize('NFKD', name)
+        if not unicodedata.combining(c)
+    ).casefold()
+
+
+def name_ngrams(normalized_names, n=NAME_SEARCH_NGRAM):
+    """
+    Every n-gram of every name, as integers
+    :param normalized_names: Names, from normalize_name
+    :type normalized_names: list
+    :param n: Length of the n-grams
+    :type n: int
+    :return:
+        - Position of the name of each n-gram in normalized_names
+        - N-gram, its code points packed into an integer
+    :rtype:
+        - numpy array
+        - numpy array
+    """
+    lengths = np.fromiter(
+        (len(name) for name in normalized_names),
+        dtype=np.int64,
+        count=len(normalized_names),
+    )
+    code_points = np.frombuffer(
+        ''.join(normalized_names).encode('utf-32-le'), dtype=np.uint32
+    ).astype(np.int64)
+    name_ids = np.repeat(np.arange(len(normalized_names)), lengths)
+    # N-grams starting in the last n - 1 characters of a name run into the next
+    ends = np.repeat(np.cumsum(lengths), lengths)
+    starts = np.flatnonzero(np.arange(len(code_points)) + n <= ends)
+    ngrams = np.zeros(len(starts), dtype=np.int64)
+    for i in range(n):
+        ngrams = (ngrams << CODE_POINT_BITS) | code_points[starts + i]
+    return name_ids[starts], ngrams
+
+
+class NameSearchIndex:
+    """
+    Search index over names with their number of works. Names are numbered by
+        number of works, most first, so any list of names sorted by number is
+        sorted by rank and a search stops once it has a page of results.
+        Queries shorter than an n-gram match the start of names through a
+        sorted list, longer queries match anywhere in names through n-gram
+        postings
+    """
+    def __init__(self, names, works_num, kinds=None):
+        """
+        :param names: Names to search, without duplicates of the same kind
+        :type names: list
+        :param works_num: Number of works of each name, to rank results by
+        :type works_num: list
+        :param kinds: Kind of each name, e.g. the type of a tag, returned with
+            results
+        :type kinds: list
+        """
+        order = np.argsort(-np.asarray(works_num), kind='stable')
+        self.names = [names[i] for i in order]
+        self.works_num = np.asarray(works_num)[order]
+        self.kinds = None if kinds is None else [kinds[i] for i in order]
+        self.normalized_names = [normalize_name(name) for name in self.names]
+        # For prefixes and alphabetical order
+        self.alphabetical_ids = np.array(
+            sorted(
+                range(len(self.names)), key=self.normalized_names.__getitem__
+            ),
+            dtype=np.int64,
+        )
+        self.alphabetical_names = [
+            self.normalized_names[i] for i in self.alphabetical_ids
+        ]
+        self.alphabetical_ranks = np.empty(len(self.names), dtype=np.int64)
+        self.alphabetical_ranks[self.alphabetical_ids] = np.arange(
+            len(self.names)
+        )
+        # For substrings, postings of each n-gram sorted by rank like CSR
+        name_ids, ngrams = name_ngrams(self.normalized_names)
+        order = np.lexsort((name_ids, ngrams))
+        name_ids, ngrams = name_ids[order], ngrams[order]
+        # A name holding an n-gram twice is posted once
+        first = np.ones(len(ngrams), dtype=bool)
+        first[1:] = (ngrams[1:] != ngrams[:-1]) | (
+            name_ids[1:] != name_ids[:-1]
+        )
+        ngrams = ngrams[first]
+        self.postings = name_ids[first].astype(np.int32)
+        self.ngrams, ngram_starts = np.unique(ngrams, return_index=True)
+        self.ngram_offsets = np.append(ngram_starts, len(ngrams))
+
+    def __len__(self):
+        return len(self.names)
+
+    def _postings(self, ngram):
+        i = np.searchsorted(self.ngrams, ngram)
+        if i == len(self.ngrams) or self.ngrams[i] != ngram:
+            return self.postings[:0]
+        return self.postings[self.ngram_offsets[i]:self.ngram_offsets[i + 1]]
+
+    def _prefix_matches(self, normalized_query):
+        # In alphabetical order
+        start = bisect.bisect_left(self.alphabetical_names, normalized_query)
+        end = bisect.bisect_left(
+            self.alphabetical_names, normalized_query + '\U0010ffff'
+        )
+        return self.alphabetical_ids[start:end]
+
+    def _prefix_ids(self, normalized_query, results_num):
+        ids = self._prefix_matches(normalized_query)
+        if len(ids) > results_num:
+            ids = np.partition(ids, results_num - 1)[:results_num]
+        return np.sort(ids)
+
+    def _substring_ids(self, normalized_query, results_num):
+        _, ngrams = name_ngrams([normalized_query])
+        postings = sorted(
+            (self._postings(ngram) for ngram in np.unique(ngrams)), key=len
+        )
+        ids = []
+        for start in range(0, len(postings[0]), NAME_SEARCH_CHUNK_SIZE):
+            candidates = postings[0][start:start + NAME_SEARCH_CHUNK_SIZE]
+            for other in postings[1:]:
+                positions = np.searchsorted(other, candidates)
+                candidates = candidates[
+                    other[np.minimum(positions, len(other) - 1)] == candidates
+                ]
+            # Having all the n-grams does not mean holding them in order
+            for i in candidates:
+                if normalized_query in self.normalized_names[i]:
+                    ids.append(i)
+                    if len(ids) == results_num:
+                        return ids
+        return ids
+
+    def _alphabetical_ids(self, normalized_query):
+        if not normalized_query:
+            return self.alphabetical_ids
+        if len(normalized_query) < NAME_SEARCH_NGRAM:
+            return self._prefix_matches(normalized_query)
+        # Every match is needed to sort them by name, not only a page
+        ids = np.array(
+            self._substring_ids(normalized_query, len(self.names)),
+            dtype=np.int64,
+        )
+        return ids[np.argsort(self.alphabetical_ranks[ids], kind='stable')]
+
+    def search(
+        self,
+        query,
+        offset=0,
+        limit=NAME_SEARCH_PAGE_SIZE,
+        alphabetical=False,
+    ):
+        """
+        Names matching a query, case- and diacritic-insensitively, with most
+            works first. An empty query matches all names
+        :param query: Text to search for
+        :type query: str
+        :param offset: Number of results to skip, for pages after the first
+        :type offset: int
+        :param limit: Number of results
+        :type limit: int
+        :param alphabetical: Whether to order results alphabetically instead
+            of by number of works, which finds every match before paging
+        :type alphabetical: bool
+        :return: Name, kind (if any) and number of works of each result, and
+            whether there are results after these
+        :rtype:
+            - list
+            - bool
+        """
+        normalized_query = normalize_name(query.strip())
+        if alphabetical:
+            ids = self._alphabetical_ids(normalized_query)
+            return self._results(ids[offset:offset + limit]), (
+                offset + limit < len(ids)
+            )
+        results_num = offset + limit + 1
+        if len(normalized_query) >= NAME_SEARCH_NGRAM:
+            ids = self._substring_ids(normalized_query, results_num)
+        elif normalized_query:
+            ids = self._prefix_ids(normalized_query, results_num)
+        else:
+            ids = range(min(results_num, len(self.names)))
+        return self._results(list(ids)[offset:offset + limit]), (
+            len(ids) == results_num
+        )
+
+    def _results(self, ids):
+        results = [
+            {'name': self.names[i], 'works_num': int(self.works_num[i])}
+            for i in ids
+        ]
+        if self.kinds is not None:
+            for i, result in zip(ids, results):
+                result['kind'] = self.kinds[i]
+        return results
+
+
+def build_fandom_search_index(fandom_works_count):
+    """
+    Search index over fandom names
+    :param fandom_works_count: One row per fandom with count of works,
+        indexed by fandom_name
+    :type fandom_works_count: pandas DataFrame
+    :return: Index of the fandoms
+    :rtype: NameSearchIndex
+    """
+    return NameSearchIndex(
+        fandom_works_count.index.astype(str).tolist(),
+        fandom_works_count['works_num'].to_numpy(),
+    )
+
+
+def build_tag_search_index(non_fandom_tags_agg):
+    """
+    Search index over non-fandom tag names, ranked by their works across all
+        fandoms, a work being counted once per fandom it is in
+    :param non_fandom_tags_agg: One row per fandom per non-fandom tag with
+        count of works, output of aggregate_works_tags_df
+    :type non_fandom_tags_agg: pandas DataFrame
+    :return: Index of the tags, with their type as kind
+    :rtype: NameSearchIndex
+    """
+    tags = (
+        non_fandom_tags_agg.reset_index()
+        .astype({'name_final': str, 'type_final': str})
+        .groupby(['name_final', 'type_final'], sort=False)['works_num']
+        .sum()
+        .reset_index()
+    )
+    return NameSearchIndex(
+        tags['name_final'].tolist(),
+        tags['works_num'].to_numpy(),
+        tags['type_final'].tolist(),
+    )
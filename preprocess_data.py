@@ -1,5 +1,29 @@
+import collections
+import functools
+import multiprocessing
+import os
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
+from checkpoints import fingerprint_file, load_or_compute, stage_key
+from fandom_similarity import build_fandom_tag_weights, build_similar_fandoms
+from date_ranges import build_monthly_relationships
+from monthly_works import build_monthly_works, creation_month_ordinals
+from instrumentation import (
+    RunReport,
+    instrument_stage,
+    is_report_open,
+    merge_stages,
+    set_output,
+    set_output_files,
+)
+from relationships import build_character_pairs, build_top_relationships
+from word_counts import build_word_count_summaries
+from work_sketches import build_work_sketches
 from utils import (
     logger,
     WORKS_CSV,
@@ -8,19 +32,63 @@ from utils import (
     NON_FANDOM_TAGS_AGG_LOC,
     WORKS_WITH_FANDOM_LOC,
     FANDOM_WORKS_COUNT_LOC,
+    CHARACTER_PAIRS_LOC,
+    CHARACTERS_LOC,
+    WORD_COUNT_HISTOGRAMS_LOC,
+    WORD_COUNT_SKETCHES_LOC,
+    MONTHLY_WORKS_LOC,
+    MONTHLY_RELATIONSHIPS_LOC,
+    TOP_RELATIONSHIPS_LOC,
+    FANDOM_TAG_WEIGHTS_LOC,
+    SIMILAR_FANDOMS_LOC,
+    WORK_SKETCHES_LOC,
+    MONTHLY_WORK_SKETCHES_LOC,
+    MONTHLY_WORK_SKETCHES,
     MINIMUM_WORK_COUNT,
     TAG_TYPES_TO_KEEP,
     TO_PARQUET_CONFIG,
-    TAG_GROUPBY_AGG,
+    DICTIONARY_ENCODED_COLUMNS,
+    TAG_PARTIAL_AGG,
     TAG_GROUPBY_LIST,
+    TAG_MONTHLY_TYPES,
+    NO_CREATION_MONTH,
+    FANDOM_ROW_GROUP_SIZE,
+    fandom_index_location,
+    WORKS_CSV_CHUNKSIZE,
+    PREPROCESS_PROCESSES,
+    CHECKPOINT_DIRECTORY,
+    RUN_REPORT_DIRECTORY,
 )
 
+WORKS_COLUMNS_TO_DROP = [
+    'tags',
+    'Unnamed: 6',
+    'restricted',
+    'complete',
+    'language',
+]
+TAGS_COLUMNS_TO_COALESCE = ['type', 'name', 'canonical']
+# Types of the works CSV columns when read in one go, given so that batches
+# do not infer their own, e.g. an integer 'tags' column when every work of a
+# batch has a single tag
+WORKS_CSV_DTYPES = {
+    'creation date': str,
+    'tags': str,
+    'word_count': 'float64',
+}
+
 
 def preprocess_data(
     works_csv_location=WORKS_CSV,
     tags_csv_location=TAGS_CSV,
     minimum_work_count=MINIMUM_WORK_COUNT,
     flag_save_works_tags_df=True,
+    chunksize=None,
+    processes=None,
+    checkpoint_directory=None,
+    report_location=None,
+    profile_stage=None,
+    profile_mode='cprofile',
 ):
     """
     Preprocesses raw AO3 data dump. If flag_save_data=True, will save data as
@@ -33,46 +101,614 @@ def preprocess_data(
     :type minimum_work_count: int
     :param flag_save_works_tags_df: Whether or not to save the works_tags_df
     :type flag_save_works_tags_df: bool
+    :param chunksize: If provided, the works CSV is streamed in batches of
+        this many works so peak memory does not scale with the exploded data
+    :type chunksize: int
+    :param processes: If provided with chunksize, batches are processed by a
+        pool of this many processes
+    :type processes: int
+    :param checkpoint_directory: If provided, the output of each stage is
+        saved there, keyed by its inputs and parameters, and reused by later
+        runs with the same inputs and parameters
+    :type checkpoint_directory: str
+    :param report_location: If provided, the time, CPU time, peak memory, rows
+        and output bytes of each stage are saved there as JSON
+    :type report_location: str
+    :param profile_stage: With report_location, name of a stage to profile
+        (e.g. 'explode'). The profile is saved next to the report
+    :type profile_stage: str
+    :param profile_mode: 'cprofile' or 'tracemalloc'
+    :type profile_mode: str
     :return: None
     :rtype: None
     """
-    # Retrieve data
+    if report_location is None:
+        _preprocess_data(
+            works_csv_location,
+            tags_csv_location,
+            minimum_work_count,
+            flag_save_works_tags_df,
+            chunksize,
+            processes,
+            checkpoint_directory,
+        )
+        return None
+    with RunReport(
+        profile_stage,
+        profile_mode,
+        os.path.dirname(report_location) or '.',
+    ) as report:
+        report.run.update(
+            {
+                'works_csv_location': works_csv_location,
+                'tags_csv_location': tags_csv_location,
+                'minimum_work_count': minimum_work_count,
+                'chunksize': chunksize,
+                'processes': processes,
+            }
+        )
+        _preprocess_data(
+            works_csv_location,
+            tags_csv_location,
+            minimum_work_count,
+            flag_save_works_tags_df,
+            chunksize,
+            processes,
+            checkpoint_directory,
+        )
+    report.write(report_location)
+    return None
+
+
+def _preprocess_data(
+    works_csv_location,
+    tags_csv_location,
+    minimum_work_count,
+    flag_save_works_tags_df,
+    chunksize,
+    processes,
+    checkpoint_directory,
+):
     logger.info('Preprocessing data')
-    logger.info('Retrieving works_df')
-    works_df = pd.read_csv(works_csv_location)
-    logger.info('Retrieving tags_df')
-    tags_df = pd.read_csv(tags_csv_location, index_col='id')
-    # Notes: Takes 19 minutes to process entire dataset
-    logger.info('Generating works_tags_df')
-    works_tags_df = generate_works_tags_df(works_df, tags_df)
-    logger.info('Aggregating works_tags_df')
+    works_fingerprint, tags_fingerprint = (
+        (fingerprint_file(works_csv_location),
+         fingerprint_file(tags_csv_location))
+        if checkpoint_directory else (None, None)
+    )
+    # Stage keys chain, so changing an input or parameter only invalidates
+    # the stages downstream of it
+    tags_key = stage_key(tags_fingerprint, TAGS_COLUMNS_TO_COALESCE)
+    works_tags_key = stage_key(works_fingerprint, tags_key, TAG_TYPES_TO_KEEP)
+    aggregates_key = stage_key(works_tags_key, minimum_work_count)
+
+    # Each stage only asks for its upstream stage when it is not checkpointed
+    def get_tags_df_merger():
+        return load_or_compute(
+            'standardized_tags',
+            tags_key,
+            functools.partial(retrieve_standardized_tags, tags_csv_location),
+            checkpoint_directory,
+        )
+
+    def compute_partial_aggregates():
+        if chunksize:
+            return preprocess_works_in_batches(
+                works_csv_location,
+                get_tags_df_merger(),
+                chunksize,
+                WORKS_TAGS_PARQUET if flag_save_works_tags_df else None,
+                processes,
+            )
+        # Notes: Takes 19 minutes to process entire dataset
+        works_tags_df = load_or_compute(
+            'works_tags',
+            works_tags_key,
+            lambda: retrieve_works_tags_df(
+                works_csv_location, get_tags_df_merger()
+            ),
+            checkpoint_directory,
+        )
+        if flag_save_works_tags_df:
+            save_data_to_parquet(
+                works_tags_df, WORKS_TAGS_PARQUET
+            )
+        logger.info('Aggregating works_tags_df')
+        return partially_aggregate_works_tags_df(works_tags_df)
+
+    def compute_aggregates():
+        works_with_fandom, tags_partial = load_or_compute(
+            'partial_aggregates',
+            works_tags_key,
+            compute_partial_aggregates,
+            checkpoint_directory,
+        )
+        return finalize_partial_aggregates(
+            works_with_fandom, tags_partial, minimum_work_count
+        )
+
     (
         non_fandom_tags_agg,
         works_with_fandom,
         fandom_works_count,
-    ) = aggregate_works_tags_df(works_tags_df, minimum_work_count)
-    save_data_to_parquet(
+        relationships_by_month,
+    ) = load_or_compute(
+        'aggregates', aggregates_key, compute_aggregates, checkpoint_directory
+    )
+    save_aggregates(
+        non_fandom_tags_agg,
+        works_with_fandom,
+        fandom_works_count,
+        relationships_by_month,
+    )
+    return None
+
+
+def retrieve_standardized_tags(tags_csv_location):
+    logger.info('Retrieving tags_df')
+    with instrument_stage('read_tags_csv') as stage:
+        tags_df = set_output(
+            stage, pd.read_csv(tags_csv_location, index_col='id')
+        )
+    logger.info('Standardizing non-canonical tags')
+    return standardize_tags(tags_df, TAGS_COLUMNS_TO_COALESCE)
+
+
+def retrieve_works_tags_df(works_csv_location, tags_df_merger):
+    logger.info('Retrieving works_df')
+    with instrument_stage('read_works_csv') as stage:
+        works_df = set_output(
+            stage, pd.read_csv(works_csv_location, dtype=WORKS_CSV_DTYPES)
+        )
+    logger.info('Generating works_tags_df')
+    return explode_works_tags(works_df, TagLookup(tags_df_merger))
+
+
+def preprocess_works_in_batches(
+    works_csv_location,
+    tags_df_merger,
+    chunksize,
+    works_tags_location=None,
+    processes=None,
+):
+    """
+    Streams the works CSV in batches, exploding and partially aggregating each
+        batch before it is discarded. Only the work-level fandom rows and the
+        running tag aggregates are kept in memory
+    Each batch is a contiguous range of work ids, so batches can be processed
+        independently by a pool of processes and reduced in the parent
+    :param works_csv_location: Location of the AO3 data dump works CSV
+    :type works_csv_location: str
+    :param tags_df_merger: Standardized tags, output of standardize_tags
+    :type tags_df_merger: pandas DataFrame
+    :param chunksize: Number of works per batch
+    :type chunksize: int
+    :param works_tags_location: If provided, each exploded batch is appended to
+        a parquet file at this location
+    :type works_tags_location: str
+    :param processes: Number of worker processes. If None or 1, batches are
+        processed in this process
+    :type processes: int
+    :return: Same outputs as partially_aggregate_works_tags_df
+    :rtype:
+        - pandas DataFrame
+        - pandas DataFrame
+    """
+    with instrument_stage('process_works_batches') as stage:
+        works_with_fandom, tags_partial = _preprocess_works_in_batches(
+            works_csv_location,
+            tags_df_merger,
+            chunksize,
+            works_tags_location,
+            processes,
+            stage,
+        )
+        set_output(stage, (works_with_fandom, tags_partial))
+    return works_with_fandom, tags_partial
+
+
+def _preprocess_works_in_batches(
+    works_csv_location,
+    tags_df_merger,
+    chunksize,
+    works_tags_location,
+    processes,
+    stage,
+):
+    tag_lookup = TagLookup(tags_df_merger)
+    works_with_fandom_batches = []
+    tags_partials = []
+    tags_partial = None
+    writer = None
+    # The reader keeps a running index, so work ids stay the same as when the
+    # CSV is read in one go
+    works_batches = _count_rows(
+        pd.read_csv(
+            works_csv_location, chunksize=chunksize, dtype=WORKS_CSV_DTYPES
+        ),
+        stage,
+    )
+    if processes and processes > 1:
+        pool = multiprocessing.Pool(
+            processes,
+            initializer=_set_worker_tag_lookup,
+            initargs=(tag_lookup,),
+        )
+        batch_results = _merge_worker_stages(
+            _imap_bounded(
+                pool,
+                functools.partial(
+                    _process_works_batch_in_worker,
+                    return_works_tags_df=works_tags_location is not None,
+                    instrument=is_report_open(),
+                ),
+                works_batches,
+                max_pending=2 * processes,
+            )
+        )
+    else:
+        pool = None
+        batch_results = (
+            process_works_batch(
+                works_df,
+                tag_lookup,
+                return_works_tags_df=works_tags_location is not None,
+            )
+            for works_df in works_batches
+        )
+    try:
+        for i, (
+            works_tags_df,
+            works_with_fandom_batch,
+            tags_partial_batch,
+        ) in enumerate(batch_results):
+            logger.info(f'Processed batch {i}')
+            works_with_fandom_batches.append(works_with_fandom_batch)
+            tags_partials.append(tags_partial_batch)
+            # Reduce a few batches at a time to keep the parent from
+            # falling behind the workers
+            if len(tags_partials) >= (processes or 1):
+                tags_partial = merge_partial_tag_aggs(
+                    [tags_partial] + tags_partials
+                )
+                tags_partials = []
+            if works_tags_location:
+                with instrument_stage(
+                    'save_works_tags', rows_in=len(works_tags_df)
+                ):
+                    # Later batches are converted to the schema of the
+                    # first, which the file is written with
+                    table = pa.Table.from_pandas(
+                        works_tags_df,
+                        schema=writer.schema if writer else None,
+                        preserve_index=False,
+                    )
+                    if writer is None:
+                        writer = pq.ParquetWriter(
+                            works_tags_location,
+                            table.schema,
+                            **TO_PARQUET_CONFIG,
+                        )
+                    writer.write_table(table)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    tags_partial = merge_partial_tag_aggs([tags_partial] + tags_partials)
+    if writer is not None:
+        writer.close()
+        logger.info(f'Data saved to {works_tags_location}')
+    works_with_fandom = pd.concat(
+        works_with_fandom_batches, ignore_index=True
+    )
+    return works_with_fandom, tags_partial
+
+
+def _count_rows(works_batches, stage):
+    """
+    Passes batches through, adding their rows to the rows in of stage
+    """
+    stage['rows_in'] = 0
+    for works_df in works_batches:
+        stage['rows_in'] += len(works_df)
+        yield works_df
+
+
+def process_works_batch(works_df, tag_lookup, return_works_tags_df=False):
+    """
+    Explodes and partially aggregates one batch of works
+    :param works_df: A DataFrame with work info, one row per work
+    :type works_df: pandas Dataframe
+    :param tag_lookup: Lookup built from the standardized tags
+    :type tag_lookup: TagLookup
+    :param return_works_tags_df: Whether or not to return the exploded batch
+    :type return_works_tags_df: bool
+    :return:
+        - One row per tag per work if return_works_tags_df, otherwise None
+        - Outputs of partially_aggregate_works_tags_df
+    :rtype:
+        - pandas DataFrame
+        - pandas DataFrame
+        - pandas DataFrame
+    """
+    works_tags_df = explode_works_tags(works_df, tag_lookup)
+    works_with_fandom, tags_partial = partially_aggregate_works_tags_df(
+        works_tags_df
+    )
+    if not return_works_tags_df:
+        works_tags_df = None
+    return works_tags_df, works_with_fandom, tags_partial
+
+
+# Set once per worker process so the lookup is not pickled with every batch
+_worker_tag_lookup = None
+
+
+def _set_worker_tag_lookup(tag_lookup):
+    global _worker_tag_lookup
+    _worker_tag_lookup = tag_lookup
+
+
+def _process_works_batch_in_worker(works_df, return_works_tags_df, instrument):
+    """
+    Processes a batch in a pool worker. If instrument, its stages are measured
+        in the worker and returned with the batch for the parent's report
+    """
+    if not instrument:
+        return (
+            process_works_batch(
+                works_df, _worker_tag_lookup, return_works_tags_df
+            ),
+            None,
+        )
+    with RunReport() as report:
+        batch_result = process_works_batch(
+            works_df, _worker_tag_lookup, return_works_tags_df
+        )
+    return batch_result, report.stages
+
+
+def _merge_worker_stages(worker_results):
+    """
+    Passes the batches of the workers through, adding the stages measured in
+        the workers to the open report
+    """
+    for batch_result, stages in worker_results:
+        if stages:
+            merge_stages(stages)
+        yield batch_result
+
+
+def _imap_bounded(pool, func, iterable, max_pending):
+    """
+    Like Pool.imap, but stops reading from iterable while max_pending tasks
+        are outstanding, so batches are not all read into memory up front
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def save_aggregates(
+    non_fandom_tags_agg,
+    works_with_fandom,
+    fandom_works_count,
+    relationships_by_month,
+):
+    """
+    Saves the outputs of aggregate_works_tags_df where the app loads them from,
+        along with the character pairs and top relationships, the word count
+        summaries, the monthly works and relationships and the work sketches
+        of each fandom, and the fandom x tag weights and most similar fandoms
+    :param non_fandom_tags_agg: One row per fandom per non-fandom tag
+    :type non_fandom_tags_agg: pandas DataFrame
+    :param works_with_fandom: One row per work per fandom
+    :type works_with_fandom: pandas DataFrame
+    :param fandom_works_count: One row per fandom with count of works
+    :type fandom_works_count: pandas DataFrame
+    :param relationships_by_month: One row per fandom per relationship per
+        month with count of works
+    :type relationships_by_month: pandas DataFrame
+    :return: None
+    :rtype: None
+    """
+    save_data_partitioned_by_fandom(
         non_fandom_tags_agg, NON_FANDOM_TAGS_AGG_LOC
     )
-    save_data_to_parquet(
+    save_data_partitioned_by_fandom(
         works_with_fandom, WORKS_WITH_FANDOM_LOC
     )
     save_data_to_parquet(
         fandom_works_count, FANDOM_WORKS_COUNT_LOC
     )
-    if flag_save_works_tags_df:
-        save_data_to_parquet(
-            works_tags_df, WORKS_TAGS_PARQUET
+    logger.info('Building character pairs')
+    with instrument_stage(
+        'character_pairs', rows_in=len(non_fandom_tags_agg)
+    ) as stage:
+        character_pairs, characters = set_output(
+            stage, build_character_pairs(non_fandom_tags_agg)
+        )
+    save_data_partitioned_by_fandom(
+        use_efficient_dtypes(character_pairs), CHARACTER_PAIRS_LOC
+    )
+    save_data_to_parquet(characters, CHARACTERS_LOC)
+    with instrument_stage(
+        'top_relationships', rows_in=len(non_fandom_tags_agg)
+    ) as stage:
+        top_relationships = set_output(
+            stage,
+            build_top_relationships(non_fandom_tags_agg, fandom_works_count),
+        )
+    save_data_to_parquet(
+        use_efficient_dtypes(top_relationships), TOP_RELATIONSHIPS_LOC
+    )
+    logger.info('Summarizing word counts')
+    with instrument_stage(
+        'word_count_summaries', rows_in=len(works_with_fandom)
+    ) as stage:
+        word_count_histograms, word_count_sketches = set_output(
+            stage, build_word_count_summaries(works_with_fandom)
+        )
+    save_data_partitioned_by_fandom(
+        use_efficient_dtypes(word_count_histograms),
+        WORD_COUNT_HISTOGRAMS_LOC,
+    )
+    save_data_partitioned_by_fandom(
+        use_efficient_dtypes(word_count_sketches), WORD_COUNT_SKETCHES_LOC
+    )
+    logger.info('Counting works per month')
+    with instrument_stage(
+        'monthly_works', rows_in=len(works_with_fandom)
+    ) as stage:
+        monthly_works = set_output(
+            stage, build_monthly_works(works_with_fandom)
+        )
+    save_data_partitioned_by_fandom(
+        use_efficient_dtypes(monthly_works), MONTHLY_WORKS_LOC
+    )
+    with instrument_stage(
+        'monthly_relationships', rows_in=len(relationships_by_month)
+    ) as stage:
+        monthly_relationships = set_output(
+            stage,
+            build_monthly_relationships(
+                relationships_by_month, non_fandom_tags_agg, fandom_works_count
+            ),
         )
+    save_data_partitioned_by_fandom(
+        use_efficient_dtypes(monthly_relationships),
+        MONTHLY_RELATIONSHIPS_LOC,
+    )
+    logger.info('Sketching works')
+    with instrument_stage(
+        'work_sketches', rows_in=len(works_with_fandom)
+    ) as stage:
+        work_sketches = set_output(
+            stage, build_work_sketches(works_with_fandom)
+        )
+    save_data_partitioned_by_fandom(
+        use_efficient_dtypes(work_sketches), WORK_SKETCHES_LOC
+    )
+    if MONTHLY_WORK_SKETCHES:
+        with instrument_stage(
+            'monthly_work_sketches', rows_in=len(works_with_fandom)
+        ) as stage:
+            monthly_work_sketches = set_output(
+                stage, build_work_sketches(works_with_fandom, by_month=True)
+            )
+        save_data_partitioned_by_fandom(
+            use_efficient_dtypes(monthly_work_sketches),
+            MONTHLY_WORK_SKETCHES_LOC,
+        )
+    else:
+        # Left from a run with them on, they would no longer match the data
+        for location in [
+            MONTHLY_WORK_SKETCHES_LOC,
+            fandom_index_location(MONTHLY_WORK_SKETCHES_LOC),
+        ]:
+            if os.path.exists(location):
+                os.remove(location)
+    logger.info('Building fandom similarities')
+    with instrument_stage(
+        'fandom_tag_weights', rows_in=len(non_fandom_tags_agg)
+    ) as stage:
+        fandom_tag_weights = set_output(
+            stage, build_fandom_tag_weights(non_fandom_tags_agg)
+        )
+    save_data_to_parquet(
+        use_efficient_dtypes(fandom_tag_weights), FANDOM_TAG_WEIGHTS_LOC
+    )
+    with instrument_stage(
+        'similar_fandoms', rows_in=len(fandom_tag_weights)
+    ) as stage:
+        similar_fandoms = set_output(
+            stage, build_similar_fandoms(fandom_tag_weights)
+        )
+    save_data_to_parquet(
+        use_efficient_dtypes(similar_fandoms), SIMILAR_FANDOMS_LOC
+    )
     return None
 
 
 def save_data_to_parquet(df, file_location):
-    df.to_parquet(file_location, **TO_PARQUET_CONFIG)
+    with instrument_stage('save_parquet', rows_in=len(df)) as stage:
+        df.to_parquet(file_location, **TO_PARQUET_CONFIG)
+        set_output_files(stage, [file_location])
     logger.info(f'Data saved to {file_location}')
     return None
 
 
+def save_data_partitioned_by_fandom(
+    df, file_location, row_group_size=FANDOM_ROW_GROUP_SIZE
+):
+    """
+    Saves data sorted by fandom as parquet, with row groups that never split
+        a fandom unless it is the only fandom in them, along with an index of
+        the rows of each fandom (see retrieve_fandom_rows in utils)
+    :param df: DataFrame with fandom_name as the first index level, sorted
+    :type df: pandas DataFrame
+    :param file_location: Location of the parquet file
+    :type file_location: str
+    :param row_group_size: Number of rows after which a row group is closed at
+        the next fandom boundary
+    :type row_group_size: int
+    :return: None
+    :rtype: None
+    """
+    with instrument_stage('save_parquet', rows_in=len(df)) as stage:
+        _save_data_partitioned_by_fandom(df, file_location, row_group_size)
+        set_output_files(
+            stage, [file_location, fandom_index_location(file_location)]
+        )
+    logger.info(f'Data saved to {file_location}, partitioned by fandom')
+    return None
+
+
+def _save_data_partitioned_by_fandom(df, file_location, row_group_size):
+    fandom_codes, fandom_names = pd.factorize(
+        df.index.get_level_values('fandom_name')
+    )
+    fandom_starts = np.flatnonzero(np.diff(fandom_codes, prepend=-1) != 0)
+    fandom_ends = np.append(fandom_starts[1:], len(df))
+    # Close a row group at the first fandom boundary past row_group_size
+    row_group_starts = [0]
+    for fandom_end in fandom_ends[:-1]:
+        if fandom_end - row_group_starts[-1] >= row_group_size:
+            row_group_starts.append(fandom_end)
+    row_group_starts = np.array(row_group_starts)
+    row_group_ends = np.append(row_group_starts[1:], len(df))
+    table = pa.Table.from_pandas(df)
+    with pq.ParquetWriter(
+        file_location, table.schema, **TO_PARQUET_CONFIG
+    ) as writer:
+        for start, end in zip(row_group_starts, row_group_ends):
+            writer.write_table(
+                table.slice(start, end - start), row_group_size=end - start
+            )
+    row_group_of_start = (
+        np.searchsorted(row_group_starts, fandom_starts, side='right') - 1
+    )
+    row_group_of_end = np.searchsorted(row_group_starts, fandom_ends)
+    fandom_index = pd.DataFrame(
+        {
+            'row_group_start': row_group_of_start,
+            'row_group_end': row_group_of_end,
+            'offset': fandom_starts - row_group_starts[row_group_of_start],
+            'length': fandom_ends - fandom_starts,
+        },
+        index=pd.Index(
+            np.asarray(fandom_names[fandom_codes[fandom_starts]]),
+            name='fandom_name',
+        ),
+    )
+    fandom_index.to_parquet(
+        fandom_index_location(file_location), **TO_PARQUET_CONFIG
+    )
+    return None
+
+
 def generate_works_tags_df(works_df, tags_df):
     """
     Explodes works_df to one row per tag per work, retrieves the names
@@ -86,35 +722,127 @@ def generate_works_tags_df(works_df, tags_df):
     """
     # Standardize non-canonical tags
     logger.info('Standardizing non-canonical tags')
-    cols_to_coalesce = ['type', 'name', 'canonical']
-    tags_df_merger = standardize_tags(tags_df, cols_to_coalesce)
-    # Retrieve work tags
-    logger.debug('Splitting tags into a list')
-    works_df['tags_list'] = works_df['tags'].str.strip().str.split('+')
+    tags_df_merger = standardize_tags(tags_df, TAGS_COLUMNS_TO_COALESCE)
+    return explode_works_tags(works_df, TagLookup(tags_df_merger))
+
+
+class TagLookup:
+    """
+    Dense lookup table from tag id to standardized tag information, so tags
+        can be retrieved by array indexing instead of a merge
+    """
+    def __init__(self, tags_df_merger):
+        """
+        :param tags_df_merger: Standardized tags, output of standardize_tags
+        :type tags_df_merger: pandas DataFrame
+        """
+        tag_ids = tags_df_merger.index.to_numpy(dtype=np.int64)
+        self.columns = list(tags_df_merger.columns)
+        self.values = {
+            col: tags_df_merger[col].to_numpy() for col in self.columns
+        }
+        # Filter on integer codes rather than comparing strings per tag
+        type_codes, type_uniques = pd.factorize(tags_df_merger['type_final'])
+        name_codes, name_uniques = pd.factorize(tags_df_merger['name_final'])
+        keep_type_codes = np.flatnonzero(
+            pd.Index(type_uniques).isin(TAG_TYPES_TO_KEEP)
+        )
+        redacted_codes = np.flatnonzero(pd.Index(name_uniques) == 'Redacted')
+        keep = np.isin(type_codes, keep_type_codes) & ~np.isin(
+            name_codes, redacted_codes
+        )
+        size = tag_ids.max() + 1 if len(tag_ids) else 0
+        self.row_by_tag_id = np.full(size, -1, dtype=np.int64)
+        self.row_by_tag_id[tag_ids] = np.arange(len(tag_ids))
+        self.keep_by_tag_id = np.zeros(size, dtype=bool)
+        self.keep_by_tag_id[tag_ids] = keep
+
+    def keep(self, tag_ids):
+        """
+        Whether tags should be kept (known, a type in TAG_TYPES_TO_KEEP and
+            not redacted)
+        :param tag_ids: Array of tag ids
+        :type tag_ids: numpy array
+        :return: Boolean array, one entry per tag id
+        :rtype: numpy array
+        """
+        in_range = (tag_ids >= 0) & (tag_ids < len(self.keep_by_tag_id))
+        keep = np.zeros(len(tag_ids), dtype=bool)
+        keep[in_range] = self.keep_by_tag_id[tag_ids[in_range]]
+        return keep
+
+    def take(self, tag_ids):
+        """
+        Retrieves standardized tag information. All tag ids must be known
+        :param tag_ids: Array of tag ids
+        :type tag_ids: numpy array
+        :return: Dictionary of column name to array of values
+        :rtype: dict
+        """
+        rows = self.row_by_tag_id[tag_ids]
+        return {col: self.values[col][rows] for col in self.columns}
+
+
+def parse_tag_ids(tags):
+    """
+    Parses '+'-separated tag id strings into one flat integer array without
+        creating a string per tag
+    :param tags: Series of '+'-separated tag ids, one row per work
+    :type tags: pandas Series
+    :return:
+        - Tag ids of all works, concatenated
+        - Number of tag ids per work (0 for works without tags)
+    :rtype:
+        - numpy array
+        - numpy array
+    """
+    tags_arrow = pa.array(tags, type=pa.string(), from_pandas=True)
+    tags_lists = pc.split_pattern(pc.utf8_trim_whitespace(tags_arrow), '+')
+    tags_num = pc.list_value_length(tags_lists).fill_null(0)
+    tag_ids = pc.cast(pc.list_flatten(tags_lists), pa.int64())
+    return (
+        tag_ids.to_numpy(),
+        tags_num.to_numpy().astype(np.int64),
+    )
+
+
+def explode_works_tags(works_df, tag_lookup):
+    """
+    Explodes works_df to one row per tag per work and attaches the
+        standardized tag information
+    :param works_df: A DataFrame with work info, one row per work
+    :type works_df: pandas Dataframe
+    :param tag_lookup: Lookup built from the standardized tags
+    :type tag_lookup: TagLookup
+    :return: A DataFrame with one row per tag per work
+    :rtype: pandas DataFrame
+    """
     logger.info('Exploding works')
-    works_tags_df = (
-        works_df.drop(
-            labels=[
-                'tags',
-                'Unnamed: 6',
-                'restricted',
-                'complete',
-                'language',
-            ],
-            axis=1,
-        )
-        .explode('tags_list')
-        .reset_index()
-        .rename(columns={'tags_list': 'tag_id', 'index': 'work_id'})
+    with instrument_stage('explode', rows_in=len(works_df)) as stage:
+        return set_output(
+            stage, _explode_works_tags(works_df, tag_lookup)
+        )
+
+
+def _explode_works_tags(works_df, tag_lookup):
+    # Retrieve work tags
+    logger.debug('Parsing tag ids')
+    tag_ids, tags_num = parse_tag_ids(works_df['tags'])
+    work_positions = np.repeat(np.arange(len(works_df)), tags_num)
+    keep = tag_lookup.keep(tag_ids)
+    tag_ids = tag_ids[keep]
+    work_positions = work_positions[keep]
+    works_df = works_df.drop(
+        labels=WORKS_COLUMNS_TO_DROP, axis=1, errors='ignore'
     )
-    works_tags_df['tag_id'] = works_tags_df['tag_id'].fillna(-999).astype(int)
-    works_tags_df = works_tags_df.merge(
-        tags_df_merger, how='left', left_on='tag_id', right_index=True
+    works_tags_df = pd.DataFrame(
+        {'work_id': works_df.index.to_numpy()[work_positions]}
     )
-    works_tags_df = works_tags_df.loc[
-        works_tags_df['type_final'].isin(TAG_TYPES_TO_KEEP)
-    ]
-    works_tags_df = works_tags_df.query('name_final != "Redacted"').copy()
+    for col in works_df.columns:
+        works_tags_df[col] = works_df[col].to_numpy()[work_positions]
+    works_tags_df['tag_id'] = tag_ids
+    for col, values in tag_lookup.take(tag_ids).items():
+        works_tags_df[col] = values
     return works_tags_df
 
 
@@ -131,17 +859,130 @@ def aggregate_works_tags_df(works_tags_df, minimum_work_count):
         - One row per fandom per non-fandom tag with count of works
         - One row per work per fandom
         - One row per fandom with count of works
+        - One row per fandom per relationship per month with count of works
     :rtype:
         - pandas DataFrame
         - pandas DataFrame
         - pandas DataFrame
+        - pandas DataFrame
+    """
+    works_with_fandom, tags_partial = partially_aggregate_works_tags_df(
+        works_tags_df
+    )
+    return finalize_partial_aggregates(
+        works_with_fandom, tags_partial, minimum_work_count
+    )
+
+
+def partially_aggregate_works_tags_df(works_tags_df):
     """
+    Aggregates works_tags_df into partial aggregates that can be merged with
+        those of other batches. All tags of a work must be in the same batch
+    :param works_tags_df: A DataFrame with one row per tag per work
+    :type works_tags_df: pandas DataFrame
+    :return:
+        - One row per work per fandom, for all fandoms
+        - One row per fandom per non-fandom tag (per creation month for tags
+            of TAG_MONTHLY_TYPES) with count of works and the sum and count
+            of word counts
+    :rtype:
+        - pandas DataFrame
+        - pandas DataFrame
+    """
+    with instrument_stage(
+        'partially_aggregate', rows_in=len(works_tags_df)
+    ) as stage:
+        return set_output(
+            stage, _partially_aggregate_works_tags_df(works_tags_df)
+        )
+
+
+def _partially_aggregate_works_tags_df(works_tags_df):
     works_with_fandom = works_tags_df.query('type_final == "Fandom"')[
         ['work_id', 'name_final', 'word_count', 'creation date']
     ]
     works_with_fandom = works_with_fandom.rename(
         columns={'name_final': 'fandom_name'}
     ).drop_duplicates()
+    works_tags_df_no_fandom = works_tags_df.query(
+        'type_final != "Fandom"'
+    ).drop(columns='tag_id')
+    works_tags_df_no_fandom = works_tags_df_no_fandom.drop_duplicates()
+    works_tags_df_no_fandom = works_tags_df_no_fandom.merge(
+        works_with_fandom[['work_id', 'fandom_name']],
+        how='inner',
+        on='work_id',
+    )
+    works_tags_df_no_fandom['creation_month'] = np.where(
+        works_tags_df_no_fandom['type_final'].isin(TAG_MONTHLY_TYPES),
+        creation_month_ordinals(works_tags_df_no_fandom['creation date']),
+        NO_CREATION_MONTH,
+    )
+    tags_partial = (
+        works_tags_df_no_fandom.groupby(by=TAG_GROUPBY_LIST)
+        .agg(**TAG_PARTIAL_AGG)
+    )
+    return works_with_fandom, tags_partial
+
+
+def merge_partial_tag_aggs(tags_partials):
+    """
+    Merges partial tag aggregates from partially_aggregate_works_tags_df
+    :param tags_partials: List of partial tag aggregates. None entries are
+        ignored
+    :type tags_partials: list
+    :return: One row per fandom per non-fandom tag with count of works and the
+        sum and count of word counts
+    :rtype: pandas DataFrame
+    """
+    tags_partials = [df for df in tags_partials if df is not None]
+    if len(tags_partials) == 1:
+        return tags_partials[0]
+    with instrument_stage(
+        'merge_partial_aggregates',
+        rows_in=sum(len(df) for df in tags_partials),
+    ) as stage:
+        return set_output(
+            stage,
+            pd.concat(tags_partials).groupby(level=TAG_GROUPBY_LIST).sum(),
+        )
+
+
+def finalize_partial_aggregates(
+    works_with_fandom, tags_partial, minimum_work_count
+):
+    """
+    Applies the minimum work count to partial aggregates and turns them into
+        the final outputs
+    :param works_with_fandom: One row per work per fandom, for all fandoms
+    :type works_with_fandom: pandas DataFrame
+    :param tags_partial: Partial tag aggregates
+    :type tags_partial: pandas DataFrame
+    :param minimum_work_count: Minimum number of works a fandom must have to be
+     included in analysis
+    :type minimum_work_count: int
+    :return: Same outputs as aggregate_works_tags_df
+    :rtype:
+        - pandas DataFrame
+        - pandas DataFrame
+        - pandas DataFrame
+        - pandas DataFrame
+    """
+    with instrument_stage(
+        'finalize_aggregates',
+        rows_in=len(works_with_fandom) + len(tags_partial),
+    ) as stage:
+        return set_output(
+            stage,
+            _finalize_partial_aggregates(
+                works_with_fandom, tags_partial, minimum_work_count
+            ),
+        )
+
+
+def _finalize_partial_aggregates(
+    works_with_fandom, tags_partial, minimum_work_count
+):
     fandom_works_count = (
         works_with_fandom.groupby(by='fandom_name')
         .count()['work_id']
@@ -156,23 +997,33 @@ def aggregate_works_tags_df(works_tags_df, minimum_work_count):
             fandom_works_count['fandom_name']
         )
     ]
-    works_tags_df_no_fandom = works_tags_df.query(
-        'type_final != "Fandom"'
-    ).drop(columns='tag_id')
-    works_tags_df_no_fandom = works_tags_df_no_fandom.drop_duplicates()
-    works_tags_df_no_fandom = works_tags_df_no_fandom.merge(
-        works_with_fandom[['work_id', 'fandom_name']],
-        how='inner',
-        on='work_id',
-    )
+    tags_partial = tags_partial.reset_index()
+    tags_partial = tags_partial.loc[
+        tags_partial['fandom_name'].isin(fandom_works_count['fandom_name'])
+    ]
+    is_relationship_month = (
+        tags_partial['creation_month'] != NO_CREATION_MONTH
+    ) & (tags_partial['type_final'] == 'Relationship')
+    relationships_by_month = tags_partial.loc[
+        is_relationship_month,
+        ['fandom_name', 'name_final', 'creation_month', 'works_num'],
+    ].reset_index(drop=True)
+    relationships_by_month['creation_month'] = pd.PeriodIndex(
+        ordinal=relationships_by_month['creation_month'], freq='M'
+    ).to_timestamp()
+    # Months of tags counted per month are added back up
     non_fandom_tags_agg = (
-        works_tags_df_no_fandom.groupby(by=TAG_GROUPBY_LIST)
-        .agg(TAG_GROUPBY_AGG)
+        tags_partial.drop(columns='creation_month')
+        .groupby(['fandom_name', 'name_final', 'type_final'], observed=True)
+        .sum()
         .reset_index()
     )
-    non_fandom_tags_agg.rename(
-        columns={'work_id': 'works_num', 'word_count': 'word_count_mean'},
-        inplace=True,
+    non_fandom_tags_agg['word_count_mean'] = (
+        non_fandom_tags_agg['word_count_sum']
+        / non_fandom_tags_agg['word_count_n']
+    )
+    non_fandom_tags_agg.drop(
+        columns=['word_count_sum', 'word_count_n'], inplace=True
     )
     works_with_fandom = works_with_fandom.set_index(
         ['fandom_name', 'work_id']
@@ -186,13 +1037,36 @@ def aggregate_works_tags_df(works_tags_df, minimum_work_count):
     non_fandom_tags_agg = use_efficient_dtypes(non_fandom_tags_agg)
     works_with_fandom = use_efficient_dtypes(works_with_fandom)
     fandom_works_count = use_efficient_dtypes(fandom_works_count)
-    return non_fandom_tags_agg, works_with_fandom, fandom_works_count
+    relationships_by_month = use_efficient_dtypes(relationships_by_month)
+    return (
+        non_fandom_tags_agg,
+        works_with_fandom,
+        fandom_works_count,
+        relationships_by_month,
+    )
 
 
 def use_efficient_dtypes(df_u):
-    df = df_u.copy()
+    """
+    Downcasts numeric columns and dictionary encodes fandom and tag names, so
+        each name is stored once with integer codes per row. Index levels are
+        converted too
+    :param df_u: DataFrame to convert
+    :type df_u: pandas DataFrame
+    :return: Converted copy of df_u
+    :rtype: pandas DataFrame
+    """
+    with instrument_stage('use_efficient_dtypes', rows_in=len(df_u)) as stage:
+        return set_output(stage, _use_efficient_dtypes(df_u))
+
+
+def _use_efficient_dtypes(df_u):
+    index_names = [name for name in df_u.index.names if name is not None]
+    df = df_u.reset_index() if index_names else df_u.copy()
     for col in df.columns:
-        if pd.api.types.is_integer_dtype(df[col]):
+        if col in DICTIONARY_ENCODED_COLUMNS:
+            df[col] = df[col].astype('category')
+        elif pd.api.types.is_integer_dtype(df[col]):
             df[col] = pd.to_numeric(df[col], downcast='integer')
         elif pd.api.types.is_float_dtype(df[col]):
             df[col] = pd.to_numeric(df[col], downcast='float')
@@ -203,13 +1077,16 @@ def use_efficient_dtypes(df_u):
             df[col] = pd.to_datetime(df[col], infer_datetime_format=True)
         elif pd.api.types.is_object_dtype(df[col]):
             df[col] = df[col].astype('string[pyarrow]')
+    if index_names:
+        df = df.set_index(index_names)
     return df
 
 
 def standardize_tags(tags_df, cols_to_coalesce):
     """
     Standardizes tags by retrieving canonical tag information for non-canonical
-        tags that have a canonical equivalent
+        tags that have a canonical equivalent. Merger chains (A merged into B,
+        B merged into C) are followed to their end
     :param tags_df: A DataFrame with tag info, one row per tag
     :type tags_df: pandas DataFrame
     :param cols_to_coalesce: A list of columns in tags_df for which to retrieve
@@ -218,27 +1095,81 @@ def standardize_tags(tags_df, cols_to_coalesce):
     :return: A DataFrame with standardized fields listed in cols_to_coalesce
     :rtype: pandas DataFrame
     """
-    tags_df_std = tags_df.merge(
-        tags_df,
-        how='left',
-        left_on='merger_id',
-        right_index=True,
-        suffixes=['_orig', '_merg'],
-        validate='many_to_one',
+    with instrument_stage('standardize_tags', rows_in=len(tags_df)) as stage:
+        return set_output(
+            stage, _standardize_tags(tags_df, cols_to_coalesce)
+        )
+
+
+def _standardize_tags(tags_df, cols_to_coalesce):
+    final_rows = resolve_merger_rows(
+        tags_df.index.to_numpy(dtype=np.int64),
+        tags_df['merger_id'].to_numpy(dtype=float),
     )
-    cols_final = []
+    tags_df_std = pd.DataFrame(index=tags_df.index)
     for col in cols_to_coalesce:
-        tags_df_std[f'{col}_final'] = tags_df_std[f'{col}_merg'].combine_first(
-            tags_df_std[f'{col}_orig']
+        values = tags_df[col]
+        merged_values = pd.Series(
+            values.to_numpy()[final_rows], index=tags_df.index
+        )
+        # Keep the tag's own value where the final tag's is missing
+        tags_df_std[f'{col}_final'] = merged_values.where(
+            merged_values.notna(), values
         )
-        cols_final.append(f'{col}_final')
+    return tags_df_std
 
-    tags_df_std = tags_df_std[cols_final].copy()
 
-    return tags_df_std
+def resolve_merger_rows(tag_ids, merger_ids):
+    """
+    Finds the row of the tag each tag is ultimately merged into, by pointer
+        jumping over a dense array of rows. Tags without a merger, or merged
+        into a tag that does not exist, resolve to themselves. Tags in (or
+        merged into) a merger cycle also resolve to themselves
+    :param tag_ids: Tag ids, one per row
+    :type tag_ids: numpy array
+    :param merger_ids: Id of the tag each tag is merged into, NaN if none
+    :type merger_ids: numpy array
+    :return: Row of the final tag, one per row
+    :rtype: numpy array
+    """
+    rows = np.arange(len(tag_ids))
+    size = tag_ids.max() + 1 if len(tag_ids) else 0
+    row_by_tag_id = np.full(size, -1, dtype=np.int64)
+    row_by_tag_id[tag_ids] = rows
+    has_merger = (
+        ~np.isnan(merger_ids) & (merger_ids >= 0) & (merger_ids < size)
+    )
+    parent = rows.copy()
+    parent[has_merger] = row_by_tag_id[merger_ids[has_merger].astype(np.int64)]
+    parent[parent == -1] = rows[parent == -1]
+    merger_parent = parent.copy()
+    # Each pass doubles the distance jumped, so chains of any length resolve
+    # in log2(number of tags) passes
+    for _ in range(int(np.ceil(np.log2(max(len(rows), 2)))) + 1):
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+    # Chains must end at a tag that is not merged into anything
+    in_cycle = merger_parent[parent] != parent
+    if in_cycle.any():
+        logger.warning(
+            f'{in_cycle.sum()} tags are in or merged into a merger cycle, '
+            f'leaving them unmerged'
+        )
+        parent[in_cycle] = rows[in_cycle]
+    return parent
 
 
 if __name__ == '__main__':
-    # This took 40 minutes to run....
+    # This took 40 minutes to run in one go....
     # Mostly because exploding works took 30 minutes
-    preprocess_data()
+    preprocess_data(
+        chunksize=WORKS_CSV_CHUNKSIZE,
+        processes=PREPROCESS_PROCESSES,
+        checkpoint_directory=CHECKPOINT_DIRECTORY,
+        report_location=os.path.join(
+            RUN_REPORT_DIRECTORY,
+            f'{pd.Timestamp.now():%Y%m%d_%H%M%S}.json',
+        ),
+    )
@@ -0,0 +1,593 @@
+import argparse
+import collections
+import functools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from arrow_store import fandom_row_ranges
+from fandom_similarity import FANDOM_SIMILARITY_K, FandomSimilarityIndex
+from monthly_works import fandom_active_months, roll_up_monthly_works
+from name_search import (
+    NAME_SEARCH_PAGE_SIZE,
+    build_fandom_search_index,
+    build_tag_search_index,
+)
+from utils import (
+    logger,
+    fandom_index_location,
+    read_fandom_rows,
+    FANDOM_TAG_WEIGHTS_LOC,
+    FANDOM_WORKS_COUNT_LOC,
+    MONTHLY_WORK_SKETCHES_LOC,
+    MONTHLY_WORKS_LOC,
+    NON_FANDOM_TAGS_AGG_LOC,
+    SIMILAR_FANDOMS_LOC,
+    WORD_COUNT_HISTOGRAMS_LOC,
+    WORD_COUNT_SKETCHES_LOC,
+    WORK_SKETCHES_LOC,
+    WORKS_WITH_FANDOM_LOC,
+)
+from word_counts import word_count_histogram_mean, word_count_sketch_quantile
+from work_sketches import ExactWorkCounter, WorkSketchIndex
+
+QUERY_SERVICE_HOST = '127.0.0.1'
+QUERY_SERVICE_PORT = 8600
+QUERY_SERVICE_WORKERS = 16
+# Responses kept, by path and query string
+QUERY_SERVICE_CACHE_SIZE = 4096
+# Latencies kept per endpoint for the percentiles in /metrics
+QUERY_SERVICE_LATENCY_WINDOW = 10000
+# Keep-alive connections idle for this many seconds are closed, freeing
+# their worker
+QUERY_SERVICE_IDLE_TIMEOUT = 5
+# Endpoint of each tag type
+QUERY_SERVICE_TAG_ENDPOINTS = {
+    'top_relationships': 'Relationship',
+    'top_freeform_tags': 'Freeform',
+}
+QUERY_SERVICE_FANDOM_ENDPOINTS = [
+    'works_count',
+    *QUERY_SERVICE_TAG_ENDPOINTS,
+    'word_count',
+    'monthly_works',
+    'similar_fandoms',
+]
+QUERY_SERVICE_DEFAULT_K = 10
+# Largest page of search results
+QUERY_SERVICE_MAX_LIMIT = 100
+QUERY_SERVICE_QUANTILES = [0.25, 0.5, 0.75, 0.9, 0.99]
+
+
+class QueryError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class FandomQueryIndex:
+    """
+    Preprocessed outputs held in memory with the rows of each fandom located
+        up front, so a query slices its fandom without searching
+    """
+    def __init__(self):
+        fandom_works_count = pd.read_parquet(FANDOM_WORKS_COUNT_LOC)
+        self.works_num = {
+            str(fandom_name): int(works_num)
+            for fandom_name, works_num in fandom_works_count[
+                'works_num'
+            ].items()
+        }
+        self.fandom_names = sorted(
+            self.works_num, key=self.works_num.get, reverse=True
+        )
+        non_fandom_tags_agg = pd.read_parquet(NON_FANDOM_TAGS_AGG_LOC)
+        self.search_indexes = {
+            'fandoms': build_fandom_search_index(fandom_works_count),
+            'tags': build_tag_search_index(non_fandom_tags_agg),
+        }
+        # Sorted so the top tags of a fandom and type are its first rows
+        tags = non_fandom_tags_agg.reset_index()
+        tag_types = list(QUERY_SERVICE_TAG_ENDPOINTS.values())
+        tags = (
+            tags.loc[tags['type_final'].isin(tag_types)]
+            .astype({'fandom_name': str, 'type_final': str, 'name_final': str})
+            .sort_values(
+                ['fandom_name', 'type_final', 'works_num'],
+                ascending=[True, True, False],
+                kind='stable',
+            )
+            .reset_index(drop=True)
+        )
+        self.tags = tags[['name_final', 'works_num', 'word_count_mean']]
+        self.tag_rows = fandom_row_ranges(
+            pd.MultiIndex.from_frame(tags[['fandom_name', 'type_final']])
+        )
+        self.tables = {}
+        self.table_rows = {}
+        for table_name, location in [
+            ('word_count_histograms', WORD_COUNT_HISTOGRAMS_LOC),
+            ('word_count_sketches', WORD_COUNT_SKETCHES_LOC),
+            ('monthly_works', MONTHLY_WORKS_LOC),
+        ]:
+            table = pd.read_parquet(location)
+            self.table_rows[table_name] = {
+                str(fandom_name): rows
+                for fandom_name, rows in fandom_row_ranges(
+                    table.index.get_level_values('fandom_name')
+                ).items()
+            }
+            self.tables[table_name] = table.droplevel('fandom_name')
+        # Up to FANDOM_SIMILARITY_K similar fandoms are precomputed, larger k
+        # are computed from the fandom x tag matrix
+        similar_fandoms = pd.read_parquet(SIMILAR_FANDOMS_LOC)
+        self.similar_fandom_rows = {
+            str(fandom_name): rows
+            for fandom_name, rows in fandom_row_ranges(
+                similar_fandoms['fandom_name']
+            ).items()
+        }
+        self.similar_fandoms_table = similar_fandoms[
+            ['similar_fandom_name', 'similarity']
+        ]
+        self.similarity = FandomSimilarityIndex(
+            pd.read_parquet(FANDOM_TAG_WEIGHTS_LOC)
+        )
+        self.work_sketches = WorkSketchIndex(
+            pd.read_parquet(WORK_SKETCHES_LOC),
+            pd.read_parquet(MONTHLY_WORK_SKETCHES_LOC)
+            if os.path.exists(MONTHLY_WORK_SKETCHES_LOC) else None,
+        )
+        # Works are only read by exact queries, from the row groups of their
+        # fandoms
+        works_index = pd.read_parquet(
+            fandom_index_location(WORKS_WITH_FANDOM_LOC)
+        )
+        self.exact_work_counter = ExactWorkCounter(
+            lambda fandom_name: read_fandom_rows(
+                WORKS_WITH_FANDOM_LOC, works_index, fandom_name
+            ).droplevel('fandom_name')
+        )
+        logger.info(f'Query index loaded with {len(self.works_num)} fandoms')
+
+    def fandom_rows(self, table_name, fandom_name):
+        # A fandom may have no rows in a table, e.g. no works with a word
+        # count
+        start, end = self.table_rows[table_name].get(fandom_name, (0, 0))
+        return self.tables[table_name].iloc[start:end]
+
+    def fandoms(self, limit=None):
+        """
+        :return: Fandoms with their number of works, most works first
+        :rtype: list
+        """
+        return [
+            {
+                'fandom_name': fandom_name,
+                'works_num': self.works_num[fandom_name],
+            }
+            for fandom_name in self.fandom_names[:limit]
+        ]
+
+    def search(self, query, kind, offset=0, limit=NAME_SEARCH_PAGE_SIZE):
+        """
+        :param kind: Names searched, 'fandoms' or 'tags'
+        :type kind: str
+        :return: Page of the names matching the query with most works first,
+            and whether there are more, see NameSearchIndex.search
+        :rtype: dict
+        """
+        if kind not in self.search_indexes:
+            raise ValueError(
+                f'kind must be one of {list(self.search_indexes)}, got {kind}'
+            )
+        results, has_more = self.search_indexes[kind].search(
+            query, offset, limit
+        )
+        return {'results': results, 'has_more': has_more}
+
+    def crossover(self, fandom_names, start=None, end=None, exact=False):
+        """
+        :param fandom_names: Names of the fandoms
+        :type fandom_names: list
+        :param start: First date of the works counted, see
+            WorkSketchIndex.union_count
+        :type start: str
+        :param end: Date after the works counted
+        :type end: str
+        :param exact: Whether to count from the work ids rather than the
+            sketches, which reads the works of the fandoms
+        :type exact: bool
+        :return: Number of works in any and in all of the fandoms
+        :rtype: dict
+        """
+        counter = self.exact_work_counter if exact else self.work_sketches
+        return {
+            'fandoms': fandom_names,
+            'union': round(counter.union_count(fandom_names, start, end)),
+            'intersection': round(
+                counter.intersection_count(fandom_names, start, end)
+            ),
+            'exact': exact,
+        }
+
+    def works_count(self, fandom_name):
+        return {
+            'fandom_name': fandom_name,
+            'works_num': self.works_num[fandom_name],
+        }
+
+    def top_tags(self, fandom_name, tag_type, k=QUERY_SERVICE_DEFAULT_K):
+        """
+        :return: The k tags of tag_type with most works in the fandom
+        :rtype: list
+        """
+        start, end = self.tag_rows.get((fandom_name, tag_type), (0, 0))
+        top = self.tags.iloc[start:min(end, start + k)]
+        return [
+            {
+                'name': name,
+                'works_num': int(works_num),
+                'word_count_mean': (
+                    None if np.isnan(mean) else round(float(mean), 1)
+                ),
+            }
+            for name, works_num, mean in zip(
+                top['name_final'], top['works_num'], top['word_count_mean']
+            )
+        ]
+
+    def similar_fandoms(self, fandom_name, k=QUERY_SERVICE_DEFAULT_K):
+        """
+        :return: The k fandoms with the most similar tags, see
+            build_fandom_tag_weights. Read from the similar fandoms of
+            preprocess_data unless k is above FANDOM_SIMILARITY_K
+        :rtype: list
+        """
+        if k <= FANDOM_SIMILARITY_K:
+            start, end = self.similar_fandom_rows.get(fandom_name, (0, 0))
+            top = self.similar_fandoms_table.iloc[start:min(start + k, end)]
+            most_similar = zip(
+                top['similar_fandom_name'].astype(str),
+                top['similarity'].astype(float),
+            )
+        else:
+            most_similar = self.similarity.most_similar(fandom_name, k)
+        return [
+            {'fandom_name': similar_fandom_name, 'similarity': round(s, 4)}
+            for similar_fandom_name, s in most_similar
+        ]
+
+    def word_count_stats(self, fandom_name):
+        """
+        :return: Mean word count (exact) and quantiles (within 1%), None if
+            no work of the fandom has a word count
+        :rtype: dict
+        """
+        histogram = self.fandom_rows('word_count_histograms', fandom_name)
+        sketch = self.fandom_rows(
+            'word_count_sketches', fandom_name
+        ).reset_index()
+        has_word_counts = not histogram.empty
+        return {
+            'fandom_name': fandom_name,
+            'works_num': int(histogram['works_num'].sum()),
+            'mean': (
+                round(float(word_count_histogram_mean(histogram)), 1)
+                if has_word_counts else None
+            ),
+            'quantiles': {
+                str(quantile): (
+                    round(
+                        float(word_count_sketch_quantile(sketch, quantile)), 1
+                    )
+                    if has_word_counts else None
+                )
+                for quantile in QUERY_SERVICE_QUANTILES
+            },
+        }
+
+    def monthly_works(self, fandom_name, freq=None):
+        """
+        :param freq: Pandas frequency to roll months up to, e.g. 'YS'
+        :type freq: str
+        :return: Works created per month, or per period of freq
+        :rtype: list
+        """
+        monthly_works = fandom_active_months(
+            self.fandom_rows('monthly_works', fandom_name)
+        )
+        if freq is not None:
+            monthly_works = roll_up_monthly_works(monthly_works, freq)
+        return [
+            {'period': period.strftime('%Y-%m-%d'), 'works_num': int(n)}
+            for period, n in monthly_works['works_num'].items()
+        ]
+
+
+class LatencyMetrics:
+    """
+    Number of requests and recent latencies of each endpoint
+    """
+    def __init__(self, window=QUERY_SERVICE_LATENCY_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=self.window)
+        )
+        self._counts = collections.Counter()
+        self._errors = collections.Counter()
+
+    def record(self, endpoint, seconds, status):
+        with self._lock:
+            self._latencies[endpoint].append(seconds)
+            self._counts[endpoint] += 1
+            if status >= 400:
+                self._errors[endpoint] += 1
+
+    def summary(self):
+        """
+        :return: Endpoint to number of requests and errors, and p50 and p99
+            latency in milliseconds over the recent requests
+        :rtype: dict
+        """
+        with self._lock:
+            latencies = {
+                endpoint: np.array(values) * 1000
+                for endpoint, values in self._latencies.items()
+            }
+            counts = dict(self._counts)
+            errors = dict(self._errors)
+        return {
+            endpoint: {
+                'requests': counts[endpoint],
+                'errors': errors.get(endpoint, 0),
+                'p50_ms': round(float(np.percentile(values, 50)), 3),
+                'p99_ms': round(float(np.percentile(values, 99)), 3),
+            }
+            for endpoint, values in latencies.items()
+        }
+
+
+class QueryService:
+    """
+    Routes requests to the index and caches the serialized responses
+    """
+    def __init__(self, index, cache_size=QUERY_SERVICE_CACHE_SIZE):
+        self.index = index
+        self.metrics = LatencyMetrics()
+        self.respond = functools.lru_cache(maxsize=cache_size)(self._respond)
+
+    def handle(self, url):
+        """
+        :param url: Path and query string of the request
+        :type url: str
+        :return: Status, endpoint name and JSON body
+        :rtype: tuple
+        """
+        start = time.perf_counter()
+        split_url = urlsplit(url)
+        # Sorted, so the same query in another order hits the cache
+        query = tuple(sorted(parse_qsl(split_url.query)))
+        if split_url.path == '/metrics':
+            status, endpoint, body = 200, 'metrics', json.dumps(
+                {
+                    'endpoints': self.metrics.summary(),
+                    'cache': self.respond.cache_info()._asdict(),
+                }
+            ).encode()
+        else:
+            try:
+                status, endpoint, body = self.respond(split_url.path, query)
+            except Exception:
+                # Not cached, unlike the other responses
+                logger.exception(f'Failed to answer {url}')
+                endpoint, _ = self._endpoint(split_url.path)
+                status = 500
+                body = json.dumps({'error': 'Internal error'}).encode()
+        self.metrics.record(endpoint, time.perf_counter() - start, status)
+        return status, endpoint, body
+
+    @staticmethod
+    def _endpoint(path):
+        """
+        :param path: Path of the request
+        :type path: str
+        :return: Name of the endpoint and the unquoted parts of the path
+        :rtype: tuple
+        """
+        parts = [unquote(part) for part in path.strip('/').split('/')]
+        if parts in (['fandoms'], ['search'], ['crossover']):
+            return parts[0], parts
+        if (
+            len(parts) == 3 and parts[0] == 'fandoms'
+            and parts[2] in QUERY_SERVICE_FANDOM_ENDPOINTS
+        ):
+            return parts[2], parts
+        # One name for all unknown paths, so they do not add up in metrics
+        return 'unknown', parts
+
+    def _respond(self, path, query):
+        endpoint, parts = self._endpoint(path)
+        try:
+            params = dict(query)
+            if endpoint == 'fandoms':
+                response = self._fandoms(params)
+            elif endpoint == 'search':
+                response = self._search(params)
+            elif endpoint == 'crossover':
+                response = self._crossover(query, params)
+            elif endpoint != 'unknown':
+                fandom_name = parts[1]
+                if fandom_name not in self.index.works_num:
+                    raise QueryError(404, f'Unknown fandom {fandom_name}')
+                response = self._fandom_query(fandom_name, endpoint, params)
+            else:
+                raise QueryError(404, f'Unknown path {path}')
+        except QueryError as e:
+            return e.status, endpoint, json.dumps({'error': str(e)}).encode()
+        except ValueError as e:
+            return 400, endpoint, json.dumps({'error': str(e)}).encode()
+        return 200, endpoint, json.dumps(response).encode()
+
+    def _fandoms(self, params):
+        # All fandoms without a limit
+        if 'limit' not in params:
+            return self.index.fandoms()
+        limit = int(params['limit'])
+        if not 0 < limit <= QUERY_SERVICE_MAX_LIMIT:
+            raise ValueError(
+                f'limit must be from 1 to {QUERY_SERVICE_MAX_LIMIT}, got '
+                f'{limit}'
+            )
+        return self.index.fandoms(limit)
+
+    def _search(self, params):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', NAME_SEARCH_PAGE_SIZE))
+        if offset < 0 or not 0 < limit <= QUERY_SERVICE_MAX_LIMIT:
+            raise ValueError(
+                f'offset must not be negative and limit must be from 1 to '
+                f'{QUERY_SERVICE_MAX_LIMIT}, got {offset} and {limit}'
+            )
+        return self.index.search(
+            params.get('q', ''), params.get('kind', 'fandoms'), offset, limit
+        )
+
+    def _crossover(self, query, params):
+        # Fandoms are repeated, so they are taken from the query rather than
+        # params
+        fandom_names = [value for key, value in query if key == 'fandom']
+        if not fandom_names:
+            raise ValueError('At least one fandom is needed')
+        for fandom_name in fandom_names:
+            if fandom_name not in self.index.works_num:
+                raise QueryError(404, f'Unknown fandom {fandom_name}')
+        return self.index.crossover(
+            fandom_names,
+            params.get('start'),
+            params.get('end'),
+            params.get('exact', '0') == '1',
+        )
+
+    def _fandom_query(self, fandom_name, endpoint, params):
+        if endpoint == 'works_count':
+            return self.index.works_count(fandom_name)
+        if endpoint in QUERY_SERVICE_TAG_ENDPOINTS or (
+            endpoint == 'similar_fandoms'
+        ):
+            k = int(params.get('k', QUERY_SERVICE_DEFAULT_K))
+            if k < 0:
+                raise ValueError(f'k must not be negative, got {k}')
+            if endpoint == 'similar_fandoms':
+                return self.index.similar_fandoms(fandom_name, k)
+            return self.index.top_tags(
+                fandom_name, QUERY_SERVICE_TAG_ENDPOINTS[endpoint], k
+            )
+        if endpoint == 'word_count':
+            return self.index.word_count_stats(fandom_name)
+        return self.index.monthly_works(fandom_name, params.get('freq'))
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    # Keeps connections open between requests
+    protocol_version = 'HTTP/1.1'
+    timeout = QUERY_SERVICE_IDLE_TIMEOUT
+    # Headers and body are written separately, which would otherwise wait on
+    # the client's delayed acknowledgement of the headers (about 40 ms)
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        status, _, body = self.server.service.handle(self.path)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Latencies are in /metrics rather than one log line per request
+        return None
+
+
+class QueryServer(ThreadingHTTPServer):
+    """
+    HTTP server handing connections to a fixed pool of threads, rather than a
+        new thread per connection
+    """
+    def __init__(self, address, service, workers=QUERY_SERVICE_WORKERS):
+        super().__init__(address, QueryRequestHandler)
+        self.service = service
+        self.executor = ThreadPoolExecutor(workers)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(
+            self.process_request_thread, request, client_address
+        )
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+def serve(
+    host=QUERY_SERVICE_HOST,
+    port=QUERY_SERVICE_PORT,
+    workers=QUERY_SERVICE_WORKERS,
+    cache_size=QUERY_SERVICE_CACHE_SIZE,
+):
+    """
+    Loads the index and answers queries until interrupted. Endpoints:
+        - /fandoms?limit=
+        - /fandoms/<fandom>/works_count
+        - /fandoms/<fandom>/top_relationships?k=
+        - /fandoms/<fandom>/top_freeform_tags?k=
+        - /fandoms/<fandom>/word_count
+        - /fandoms/<fandom>/monthly_works?freq=
+        - /fandoms/<fandom>/similar_fandoms?k=
+        - /search?q=&kind=fandoms|tags&offset=&limit=
+        - /crossover?fandom=&fandom=&start=&end=&exact=0|1
+        - /metrics
+    Fandom names are URL encoded
+    :param host: Address to listen on
+    :type host: str
+    :param port: Port to listen on
+    :type port: int
+    :param workers: Number of threads answering queries
+    :type workers: int
+    :param cache_size: Number of responses cached
+    :type cache_size: int
+    :return: None
+    :rtype: None
+    """
+    service = QueryService(FandomQueryIndex(), cache_size)
+    with QueryServer((host, port), service, workers) as server:
+        logger.info(f'Serving queries on http://{host}:{port}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve the preprocessed data as JSON'
+    )
+    parser.add_argument('--host', default=QUERY_SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=QUERY_SERVICE_PORT)
+    parser.add_argument(
+        '--workers', type=int, default=QUERY_SERVICE_WORKERS
+    )
+    parser.add_argument(
+        '--cache-size', type=int, default=QUERY_SERVICE_CACHE_SIZE
+    )
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.cache_size)
@@ -0,0 +1,292 @@
+import functools
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+RELATIONSHIP_SEPARATOR_LU = {'romantic': '/', 'platonic': '&'}
+CHARACTER_COLUMN_NAMES = ['char_1', 'char_2']
+CHARACTER_PAIR_COLUMN_NAMES = ['char_a_id', 'char_b_id']
+CHARACTER_FANDOM_PATTERN = re.compile(r' \(.+\)')
+CHARACTER_NAME_CACHE_SIZE = 2 ** 20
+TOP_RELATIONSHIPS_K = 10
+
+
+def classify_relationships(relationship_names):
+    """
+    Classifies relationships as romantic or platonic by their separator
+    :param relationship_names: Relationship names
+    :type relationship_names: pandas Series
+    :return: Relationship type of each relationship
+    :rtype: numpy array
+    """
+    relationship_conditions = [
+        np.array(relationship_names.str.contains(split), dtype=bool)
+        for split in RELATIONSHIP_SEPARATOR_LU.values()
+    ]
+    return np.select(
+        relationship_conditions,
+        [rel_type for rel_type in RELATIONSHIP_SEPARATOR_LU],
+    )
+
+
+def split_relationships(relationship_names, separator):
+    """
+    Splits relationships into the characters in them
+    :param relationship_names: Relationship names
+    :type relationship_names: pandas Series
+    :param separator: Separator of the characters
+    :type separator: str
+    :return:
+        - Characters of all relationships, concatenated
+        - Number of characters per relationship
+    :rtype:
+        - numpy array
+        - numpy array
+    """
+    names = pa.array(
+        relationship_names.to_numpy(dtype=object), type=pa.string()
+    )
+    characters = pc.split_pattern(names, separator)
+    return (
+        pc.list_flatten(characters).to_numpy(zero_copy_only=False),
+        pc.list_value_length(characters).to_numpy().astype(np.int64),
+    )
+
+
+def character_pair_positions(chars_num):
+    """
+    Finds every pair of characters within each relationship, as positions in
+        the concatenated characters of split_relationships. Pairs of a
+        relationship come in the order of itertools.combinations
+    Relationships with the same number of characters are paired in one go, so
+        the work is per distinct number of characters rather than per
+        relationship
+    :param chars_num: Number of characters per relationship
+    :type chars_num: numpy array
+    :return:
+        - Position of the relationship of each pair
+        - Position of the first character of each pair
+        - Position of the second character of each pair
+    :rtype:
+        - numpy array
+        - numpy array
+        - numpy array
+    """
+    offsets = np.concatenate([[0], np.cumsum(chars_num)[:-1]])
+    relationship_positions = [np.empty(0, dtype=np.int64)]
+    firsts = [np.empty(0, dtype=np.int64)]
+    seconds = [np.empty(0, dtype=np.int64)]
+    for chars in np.unique(chars_num[chars_num >= 2]):
+        relationships = np.flatnonzero(chars_num == chars)
+        first, second = np.triu_indices(chars, 1)
+        starts = offsets[relationships][:, None]
+        relationship_positions.append(np.repeat(relationships, len(first)))
+        firsts.append((starts + first).ravel())
+        seconds.append((starts + second).ravel())
+    relationship_positions = np.concatenate(relationship_positions)
+    # Back to the order of the relationships
+    order = np.argsort(relationship_positions, kind='stable')
+    return (
+        relationship_positions[order],
+        np.concatenate(firsts)[order],
+        np.concatenate(seconds)[order],
+    )
+
+
+def encode_character_names(characters):
+    """
+    Cleans up character names and encodes them as integer ids. Each distinct
+        raw name is only cleaned once
+    :param characters: Raw character names, e.g. ' Gamora (Marvel)'
+    :type characters: numpy array
+    :return:
+        - Id of each character
+        - Clean character names, indexed by id, in alphabetical order
+    :rtype:
+        - numpy array
+        - numpy array
+    """
+    raw_ids, raw_names = pd.factorize(characters)
+    clean_ids, character_names = pd.factorize(
+        np.array(
+            [clean_character_name(name) for name in raw_names], dtype=object
+        ),
+        sort=True,
+    )
+    return (
+        clean_ids[raw_ids],
+        np.asarray(character_names, dtype=object),
+    )
+
+
+@functools.lru_cache(maxsize=CHARACTER_NAME_CACHE_SIZE)
+def clean_character_name(name):
+    """
+    Cleans up a character name so ' Gamora (Marvel)' becomes 'Gamora'
+    :param name: Raw character name
+    :type name: str
+    :return: Clean character name
+    :rtype: str
+    """
+    return CHARACTER_FANDOM_PATTERN.sub('', name.strip())
+
+
+def build_character_pairs(non_fandom_tags_agg):
+    """
+    Splits the relationships of every fandom into character pairs, so the
+        chord chart does not parse relationships when a fandom is picked
+    Pairs are symmetrised: 'A/B' and 'B/A' are counted as one pair, with the
+        lower character id first
+    :param non_fandom_tags_agg: One row per fandom per non-fandom tag, output
+        of aggregate_works_tags_df
+    :type non_fandom_tags_agg: pandas DataFrame
+    :return:
+        - One row per fandom per relationship type per character pair with
+            count of works, indexed by fandom and sorted by count of works
+            (descending) within each fandom and relationship type
+        - One row per character with its name, indexed by character id.
+            Ids follow the alphabetical order of the names
+    :rtype:
+        - pandas DataFrame
+        - pandas DataFrame
+    """
+    is_relationship = (
+        non_fandom_tags_agg.index.get_level_values('type_final')
+        == 'Relationship'
+    )
+    relationships = (
+        non_fandom_tags_agg.loc[is_relationship, ['name_final', 'works_num']]
+        .droplevel('type_final')
+        .reset_index()
+    )
+    relationships['fandom_name'] = relationships['fandom_name'].astype(str)
+    relationships['relationship_type'] = classify_relationships(
+        relationships['name_final']
+    )
+    pairs_by_type = []
+    characters_by_type = []
+    characters_num = 0
+    # Characters of all types are encoded together so ids are shared
+    for rel_type, separator in RELATIONSHIP_SEPARATOR_LU.items():
+        rel_df = relationships.loc[
+            relationships['relationship_type'] == rel_type
+        ]
+        characters, chars_num = split_relationships(
+            rel_df['name_final'], separator
+        )
+        relationship_positions, char_1_positions, char_2_positions = (
+            character_pair_positions(chars_num)
+        )
+        pairs = rel_df.iloc[relationship_positions][
+            ['fandom_name', 'relationship_type', 'works_num']
+        ].reset_index(drop=True)
+        pairs[CHARACTER_COLUMN_NAMES[0]] = char_1_positions + characters_num
+        pairs[CHARACTER_COLUMN_NAMES[1]] = char_2_positions + characters_num
+        pairs_by_type.append(pairs)
+        characters_by_type.append(characters)
+        characters_num += len(characters)
+    pairs = pd.concat(pairs_by_type, ignore_index=True)
+    character_ids, character_names = encode_character_names(
+        np.concatenate(characters_by_type)
+    )
+    char_1_ids, char_2_ids = (
+        character_ids[pairs.pop(column).to_numpy()]
+        for column in CHARACTER_COLUMN_NAMES
+    )
+    pairs[CHARACTER_PAIR_COLUMN_NAMES[0]] = np.minimum(char_1_ids, char_2_ids)
+    pairs[CHARACTER_PAIR_COLUMN_NAMES[1]] = np.maximum(char_1_ids, char_2_ids)
+    character_pairs = (
+        pairs.groupby(
+            ['fandom_name', 'relationship_type', *CHARACTER_PAIR_COLUMN_NAMES]
+        )['works_num']
+        .sum()
+        .reset_index()
+        .sort_values(
+            ['fandom_name', 'relationship_type', 'works_num'],
+            ascending=[True, True, False],
+            kind='stable',
+        )
+        .set_index('fandom_name')
+    )
+    characters = pd.DataFrame(
+        {'character_name': character_names},
+        index=pd.RangeIndex(len(character_names), name='character_id'),
+    )
+    return character_pairs, characters
+
+
+def character_pair_matrix(character_pairs):
+    """
+    Builds a symmetric matrix of works per character pair from integer ids
+    :param character_pairs: Rows of build_character_pairs
+    :type character_pairs: pandas DataFrame
+    :return:
+        - Square matrix with count of works of each pair of characters
+        - Ids of the characters in the rows and columns of the matrix
+    :rtype:
+        - numpy array
+        - numpy array
+    """
+    character_ids, positions = np.unique(
+        character_pairs[CHARACTER_PAIR_COLUMN_NAMES].to_numpy(),
+        return_inverse=True,
+    )
+    positions = positions.reshape(-1, 2)
+    works_num = character_pairs['works_num'].to_numpy(dtype=float)
+    matrix = np.zeros((len(character_ids), len(character_ids)))
+    # Make it so the value of 'A/B' equals the value of 'B/A'
+    np.add.at(matrix, (positions[:, 0], positions[:, 1]), works_num)
+    np.add.at(matrix, (positions[:, 1], positions[:, 0]), works_num)
+    return matrix, character_ids
+
+
+def build_top_relationships(
+    non_fandom_tags_agg, fandom_works_count, k=TOP_RELATIONSHIPS_K
+):
+    """
+    Finds the k most popular relationships of every fandom with one sort over
+        all relationships. Ties are ranked in their order in
+        non_fandom_tags_agg, like rank(method='first')
+    :param non_fandom_tags_agg: One row per fandom per non-fandom tag, output
+        of aggregate_works_tags_df
+    :type non_fandom_tags_agg: pandas DataFrame
+    :param fandom_works_count: One row per fandom with count of works
+    :type fandom_works_count: pandas DataFrame
+    :param k: Number of relationships per fandom
+    :type k: int
+    :return: One row per fandom per top relationship with its rank (1 for the
+        most popular), count of works, count of works of the fandom and share
+        of the works of the fandom
+    :rtype: pandas DataFrame
+    """
+    is_relationship = (
+        non_fandom_tags_agg.index.get_level_values('type_final')
+        == 'Relationship'
+    )
+    relationships = (
+        non_fandom_tags_agg.loc[is_relationship, ['name_final', 'works_num']]
+        .droplevel('type_final')
+        .reset_index()
+    )
+    fandom_codes, _ = pd.factorize(relationships['fandom_name'])
+    works_num = relationships['works_num'].to_numpy()
+    order = np.lexsort((-works_num, fandom_codes))
+    fandom_codes = fandom_codes[order]
+    group_starts = np.flatnonzero(np.diff(fandom_codes, prepend=-1) != 0)
+    ranks = np.arange(len(order)) - np.repeat(
+        group_starts, np.diff(np.append(group_starts, len(order)))
+    )
+    top = relationships.iloc[order[ranks < k]].reset_index(drop=True)
+    # So the names of all tags are not carried along as unused categories
+    top = top.astype({'fandom_name': str, 'name_final': str})
+    top.insert(1, 'rank', ranks[ranks < k] + 1)
+    top['works_num_fandom_total'] = (
+        fandom_works_count['works_num']
+        .reindex(top['fandom_name'])
+        .to_numpy()
+    )
+    top['pct_of_fandom'] = top['works_num'] / top['works_num_fandom_total']
+    return top
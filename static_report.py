@@ -0,0 +1,382 @@
+import argparse
+import html
+import json
+import multiprocessing
+import os
+import re
+import time
+
+import pandas as pd
+from plotly.offline import get_plotlyjs
+
+from analyses.inter_fandom_analysis import InterFandomAnalysis
+from arrow_store import build_arrow_store
+from checkpoints import stage_key
+from chord_charts import (
+    CHORD_CHART_RELATIONSHIP_TYPES,
+    CHORD_CHART_STYLE,
+    CHORD_CHART_TOP_N,
+    retrieve_chord_chart,
+)
+from fandom import Fandom
+from utils import (
+    logger,
+    format_number,
+    ARROW_STORE_DIRECTORY,
+    ARROW_STORE_LOCS,
+    CHARACTER_PAIRS_LOC,
+    DATA_BACKEND,
+    CHARACTERS_LOC,
+    FANDOM_WORKS_COUNT_LOC,
+    MINIMUM_WORK_COUNT,
+    MONTHLY_WORKS_LOC,
+    NON_FANDOM_TAGS_AGG_LOC,
+    STATIC_REPORT_DIRECTORY,
+    TOP_RELATIONSHIPS_LOC,
+    WORD_COUNT_HISTOGRAMS_LOC,
+    WORD_COUNT_SKETCHES_LOC,
+)
+
+# Bump when the pages change, so fandoms rendered before are rendered again
+STATIC_REPORT_STYLE = 'static-report-v1'
+# Files the pages are drawn from. A fandom is rendered again when any changes
+STATIC_REPORT_DATA_LOCS = [
+    NON_FANDOM_TAGS_AGG_LOC,
+    FANDOM_WORKS_COUNT_LOC,
+    CHARACTER_PAIRS_LOC,
+    CHARACTERS_LOC,
+    WORD_COUNT_HISTOGRAMS_LOC,
+    WORD_COUNT_SKETCHES_LOC,
+    MONTHLY_WORKS_LOC,
+    TOP_RELATIONSHIPS_LOC,
+]
+STATIC_REPORT_MANIFEST_FILE = 'report.json'
+PLOTLY_JS_FILE = 'plotly.min.js'
+# Logged every this many fandoms
+STATIC_REPORT_PROGRESS_EVERY = 25
+STATIC_REPORT_PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<script src="{plotly_js}"></script>
+<style>
+body {{font-family: sans-serif; margin: 2em auto; max-width: 1200px;}}
+img {{max-width: 100%;}}
+td {{padding: 0 1em;}}
+</style>
+</head>
+<body>
+{body}
+</body>
+</html>
+'''
+
+
+def static_report_data_version():
+    """
+    Version of the data the report is drawn from, which changes whenever
+        preprocessing rewrites it
+    :return: Hex digest of the size and modification time of the data files
+    :rtype: str
+    """
+    return stage_key(
+        *[
+            (os.path.getsize(loc), os.stat(loc).st_mtime_ns)
+            for loc in STATIC_REPORT_DATA_LOCS
+        ]
+    )
+
+
+def fandom_report_directory(fandom_name, report_directory):
+    """
+    Directory of the pages of a fandom. Fandom names can hold any character,
+        so they are shortened to a readable prefix and a hash
+    :param fandom_name: Name of the fandom
+    :type fandom_name: str
+    :param report_directory: Directory of the report
+    :type report_directory: str
+    :return: Directory of the fandom
+    :rtype: str
+    """
+    readable_name = re.sub(r'[^\w-]+', '_', fandom_name).strip('_')[:60]
+    return os.path.join(
+        report_directory,
+        'fandoms',
+        f'{readable_name}-{stage_key(fandom_name)[:8]}',
+    )
+
+
+def fandom_report_version(fandom_name, data_version, top_n):
+    """
+    Version of the pages of a fandom, from the data and settings they are
+        rendered with
+    :rtype: str
+    """
+    return stage_key(
+        fandom_name,
+        data_version,
+        top_n,
+        STATIC_REPORT_STYLE,
+        CHORD_CHART_STYLE,
+    )
+
+
+def is_fandom_report_up_to_date(fandom_name, report_directory, version):
+    """
+    Whether the pages of a fandom were rendered from the same data and
+        settings. The manifest is written last, so a fandom interrupted while
+        rendering is not up to date
+    :param fandom_name: Name of the fandom
+    :type fandom_name: str
+    :param report_directory: Directory of the report
+    :type report_directory: str
+    :param version: Output of fandom_report_version
+    :type version: str
+    :rtype: bool
+    """
+    manifest_location = os.path.join(
+        fandom_report_directory(fandom_name, report_directory),
+        STATIC_REPORT_MANIFEST_FILE,
+    )
+    if not os.path.exists(manifest_location):
+        return False
+    with open(manifest_location) as f:
+        return json.load(f).get('version') == version
+
+
+def generate_static_report(
+    processes=None,
+    minimum_work_count=MINIMUM_WORK_COUNT,
+    top_n=CHORD_CHART_TOP_N,
+    report_directory=STATIC_REPORT_DIRECTORY,
+    force=False,
+):
+    """
+    Renders the charts of the app as static pages: one page per fandom with
+        its chord charts, word count distribution and works over time, and an
+        index page with the inter-fandom chart and links to the fandoms.
+        Fandoms whose pages are up to date are skipped, so an interrupted run
+        resumes where it stopped
+    :param processes: Number of processes. Defaults to the number of CPUs
+    :type processes: int
+    :param minimum_work_count: Fandoms with more than this many works are
+        rendered, as in finalize_partial_aggregates
+    :type minimum_work_count: int
+    :param top_n: Number of character pairs in the chord charts
+    :type top_n: int
+    :param report_directory: Directory of the report
+    :type report_directory: str
+    :param force: Whether to render fandoms that are up to date
+    :type force: bool
+    :return: Number of fandoms rendered, skipped and failed, and fandoms
+        rendered per minute
+    :rtype: dict
+    """
+    if DATA_BACKEND == 'arrow':
+        # Converted here, so the workers only map the files
+        build_arrow_store(ARROW_STORE_LOCS, ARROW_STORE_DIRECTORY)
+    fandom_works_count = pd.read_parquet(FANDOM_WORKS_COUNT_LOC).reset_index()
+    fandom_works_count['fandom_name'] = fandom_works_count[
+        'fandom_name'
+    ].astype(str)
+    # Same as finalize_partial_aggregates
+    fandom_works_count = fandom_works_count.loc[
+        fandom_works_count['works_num'] > minimum_work_count
+    ].sort_values('works_num', ascending=False)
+    data_version = static_report_data_version()
+    tasks = []
+    for fandom_name, works_num in zip(
+        fandom_works_count['fandom_name'], fandom_works_count['works_num']
+    ):
+        version = fandom_report_version(fandom_name, data_version, top_n)
+        if force or not is_fandom_report_up_to_date(
+            fandom_name, report_directory, version
+        ):
+            tasks.append(
+                (fandom_name, works_num, version, top_n, report_directory)
+            )
+    skipped_num = len(fandom_works_count) - len(tasks)
+    logger.info(
+        f'Rendering {len(tasks)} of {len(fandom_works_count)} fandoms, '
+        f'{skipped_num} are up to date'
+    )
+    os.makedirs(report_directory, exist_ok=True)
+    with open(os.path.join(report_directory, PLOTLY_JS_FILE), 'w') as f:
+        f.write(get_plotlyjs())
+    start = time.perf_counter()
+    failed = {}
+    with multiprocessing.Pool(processes) as pool:
+        for i, (fandom_name, error) in enumerate(
+            pool.imap_unordered(_render_fandom_report, tasks)
+        ):
+            if error is not None:
+                failed[fandom_name] = error
+                logger.info(f'Failed to render {fandom_name}: {error}')
+            if (i + 1) % STATIC_REPORT_PROGRESS_EVERY == 0:
+                logger.info(
+                    f'Rendered {i + 1}/{len(tasks)} fandoms, '
+                    f'{fandoms_per_minute(i + 1, start):.1f} per minute'
+                )
+    rendered_num = len(tasks) - len(failed)
+    results = {
+        'rendered': rendered_num,
+        'skipped': skipped_num,
+        'failed': len(failed),
+        'fandoms_per_minute': round(
+            fandoms_per_minute(rendered_num, start), 1
+        ),
+    }
+    _write_index_page(
+        fandom_works_count.loc[
+            ~fandom_works_count['fandom_name'].isin(failed)
+        ],
+        report_directory,
+    )
+    logger.info(f'Static report written to {report_directory}: {results}')
+    return results
+
+
+def fandoms_per_minute(fandoms_num, start):
+    return fandoms_num / max(time.perf_counter() - start, 1e-9) * 60
+
+
+def _render_fandom_report(task):
+    """
+    Renders the pages of one fandom in a worker process
+    :return: Name of the fandom and the error if rendering failed
+    :rtype: tuple
+    """
+    fandom_name, works_num, version, top_n, report_directory = task
+    try:
+        fandom_directory = fandom_report_directory(
+            fandom_name, report_directory
+        )
+        os.makedirs(fandom_directory, exist_ok=True)
+        fandom = Fandom(fandom_name)
+        body = [
+            '<p><a href="../../index.html">All fandoms</a></p>',
+            f'<h1>{html.escape(fandom_name)}</h1>',
+            f'<p>We found <b>{format_number(works_num)}</b> works to '
+            f'analyze.</p>',
+            '<h2>Relationship Chord Chart</h2>',
+        ]
+        for relationship_type in CHORD_CHART_RELATIONSHIP_TYPES:
+            image_file = f'{relationship_type}.png'
+            with open(os.path.join(fandom_directory, image_file), 'wb') as f:
+                f.write(retrieve_chord_chart(fandom, relationship_type, top_n))
+            body.append(
+                f'<h3>{relationship_type.capitalize()}</h3>'
+                f'<img src="{image_file}" alt="{relationship_type}">'
+            )
+        (
+            fig_wc,
+            mean_word_count,
+            median_word_count,
+        ) = fandom.word_count_distribution()
+        body.extend(
+            [
+                '<h2>Word Count Distribution</h2>',
+                f'<p>Mean: {mean_word_count}, median: {median_word_count}'
+                f'</p>',
+                fig_wc.to_html(full_html=False, include_plotlyjs=False),
+                '<h2>Works Over Time</h2>',
+                fandom.year_month_distribution().to_html(
+                    full_html=False, include_plotlyjs=False
+                ),
+            ]
+        )
+        _write_file(
+            os.path.join(fandom_directory, 'index.html'),
+            _page(fandom_name, body, f'../../{PLOTLY_JS_FILE}'),
+        )
+        _write_file(
+            os.path.join(fandom_directory, STATIC_REPORT_MANIFEST_FILE),
+            json.dumps({'fandom_name': fandom_name, 'version': version}),
+        )
+    except Exception as e:
+        return fandom_name, repr(e)
+    return fandom_name, None
+
+
+def _write_index_page(fandom_works_count, report_directory):
+    most_popular = InterFandomAnalysis.retrieve_most_popular_relationships()
+    rows = []
+    for fandom_name, works_num in zip(
+        fandom_works_count['fandom_name'], fandom_works_count['works_num']
+    ):
+        fandom_page = os.path.relpath(
+            fandom_report_directory(fandom_name, report_directory),
+            report_directory,
+        )
+        rows.append(
+            f'<tr><td><a href="{fandom_page}/index.html">'
+            f'{html.escape(fandom_name)}</a></td>'
+            f'<td>{format_number(works_num)}</td></tr>'
+        )
+    body = [
+        '<h1>AO3 Data Visualizations</h1>',
+        '<h2>How popular is the most popular pairing in each fandom?</h2>',
+        InterFandomAnalysis.most_popular_relationship_scatter(
+            most_popular
+        ).to_html(full_html=False, include_plotlyjs=False),
+        '<h2>Fandoms</h2>',
+        '<table><tr><th>Fandom</th><th>Works</th></tr>',
+        *rows,
+        '</table>',
+    ]
+    _write_file(
+        os.path.join(report_directory, 'index.html'),
+        _page('AO3 Data Visualizations', body, PLOTLY_JS_FILE),
+    )
+    return None
+
+
+def _page(title, body, plotly_js):
+    return STATIC_REPORT_PAGE.format(
+        title=html.escape(title), plotly_js=plotly_js, body='\n'.join(body)
+    )
+
+
+def _write_file(location, content):
+    """
+    Writes a file aside and moves it into place, so readers of the report
+        never see a partial file
+    """
+    temporary_location = f'{location}.{os.getpid()}.tmp'
+    with open(temporary_location, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(temporary_location, location)
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Render the charts of every fandom as static pages'
+    )
+    parser.add_argument('--processes', type=int)
+    parser.add_argument(
+        '--minimum-work-count', type=int, default=MINIMUM_WORK_COUNT
+    )
+    parser.add_argument('--top-n', type=int, default=CHORD_CHART_TOP_N)
+    parser.add_argument(
+        '--report-directory', default=STATIC_REPORT_DIRECTORY
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Render fandoms whose pages are up to date',
+    )
+    args = parser.parse_args()
+    print(
+        json.dumps(
+            generate_static_report(
+                args.processes,
+                args.minimum_work_count,
+                args.top_n,
+                args.report_directory,
+                args.force,
+            ),
+            indent=2,
+        )
+    )
@@ -1,17 +1,55 @@
 import logging
+import os
 
 import pandas as pd
+import pyarrow.parquet as pq
 import streamlit as st
-import dask.dataframe as dd
+
+from arrow_store import (
+    ArrowStoreTable, arrow_store_location, convert_to_arrow_store,
+    is_arrow_store_stale
+)
+from name_search import build_fandom_search_index
 
 LOGGING_LEVEL = logging.INFO
 WORKS_CSV = 'not_added_to_git/ao3_official_dump_210321/works-20210226.csv'
 TAGS_CSV = 'not_added_to_git/ao3_official_dump_210321/tags-20210226.csv'
-WORKS_TAGS_PARQUET = 'not_added_to_git/preprocessed_works_tags.parquet.gzip'
+WORKS_TAGS_PARQUET = 'not_added_to_git/preprocessed_works_tags.parquet'
 DATA_DIRECTORY = 'data'
-WORKS_WITH_FANDOM_LOC = f'{DATA_DIRECTORY}/works_with_fandom.parquet.gzip'
-NON_FANDOM_TAGS_AGG_LOC = f'{DATA_DIRECTORY}/non_fandom_tags_agg.parquet.gzip'
-FANDOM_WORKS_COUNT_LOC = f'{DATA_DIRECTORY}/fandom_works_count.parquet.gzip'
+INCREMENTAL_STATE_DIRECTORY = 'not_added_to_git/incremental_state'
+CHECKPOINT_DIRECTORY = 'not_added_to_git/checkpoints'
+RUN_REPORT_DIRECTORY = 'not_added_to_git/run_reports'
+CHORD_CHART_CACHE_DIRECTORY = 'not_added_to_git/chord_charts'
+ARROW_STORE_DIRECTORY = 'not_added_to_git/arrow_store'
+STATIC_REPORT_DIRECTORY = 'not_added_to_git/static_report'
+WORKS_WITH_FANDOM_LOC = f'{DATA_DIRECTORY}/works_with_fandom.parquet'
+NON_FANDOM_TAGS_AGG_LOC = f'{DATA_DIRECTORY}/non_fandom_tags_agg.parquet'
+FANDOM_WORKS_COUNT_LOC = f'{DATA_DIRECTORY}/fandom_works_count.parquet'
+CHARACTER_PAIRS_LOC = f'{DATA_DIRECTORY}/character_pairs.parquet'
+CHARACTERS_LOC = f'{DATA_DIRECTORY}/characters.parquet'
+WORD_COUNT_HISTOGRAMS_LOC = (
+    f'{DATA_DIRECTORY}/word_count_histograms.parquet'
+)
+WORD_COUNT_SKETCHES_LOC = f'{DATA_DIRECTORY}/word_count_sketches.parquet'
+MONTHLY_WORKS_LOC = f'{DATA_DIRECTORY}/monthly_works.parquet'
+MONTHLY_RELATIONSHIPS_LOC = (
+    f'{DATA_DIRECTORY}/monthly_relationships.parquet'
+)
+TOP_RELATIONSHIPS_LOC = f'{DATA_DIRECTORY}/top_relationships.parquet'
+FANDOM_TAG_WEIGHTS_LOC = f'{DATA_DIRECTORY}/fandom_tag_weights.parquet'
+SIMILAR_FANDOMS_LOC = f'{DATA_DIRECTORY}/similar_fandoms.parquet'
+WORK_SKETCHES_LOC = f'{DATA_DIRECTORY}/work_sketches.parquet'
+MONTHLY_WORK_SKETCHES_LOC = f'{DATA_DIRECTORY}/monthly_work_sketches.parquet'
+# Whether preprocessing also sketches the works of each fandom per month, to
+# count distinct works over date ranges. Off by default, as the table has up
+# to one row per work per fandom, close to the size of works_with_fandom
+MONTHLY_WORK_SKETCHES = False
+# Outputs served from memory-mapped Arrow files by the 'arrow' data backend
+ARROW_STORE_LOCS = [
+    NON_FANDOM_TAGS_AGG_LOC,
+    WORKS_WITH_FANDOM_LOC,
+    FANDOM_WORKS_COUNT_LOC,
+]
 TAG_TYPES_TO_KEEP = [
     'Relationship',
     'Freeform',
@@ -20,9 +58,40 @@ TAG_TYPES_TO_KEEP = [
     'Fandom',
 ]
 MINIMUM_WORK_COUNT = 1000
-TAG_GROUPBY_LIST = ['fandom_name', 'name_final', 'type_final']
-TAG_GROUPBY_AGG = {'work_id': 'count', 'word_count': 'mean'}
-TO_PARQUET_CONFIG = {'compression': 'gzip'}
+# creation_month is a month ordinal (as in pandas Period) for tags of
+# TAG_MONTHLY_TYPES, so they can be counted over date ranges, and
+# NO_CREATION_MONTH for other tags and works without a creation date
+TAG_GROUPBY_LIST = [
+    'fandom_name', 'name_final', 'type_final', 'creation_month'
+]
+TAG_MONTHLY_TYPES = ['Relationship']
+NO_CREATION_MONTH = -1
+# Sums and counts (rather than means) so batches can be merged
+TAG_PARTIAL_AGG = {
+    'works_num': ('work_id', 'count'),
+    'word_count_sum': ('word_count', 'sum'),
+    'word_count_n': ('word_count', 'count'),
+}
+WORKS_CSV_CHUNKSIZE = 500000
+PREPROCESS_PROCESSES = os.cpu_count()
+# Stored as pandas categoricals, i.e. Arrow dictionary columns
+DICTIONARY_ENCODED_COLUMNS = [
+    'fandom_name', 'name_final', 'type_final', 'relationship_type',
+    'similar_fandom_name'
+]
+# zstd decompresses several times faster than gzip at a similar ratio
+TO_PARQUET_CONFIG = {'compression': 'zstd'}
+# 'parquet' reads the row groups of a fandom from the parquet files, 'arrow'
+# serves the outputs from the Arrow store, which is written under
+# ARROW_STORE_DIRECTORY on first use (see README)
+DATA_BACKEND = os.environ.get('DATA_BACKEND', 'parquet')
+# Memory budget of the Fandom objects kept across sessions by the app
+FANDOM_CACHE_MAX_BYTES = int(
+    os.environ.get('FANDOM_CACHE_MAX_BYTES', 512 * 2 ** 20)
+)
+# Fandom-level outputs are written in row groups of roughly this many rows,
+# split only at fandom boundaries
+FANDOM_ROW_GROUP_SIZE = 50000
 
 PX_TEMPLATE = 'ggplot2'
 PX_FONT_SIZE_AXES = 15
@@ -41,25 +110,126 @@ logger.addHandler(ch)
 logger.propagate = False
 
 
+@st.experimental_singleton
+def retrieve_arrow_store_table(file_location):
+    """
+    Opens the Arrow store copy of a parquet file, converting it first if it
+        is missing or older than the parquet file. Not memoized like the
+        other data, which would copy the table into every session
+    :param file_location: Location of the parquet file
+    :type file_location: str
+    :return: Memory-mapped table
+    :rtype: ArrowStoreTable
+    """
+    store_location = arrow_store_location(file_location, ARROW_STORE_DIRECTORY)
+    if is_arrow_store_stale(file_location, store_location):
+        logger.info(f'Converting {file_location} to {store_location}')
+        convert_to_arrow_store(file_location, store_location)
+    return ArrowStoreTable(store_location)
+
+
 @st.experimental_memo(ttl=60*60*6)
-def retrieve_preprocessed_data():
-    """
-    Loads previously saved preprocessed and aggregated data
-    :return:
-        - One row per fandom per non-fandom tag with count of works
-        - One row per work per fandom
-        - One row per fandom with count of works
-    :rtype:
-        - pandas DataFrame
-        - pandas DataFrame
-        - pandas DataFrame
-    """
-    logger.info('Loading previously preprocessed data')
-    non_fandom_tags_agg = dd.read_parquet(NON_FANDOM_TAGS_AGG_LOC)
-    works_with_fandom = dd.read_parquet(WORKS_WITH_FANDOM_LOC)
-    fandom_works_count = dd.read_parquet(FANDOM_WORKS_COUNT_LOC)
-    logger.info('Finished loading data')
-    return non_fandom_tags_agg, works_with_fandom, fandom_works_count
+def retrieve_top_relationships():
+    """
+    Loads the most popular relationships of each fandom, see
+        build_top_relationships
+    :return: One row per fandom per top relationship
+    :rtype: pandas DataFrame
+    """
+    return pd.read_parquet(TOP_RELATIONSHIPS_LOC)
+
+
+@st.experimental_singleton
+def retrieve_fandom_search_index():
+    """
+    Builds the search index over fandom names, once per process
+    :return: Index of the fandoms, see NameSearchIndex
+    :rtype: NameSearchIndex
+    """
+    logger.info('Building fandom search index')
+    return build_fandom_search_index(pd.read_parquet(FANDOM_WORKS_COUNT_LOC))
+
+
+def fandom_index_location(file_location):
+    """
+    Location of the index of fandom rows saved alongside a parquet file
+    :param file_location: Location of the parquet file
+    :type file_location: str
+    :return: Location of the fandom index
+    :rtype: str
+    """
+    return file_location.replace('.parquet', '_fandom_index.parquet')
+
+
+@st.experimental_memo(ttl=60*60*6)
+def retrieve_fandom_index(file_location):
+    """
+    Loads the index of fandom rows of a file saved with
+        save_data_partitioned_by_fandom
+    :param file_location: Location of the parquet file
+    :type file_location: str
+    :return: One row per fandom with the row groups holding its rows, and its
+        offset within the first of them and number of rows
+    :rtype: pandas DataFrame
+    """
+    return pd.read_parquet(fandom_index_location(file_location))
+
+
+def retrieve_fandom_rows(file_location, fandom_name):
+    """
+    Reads only the rows of one fandom from a file saved with
+        save_data_partitioned_by_fandom. With the 'arrow' data backend, files
+        in the Arrow store are sliced from its memory-mapped copy instead
+    :param file_location: Location of the parquet file
+    :type file_location: str
+    :param fandom_name: Name of the fandom
+    :type fandom_name: str
+    :return: Rows of the fandom, with the same index as the saved data. No
+        rows if the fandom has none in the file, e.g. no character pairs
+    :rtype: pandas DataFrame
+    """
+    if DATA_BACKEND == 'arrow' and file_location in ARROW_STORE_LOCS:
+        return retrieve_arrow_store_table(file_location).fandom_rows(
+            fandom_name
+        )
+    return read_fandom_rows(
+        file_location, retrieve_fandom_index(file_location), fandom_name
+    )
+
+
+def read_fandom_rows(file_location, fandom_index, fandom_name):
+    """
+    Reads only the rows of one fandom from a file saved with
+        save_data_partitioned_by_fandom, given its fandom index. Unlike
+        retrieve_fandom_rows, nothing is cached, so it can be used outside
+        the app
+    :param file_location: Location of the parquet file
+    :type file_location: str
+    :param fandom_index: Index of the fandom rows of the file, see
+        retrieve_fandom_index
+    :type fandom_index: pandas DataFrame
+    :param fandom_name: Name of the fandom
+    :type fandom_name: str
+    :return: Rows of the fandom, see retrieve_fandom_rows
+    :rtype: pandas DataFrame
+    """
+    if fandom_name not in fandom_index.index:
+        return pq.read_schema(file_location).empty_table().to_pandas()
+    rows = fandom_index.loc[fandom_name]
+    table = pq.ParquetFile(file_location).read_row_groups(
+        range(rows['row_group_start'], rows['row_group_end'])
+    )
+    return table.slice(rows['offset'], rows['length']).to_pandas()
+
+
+@st.experimental_memo(ttl=60*60*6)
+def retrieve_character_names():
+    """
+    Loads the names of the characters in character_pairs
+    :return: Character names, indexed by character id
+    :rtype: numpy array
+    """
+    return pd.read_parquet(CHARACTERS_LOC)['character_name'].to_numpy()
 
 
 def concat_data(file_locations, final_df):
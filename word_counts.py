@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+
+# Works are counted in bins of this many words, closed on the right like
+# pd.cut: [0, 100], (100, 200], ... Charts with bin boundaries that are
+# multiples of this are served exactly
+WORD_COUNT_BIN_WIDTH = 100
+# Word counts above this share the last bin
+WORD_COUNT_BIN_MAX = 1000000
+# Quantiles from the sketch are within this relative error of a word count in
+# the fandom
+WORD_COUNT_SKETCH_RELATIVE_ACCURACY = 0.01
+WORD_COUNT_SKETCH_GAMMA = (
+    (1 + WORD_COUNT_SKETCH_RELATIVE_ACCURACY)
+    / (1 - WORD_COUNT_SKETCH_RELATIVE_ACCURACY)
+)
+
+
+def word_count_bins(word_counts):
+    """
+    Fine bin of each word count
+    :param word_counts: Word counts, without missing values
+    :type word_counts: numpy array
+    :return: Bin of each word count
+    :rtype: numpy array
+    """
+    bins = np.ceil(word_counts / WORD_COUNT_BIN_WIDTH).astype(np.int64) - 1
+    return np.clip(bins, 0, WORD_COUNT_BIN_MAX // WORD_COUNT_BIN_WIDTH)
+
+
+def word_count_sketch_buckets(word_counts):
+    """
+    Bucket of each word count in a logarithmic quantile sketch (as in
+        DDSketch). Bucket i > 0 holds word counts in
+        (gamma ** (i - 2), gamma ** (i - 1)], bucket 0 holds word counts below
+        1. Sketches are merged by adding up the works in each bucket
+    :param word_counts: Word counts, without missing values
+    :type word_counts: numpy array
+    :return: Bucket of each word count
+    :rtype: numpy array
+    """
+    buckets = np.zeros(len(word_counts), dtype=np.int64)
+    positive = word_counts >= 1
+    buckets[positive] = np.ceil(
+        np.log(word_counts[positive]) / np.log(WORD_COUNT_SKETCH_GAMMA)
+    ).astype(np.int64) + 1
+    return buckets
+
+
+def build_word_count_summaries(works_with_fandom):
+    """
+    Summarizes the word counts of the works of every fandom, so the word count
+        chart does not need the works of the fandom
+    :param works_with_fandom: One row per work per fandom, output of
+        aggregate_works_tags_df
+    :type works_with_fandom: pandas DataFrame
+    :return:
+        - One row per fandom per fine bin with count of works and sum of word
+            counts, indexed by fandom and bin
+        - One row per fandom per sketch bucket with count of works, indexed by
+            fandom and bucket
+    :rtype:
+        - pandas DataFrame
+        - pandas DataFrame
+    """
+    word_counts = works_with_fandom['word_count']
+    has_word_count = word_counts.notna().to_numpy()
+    word_counts = word_counts.to_numpy(dtype=np.float64)[has_word_count]
+    fandom_names = works_with_fandom.index.get_level_values('fandom_name')[
+        has_word_count
+    ]
+    summaries_df = pd.DataFrame(
+        {
+            'fandom_name': fandom_names,
+            'word_count_bin': word_count_bins(word_counts),
+            'sketch_bucket': word_count_sketch_buckets(word_counts),
+            # Word counts are whole numbers, so the sums are exact
+            'word_count': word_counts.astype(np.int64),
+        }
+    )
+    word_count_histograms = summaries_df.groupby(
+        ['fandom_name', 'word_count_bin'], observed=True
+    ).agg(
+        works_num=('word_count', 'size'),
+        word_count_sum=('word_count', 'sum'),
+    )
+    word_count_sketches = (
+        summaries_df.groupby(['fandom_name', 'sketch_bucket'], observed=True)
+        .size()
+        .to_frame('works_num')
+    )
+    return word_count_histograms, word_count_sketches
+
+
+def rebin_word_count_histogram(word_count_histogram, bins):
+    """
+    Counts works in coarser bins by adding up fine bins
+    :param word_count_histogram: Fine bins of one fandom, from
+        build_word_count_summaries
+    :type word_count_histogram: pandas DataFrame
+    :param bins: Bin edges as used with pd.cut(include_lowest=True), ending in
+        np.inf
+    :type bins: list
+    :return: Count of works in each bin
+    :rtype: numpy array
+    """
+    edges = np.asarray(bins, dtype=np.float64)
+    fine_bins = word_count_histogram['word_count_bin'].to_numpy(np.int64)
+    # A fine bin falls in the coarse bin holding its lower edge
+    coarse_bins = (
+        np.searchsorted(edges, fine_bins * WORD_COUNT_BIN_WIDTH, side='right')
+        - 1
+    )
+    return np.bincount(
+        coarse_bins,
+        weights=word_count_histogram['works_num'].to_numpy(),
+        minlength=len(edges) - 1,
+    ).astype(np.int64)
+
+
+def word_count_histogram_mean(word_count_histogram):
+    """
+    Exact mean word count from fine bins
+    :param word_count_histogram: Fine bins of one fandom
+    :type word_count_histogram: pandas DataFrame
+    :return: Mean word count
+    :rtype: float
+    """
+    return (
+        word_count_histogram['word_count_sum'].sum()
+        / word_count_histogram['works_num'].sum()
+    )
+
+
+def word_count_sketch_quantile(word_count_sketch, quantile):
+    """
+    Estimates a word count quantile from a sketch, interpolating between the
+        works on either side of the quantile like pandas does
+    :param word_count_sketch: Sketch buckets of one fandom, from
+        build_word_count_summaries
+    :type word_count_sketch: pandas DataFrame
+    :param quantile: Quantile between 0 and 1, e.g. 0.5 for the median
+    :type quantile: float
+    :return: Estimated word count
+    :rtype: float
+    """
+    word_count_sketch = word_count_sketch.sort_values('sketch_bucket')
+    works_num = word_count_sketch['works_num'].to_numpy()
+    rank = quantile * (works_num.sum() - 1)
+    buckets = word_count_sketch['sketch_bucket'].to_numpy()[
+        np.searchsorted(
+            np.cumsum(works_num),
+            [np.floor(rank), np.ceil(rank)],
+            side='right',
+        )
+    ]
+    # Value within relative accuracy of every word count in the bucket
+    values = np.where(
+        buckets == 0,
+        0.0,
+        2 * WORD_COUNT_SKETCH_GAMMA ** (buckets - 1.0)
+        / (WORD_COUNT_SKETCH_GAMMA + 1),
+    )
+    return values[0] + (rank - np.floor(rank)) * (values[1] - values[0])
@@ -0,0 +1,376 @@
+import numpy as np
+import pandas as pd
+
+from arrow_store import fandom_row_ranges
+from monthly_works import creation_month_ordinals
+from utils import NO_CREATION_MONTH
+
+# Sketches have 2 ** precision registers, and distinct counts from them have
+# a relative standard error of about 1.04 / sqrt(2 ** precision), i.e. 1.6%
+WORK_SKETCH_PRECISION = 12
+# Intersections are estimated by inclusion-exclusion, from 2 ** n - 1 unions
+WORK_SKETCH_MAX_INTERSECTION = 8
+# 2 ** -rank of every rank a register can hold
+_INVERSE_POWERS = np.ldexp(1.0, -np.arange(65))
+
+
+def hash_work_ids(work_ids):
+    """
+    64-bit hash of each work id (splitmix64), so the bits of the hash are
+        uniformly distributed whatever the ids are
+    :param work_ids: Work ids
+    :type work_ids: numpy array
+    :return: Hashes
+    :rtype: numpy array of uint64
+    """
+    with np.errstate(over='ignore'):
+        h = np.asarray(work_ids).astype(np.uint64) + np.uint64(
+            0x9E3779B97F4A7C15
+        )
+        h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return h ^ (h >> np.uint64(31))
+
+
+def work_sketch_registers(work_ids, precision=WORK_SKETCH_PRECISION):
+    """
+    Register of each work in a HyperLogLog sketch and the rank it sets the
+        register to: the first bits of the hash pick the register, the rank
+        is the position of the first 1 in the other bits. A register holds
+        the largest rank of its works
+    :param work_ids: Work ids
+    :type work_ids: numpy array
+    :param precision: Bits of the hash picking the register
+    :type precision: int
+    :return:
+        - Register of each work
+        - Rank of each work, from 1 to 65 - precision
+    :rtype:
+        - numpy array
+        - numpy array
+    """
+    hashes = hash_work_ids(work_ids)
+    registers = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    rest = hashes << np.uint64(precision)
+    # Leading zeros of rest, by halving the bits searched
+    leading_zeros = np.zeros(len(hashes), dtype=np.int64)
+    for bits in [32, 16, 8, 4, 2, 1]:
+        is_zero = (rest >> np.uint64(64 - bits)) == 0
+        leading_zeros += np.where(is_zero, bits, 0)
+        rest = np.where(is_zero, rest << np.uint64(bits), rest)
+    ranks = np.minimum(leading_zeros, 64 - precision) + 1
+    return registers, ranks.astype(np.uint8)
+
+
+def build_work_sketches(
+    works_with_fandom, by_month=False, precision=WORK_SKETCH_PRECISION
+):
+    """
+    HyperLogLog sketch of the work ids of every fandom. Sketches are stored
+        sparsely, as registers without works are 0
+    :param works_with_fandom: One row per work per fandom, output of
+        aggregate_works_tags_df
+    :type works_with_fandom: pandas DataFrame
+    :param by_month: Whether to sketch the works created in each month of
+        each fandom rather than all works of each fandom. Works without a
+        creation date are left out
+    :type by_month: bool
+    :param precision: See work_sketch_registers
+    :type precision: int
+    :return: One row per fandom (per month) per register that is not 0 with
+        its rank, indexed by fandom (and month) and sorted
+    :rtype: pandas DataFrame
+    """
+    fandom_codes, fandom_names = pd.factorize(
+        works_with_fandom.index.get_level_values('fandom_name'), sort=True
+    )
+    registers, ranks = work_sketch_registers(
+        works_with_fandom.index.get_level_values('work_id').to_numpy(),
+        precision,
+    )
+    keys = [fandom_codes]
+    if by_month:
+        months = creation_month_ordinals(works_with_fandom['creation date'])
+        has_month = months != NO_CREATION_MONTH
+        fandom_codes, registers, ranks, months = (
+            fandom_codes[has_month],
+            registers[has_month],
+            ranks[has_month],
+            months[has_month],
+        )
+        keys = [fandom_codes, months]
+    # Sorted by sketch, register and rank, so the last row of each register
+    # has its largest rank
+    order = np.lexsort((ranks, registers, *reversed(keys)))
+    keys = [key[order] for key in keys]
+    registers, ranks = registers[order], ranks[order]
+    is_last = np.ones(len(order), dtype=bool)
+    is_last[:-1] = registers[1:] != registers[:-1]
+    for key in keys:
+        is_last[:-1] |= key[1:] != key[:-1]
+    index_levels = [np.asarray(fandom_names)[keys[0][is_last]]]
+    index_names = ['fandom_name']
+    if by_month:
+        index_levels.append(
+            pd.PeriodIndex(ordinal=keys[1][is_last], freq='M').to_timestamp()
+        )
+        index_names.append('creation_month')
+    return pd.DataFrame(
+        {
+            'register': registers[is_last].astype(np.int16),
+            'rank': ranks[is_last],
+        },
+        index=pd.MultiIndex.from_arrays(index_levels, names=index_names),
+    )
+
+
+def estimate_distinct_count(registers):
+    """
+    HyperLogLog estimate of the number of distinct works in a sketch, with
+        linear counting for small counts
+    :param registers: Dense registers of the sketch
+    :type registers: numpy array
+    :return: Estimated number of distinct works
+    :rtype: float
+    """
+    registers_num = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / registers_num)
+    registers_per_rank = np.bincount(registers, minlength=1)
+    estimate = alpha * registers_num ** 2 / (
+        registers_per_rank @ _INVERSE_POWERS[:len(registers_per_rank)]
+    )
+    zeros_num = registers_per_rank[0]
+    if estimate <= 2.5 * registers_num and zeros_num:
+        return registers_num * np.log(registers_num / zeros_num)
+    return float(estimate)
+
+
+class WorkSketchIndex:
+    """
+    Work sketches of all fandoms held in memory as one dense array of
+        registers per fandom. The sketch of the union of fandoms is the
+        elementwise maximum of theirs, so counts of unions and intersections
+        across fandoms take microseconds, within a few percent (see
+        WORK_SKETCH_PRECISION). Intersections much smaller than the fandoms
+        have larger relative errors, as they are differences of unions
+    """
+    def __init__(
+        self,
+        work_sketches,
+        monthly_work_sketches=None,
+        precision=WORK_SKETCH_PRECISION,
+    ):
+        """
+        :param work_sketches: Output of build_work_sketches
+        :type work_sketches: pandas DataFrame
+        :param monthly_work_sketches: Output of build_work_sketches by month,
+            needed to count works created in a date range
+        :type monthly_work_sketches: pandas DataFrame
+        :param precision: Precision the sketches were built with
+        :type precision: int
+        """
+        fandom_codes, fandom_names = pd.factorize(
+            work_sketches.index.get_level_values('fandom_name'), sort=True
+        )
+        self.fandom_ids = {
+            str(fandom_name): i for i, fandom_name in enumerate(fandom_names)
+        }
+        self.registers = np.zeros(
+            (len(fandom_names), 2 ** precision), dtype=np.uint8
+        )
+        self.registers[
+            fandom_codes, work_sketches['register'].to_numpy(np.int64)
+        ] = work_sketches['rank'].to_numpy(np.uint8)
+        self.monthly_work_sketches = monthly_work_sketches
+        if monthly_work_sketches is not None:
+            self.monthly_rows = {
+                str(fandom_name): rows
+                for fandom_name, rows in fandom_row_ranges(
+                    monthly_work_sketches.index.get_level_values(
+                        'fandom_name'
+                    )
+                ).items()
+            }
+            self.months = monthly_work_sketches.index.get_level_values(
+                'creation_month'
+            ).to_numpy(dtype='datetime64[ns]')
+            self.monthly_registers = monthly_work_sketches[
+                'register'
+            ].to_numpy(np.int64)
+            self.monthly_ranks = monthly_work_sketches['rank'].to_numpy(
+                np.uint8
+            )
+
+    def _fandom_registers(self, fandom_names, start, end):
+        """
+        Dense registers of the sketch of each fandom, of its works created
+            from start to end with a date range
+        :rtype: numpy array
+        """
+        fandom_ids = [
+            self.fandom_ids[fandom_name] for fandom_name in fandom_names
+        ]
+        if start is None and end is None:
+            return self.registers[fandom_ids]
+        if self.monthly_work_sketches is None:
+            raise ValueError(
+                'Date ranges need the monthly work sketches, see '
+                'MONTHLY_WORK_SKETCHES'
+            )
+        registers = np.zeros(
+            (len(fandom_names), self.registers.shape[1]), dtype=np.uint8
+        )
+        for i, fandom_name in enumerate(fandom_names):
+            first, last = self.monthly_rows.get(fandom_name, (0, 0))
+            # Rows of a fandom are sorted by month
+            months = self.months[first:last]
+            if end is not None:
+                last = first + int(
+                    np.searchsorted(months, pd.Timestamp(end).asm8)
+                )
+            if start is not None:
+                first += int(np.searchsorted(months, pd.Timestamp(start).asm8))
+            np.maximum.at(
+                registers[i],
+                self.monthly_registers[first:last],
+                self.monthly_ranks[first:last],
+            )
+        return registers
+
+    def union_count(self, fandom_names, start=None, end=None):
+        """
+        Estimated number of works in any of the fandoms
+        :param fandom_names: Names of the fandoms
+        :type fandom_names: list
+        :param start: With monthly sketches, first date of the works counted.
+            Only whole months starting from start to end are counted
+        :type start: str, datetime or pandas Timestamp
+        :param end: With monthly sketches, date after the works counted
+        :type end: str, datetime or pandas Timestamp
+        :return: Estimated number of works
+        :rtype: float
+        """
+        if not len(fandom_names):
+            return 0.0
+        return estimate_distinct_count(
+            self._fandom_registers(fandom_names, start, end).max(axis=0)
+        )
+
+    def intersection_count(self, fandom_names, start=None, end=None):
+        """
+        Estimated number of works in all of the fandoms, i.e. crossovers, by
+            inclusion-exclusion over the unions of every subset of them
+        :param fandom_names: Names of the fandoms, at most
+            WORK_SKETCH_MAX_INTERSECTION
+        :type fandom_names: list
+        :param start: See union_count
+        :param end: See union_count
+        :return: Estimated number of works, at least 0 and at most the
+            estimate of the smallest fandom
+        :rtype: float
+        """
+        if len(fandom_names) > WORK_SKETCH_MAX_INTERSECTION:
+            raise ValueError(
+                f'At most {WORK_SKETCH_MAX_INTERSECTION} fandoms can be '
+                f'intersected, got {len(fandom_names)}'
+            )
+        if not len(fandom_names):
+            return 0.0
+        registers = self._fandom_registers(fandom_names, start, end)
+        # Subsets are bit masks over fandom_names, each union built from the
+        # union without its lowest fandom
+        union_registers = [None] * 2 ** len(fandom_names)
+        intersection = 0.0
+        smallest = np.inf
+        for subset in range(1, len(union_registers)):
+            lowest = subset & -subset
+            i = lowest.bit_length() - 1
+            union_registers[subset] = (
+                registers[i] if subset == lowest
+                else np.maximum(union_registers[subset ^ lowest], registers[i])
+            )
+            union = estimate_distinct_count(union_registers[subset])
+            if subset == lowest:
+                smallest = min(smallest, union)
+            intersection += (-1) ** (bin(subset).count('1') + 1) * union
+        return float(np.clip(intersection, 0, smallest))
+
+
+class ExactWorkCounter:
+    """
+    Exact counterpart of WorkSketchIndex, from the sorted work ids of each
+        fandom. Reads the works of the fandoms queried, so it is meant to
+        validate the estimates rather than to serve queries
+    """
+    def __init__(self, retrieve_works):
+        """
+        :param retrieve_works: Function returning the works of a fandom, one
+            row per work indexed by work_id with their creation date, e.g.
+            rows of works_with_fandom
+        :type retrieve_works: function
+        """
+        self.retrieve_works = retrieve_works
+
+    def work_ids(self, fandom_name, start=None, end=None):
+        """
+        :param start: See WorkSketchIndex.union_count
+        :param end: See WorkSketchIndex.union_count
+        :return: Sorted ids of the works of the fandom created from start to
+            end
+        :rtype: numpy array
+        """
+        works = self.retrieve_works(fandom_name)
+        work_ids = works.index.get_level_values('work_id').to_numpy()
+        if start is not None or end is not None:
+            months = creation_month_ordinals(works['creation date'])
+            in_range = months != NO_CREATION_MONTH
+            if start is not None:
+                first = pd.Timestamp(start).to_period('M')
+                # Months starting before start are left out
+                first += int(first.start_time < pd.Timestamp(start))
+                in_range &= months >= first.ordinal
+            if end is not None:
+                last = pd.Timestamp(end).to_period('M')
+                last -= int(last.start_time >= pd.Timestamp(end))
+                in_range &= months <= last.ordinal
+            work_ids = work_ids[in_range]
+        return np.unique(work_ids)
+
+    def union_count(self, fandom_names, start=None, end=None):
+        """
+        Same as WorkSketchIndex.union_count, exactly
+        :rtype: int
+        """
+        return len(
+            np.unique(
+                np.concatenate(
+                    [np.array([], dtype=np.int64)]
+                    + [
+                        self.work_ids(fandom_name, start, end)
+                        for fandom_name in fandom_names
+                    ]
+                )
+            )
+        )
+
+    def intersection_count(self, fandom_names, start=None, end=None):
+        """
+        Same as WorkSketchIndex.intersection_count, exactly, intersecting the
+            sorted work ids smallest first
+        :rtype: int
+        """
+        if not len(fandom_names):
+            return 0
+        work_ids = sorted(
+            (
+                self.work_ids(fandom_name, start, end)
+                for fandom_name in fandom_names
+            ),
+            key=len,
+        )
+        intersection = work_ids[0]
+        for other in work_ids[1:]:
+            intersection = np.intersect1d(
+                intersection, other, assume_unique=True
+            )
+        return len(intersection)